@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .snippet_store import file_sha1
+from .schemas import ArtifactCacheParams
+
+CACHE_VERSION = 1
+
+
+class ArtifactCache():
+
+    """
+    On-disk cache of arrays derived from Kilosort output files
+
+    Each entry is a .npy file named by the SHA-1 of the artifact name, its
+    parameters and the contents of its source files, so an entry is only found
+    while the sources are unchanged. After phy curation re-saves
+    spike_clusters.npy with new cluster IDs, the entries derived from it are no
+    longer found, and are removed by eviction.
+
+    The SHA-1 of each source file is kept in sources.json with the file's size
+    and modification time, so a source is only read again after it changes.
+    When the entries take more than max_bytes, the least recently used are
+    deleted.
+
+    """
+
+    def __init__(self, cache_directory, max_bytes = 2 * 2**30):
+
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_directory, exist_ok = True)
+
+    def get(self, name, source_files, compute, params = None):
+
+        """
+        Returns an artifact from the cache, or computes and stores it
+
+        Inputs:
+        -------
+        name : String
+            Name of the artifact (e.g. 'unwhitened_templates')
+        source_files : list of Strings
+            Files the artifact is derived from
+        compute : function
+            Called without arguments to compute the artifact (a numpy.ndarray) on a miss
+        params : dict (optional)
+            Parameters the artifact depends on (must be JSON serializable)
+
+        Outputs:
+        --------
+        artifact : numpy.ndarray
+
+        """
+
+        entry_file = self.entry_file(name, source_files, params)
+
+        if os.path.exists(entry_file):
+            try:
+                artifact = np.load(entry_file)
+                os.utime(entry_file) # most recently used
+                return artifact
+            except (OSError, ValueError):
+                pass # removed by another process, or partly written; recompute
+
+        artifact = compute()
+
+        # signatures are taken again, as compute may have rewritten a source
+        # (templates.npy is re-saved when its NaNs are fixed)
+        self.put(self.entry_file(name, source_files, params), artifact)
+
+        return artifact
+
+    def put(self, entry_file, artifact):
+
+        # temp files are per process, so modules running at once never share one
+        temp_file = entry_file[:-len('.npy')] + '.' + repr(os.getpid()) + '.tmp.npy'
+        np.save(temp_file, artifact)
+        os.replace(temp_file, entry_file)
+
+        self.evict()
+
+    def entry_file(self, name, source_files, params = None):
+
+        key = {'version' : CACHE_VERSION,
+               'name' : name,
+               'params' : params,
+               'sources' : [self.source_sha1(source_file) for source_file in source_files]}
+
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+        return os.path.join(self.cache_directory, name + '_' + digest + '.npy')
+
+    def source_sha1(self, source_file):
+
+        """ SHA-1 of a source file, read again only if its size or modification time changed """
+
+        sources_file = os.path.join(self.cache_directory, 'sources.json')
+
+        sources = {}
+        if os.path.exists(sources_file):
+            try:
+                with open(sources_file) as f:
+                    sources = json.load(f)
+            except ValueError:
+                sources = {}
+
+        path = os.path.abspath(source_file)
+        signature = {'size' : os.path.getsize(path), 'mtime' : os.path.getmtime(path)}
+
+        saved = sources.get(path)
+        if saved is not None and saved['size'] == signature['size'] and saved['mtime'] == signature['mtime']:
+            return saved['sha1']
+
+        signature['sha1'] = file_sha1(path)
+        sources[path] = signature
+
+        # written to a per-process temp file and replaced atomically, so a reader never
+        # sees a partly written index; an update lost to a concurrent writer only
+        # means that source is hashed again
+        temp_file = sources_file + '.' + repr(os.getpid()) + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(sources, f, indent=2)
+        os.replace(temp_file, sources_file)
+
+        return signature['sha1']
+
+    def evict(self):
+
+        """ Deletes the least recently used entries until the cache is at most max_bytes """
+
+        entries = []
+        for filename in os.listdir(self.cache_directory):
+            if filename.endswith('.npy') and not filename.endswith('.tmp.npy'):
+                path = os.path.join(self.cache_directory, filename)
+                try:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except FileNotFoundError:
+                    pass # evicted by another process
+
+        total_bytes = 0
+        for last_used, size, path in sorted(entries, reverse=True):
+            total_bytes += size
+            if total_bytes > self.max_bytes:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def get_artifact_cache(args):
+
+    """
+    Artifact cache of the Kilosort output directory of a module
+
+    Inputs:
+    -------
+    args : dict
+        Module arguments, with directories and (optionally) artifact_cache_params
+        (see ArtifactCacheParams)
+
+    Outputs:
+    --------
+    cache : ArtifactCache, or None if use_cache is False
+
+    """
+
+    kilosort_output_directory = args['directories']['kilosort_output_directory']
+    cache_params = ArtifactCacheParams().load(args.get('artifact_cache_params') or {})
+
+    if not cache_params['use_cache']:
+        return None
+
+    cache_directory = cache_params['cache_directory']
+    if cache_directory is None:
+        cache_directory = os.path.join(kilosort_output_directory, 'artifact_cache')
+
+    return ArtifactCache(cache_directory, int(cache_params['max_cache_gb'] * 2**30))
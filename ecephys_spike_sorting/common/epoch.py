@@ -28,7 +28,7 @@ class Epoch():
         self.start_index = None
         self.end_index = None
 
-    def convert_to_index(timestamps):
+    def convert_to_index(self, timestamps):
 
         """ Converts start/end times to start/end indices
 
@@ -41,7 +41,7 @@ class Epoch():
 
         self.start_index = np.argmin(np.abs(timestamps - self.start_time))
 
-        if self.end_time != np.Inf:
+        if self.end_time != np.inf:
             self.end_index = np.argmin(np.abs(timestamps - self.end_time))
         else:
             self.end_index = timestamps.size
@@ -78,7 +78,7 @@ def get_epochs_from_nwb_file(filename):
 
     epochs = [Epoch('RF_mapping_and_flashes', 0, epoch1_end),
               Epoch('epoch2', epoch1_end, epoch3_start),
-              Epoch('epoch3', epoch3_start, np.Inf),
-              Epoch('complete_session', 0, np.Inf)]
+              Epoch('epoch3', epoch3_start, np.inf),
+              Epoch('complete_session', 0, np.inf)]
 
     return epochs
\ No newline at end of file
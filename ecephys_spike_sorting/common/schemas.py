@@ -34,3 +34,17 @@ class WaveformMetricsFile(DefaultSchema):
     
 class ClusterMetricsFile(DefaultSchema):
     cluster_metrics_file = String(help='Location of cluster metrics CSV')
+
+class SnippetStoreParams(DefaultSchema):
+    store_directory = String(required=False, default=None, allow_none=True, help='Folder of the snippet store (default is snippet_store in the Kilosort output directory)')
+    spikes_per_unit = Int(required=False, default=1000, help='Max number of spike snippets stored per unit')
+    samples_per_spike = Int(required=False, default=82, help='Number of samples in each snippet')
+    pre_samples = Int(required=False, default=20, help='Number of samples before the spike time')
+    site_radius_um = Float(required=False, default=100.0, help='Sites within this distance (um) of the peak channel of each unit are stored')
+    chunk_samples = Int(required=False, default=150000, help='Number of samples read from the AP band file at once')
+    random_seed = Int(required=False, default=0, help='Seed for choosing the stored spikes')
+
+class ArtifactCacheParams(DefaultSchema):
+    use_cache = Bool(required=False, default=False, help='Save derived arrays (unwhitened templates, peak channels, majority templates) in the Kilosort output directory, for reuse by later modules')
+    cache_directory = String(required=False, default=None, allow_none=True, help='Folder of the cache (default is artifact_cache in the Kilosort output directory)')
+    max_cache_gb = Float(required=False, default=2.0, help='Least recently used entries are deleted when the cache is larger than this')
@@ -0,0 +1,461 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .spike_index import SpikeIndex
+from .utils import printProgressBar, get_majority_templates
+
+STORE_VERSION = 2
+
+STORE_PARAMS = ['spikes_per_unit', 'pre_samples', 'samples_per_spike', 'site_radius_um', 'random_seed']
+
+
+class SnippetStore():
+
+    """
+    Spike snippets of each unit, read once from the raw data
+
+    Up to spikes_per_unit snippets of each unit are stored as int16, on the
+    sites within site_radius_um of the unit's peak channel, grouped by unit
+    and in time order within each unit. All arrays are memory-mapped.
+
+    Files in the store directory:
+        snippets.npy : (num_snippets x num_sites x samples_per_spike) int16
+        snippet_times.npy : (num_snippets x 0) spike time (in samples) of each snippet
+        unit_offsets.npy : (num_units + 1 x 0) snippets of unit i are unit_offsets[i]:unit_offsets[i+1]
+        kept_sites.npy : (num_units x num_sites) channel of each site (-1 for padding)
+        snippet_store.json : parameters, and signatures of the files the store was built from
+
+    """
+
+    def __init__(self, store_directory):
+
+        self.store_directory = store_directory
+
+        with open(os.path.join(store_directory, 'snippet_store.json')) as f:
+            self.manifest = json.load(f)
+
+        self.params = self.manifest['params']
+        self.pre_samples = self.params['pre_samples']
+        self.samples_per_spike = self.params['samples_per_spike']
+
+        self.snippets = np.load(os.path.join(store_directory, 'snippets.npy'), mmap_mode='r')
+        self.snippet_times = np.load(os.path.join(store_directory, 'snippet_times.npy'), mmap_mode='r')
+        self.unit_offsets = np.load(os.path.join(store_directory, 'unit_offsets.npy'))
+        self.kept_sites = np.load(os.path.join(store_directory, 'kept_sites.npy'))
+        self.num_units = self.unit_offsets.size - 1
+
+    def unit_snippets(self, cluster_id):
+
+        """ int16 snippets (num_snippets x num_sites x samples_per_spike) of one unit """
+
+        return self.snippets[self.unit_offsets[cluster_id]:self.unit_offsets[cluster_id+1]]
+
+    def unit_times(self, cluster_id):
+
+        """ Spike times (in samples) of the snippets of one unit """
+
+        return self.snippet_times[self.unit_offsets[cluster_id]:self.unit_offsets[cluster_id+1]]
+
+
+def get_snippet_store(kilosort_output_directory, raw_data, raw_data_file, spike_times, spike_clusters,
+                      templates, channel_map, channel_pos, store_params, spike_templates = None,
+                      peak_channel_index = None):
+
+    """
+    Opens the snippet store of a Kilosort output directory, building it first if it is missing or stale
+
+    Inputs:
+    -------
+    kilosort_output_directory : String
+        Folder with spike_times.npy and spike_clusters.npy
+    raw_data : numpy.ndarray (samples x channels)
+        Continuous data (usually memory-mapped)
+    raw_data_file : String
+        Path of raw_data
+    spike_times, spike_clusters, templates, channel_map, channel_pos :
+        Kilosort output, as from load_kilosort_data (spike times in samples)
+    store_params : dict
+        snippet_store_params (see SnippetStoreParams)
+    spike_templates : numpy.ndarray (optional)
+        Template IDs for each spike (needed after curation, see get_unit_peak_channels)
+    peak_channel_index : numpy.ndarray (optional)
+        Peak channel index of each template (KilosortDataset.peak_channel_index)
+
+    Outputs:
+    --------
+    store : SnippetStore
+
+    """
+
+    store_directory = store_params['store_directory']
+    if store_directory is None:
+        store_directory = os.path.join(kilosort_output_directory, 'snippet_store')
+
+    source_files = [os.path.join(kilosort_output_directory, 'spike_clusters.npy'),
+                    os.path.join(kilosort_output_directory, 'spike_times.npy'),
+                    raw_data_file]
+    if spike_templates is not None:
+        source_files.append(os.path.join(kilosort_output_directory, 'spike_templates.npy'))
+
+    params = {name : store_params[name] for name in STORE_PARAMS}
+
+    if snippet_store_is_valid(store_directory, source_files, params):
+        print('Using snippet store in ' + store_directory)
+    else:
+        print('Building snippet store in ' + store_directory)
+        build_snippet_store(raw_data, spike_times, spike_clusters, templates, channel_map, channel_pos,
+                            store_directory, chunk_samples = store_params['chunk_samples'],
+                            source_files = source_files, spike_templates = spike_templates,
+                            peak_channel_index = peak_channel_index, **params)
+
+    return SnippetStore(store_directory)
+
+
+def build_snippet_store(raw_data,
+                        spike_times,
+                        spike_clusters,
+                        templates,
+                        channel_map,
+                        channel_pos,
+                        store_directory,
+                        spikes_per_unit = 1000,
+                        pre_samples = 20,
+                        samples_per_spike = 82,
+                        site_radius_um = 100.0,
+                        random_seed = 0,
+                        chunk_samples = 150000,
+                        source_files = [],
+                        spike_templates = None,
+                        peak_channel_index = None):
+
+    """
+    Writes a snippet store (see SnippetStore) with one pass over the raw data
+
+    Up to spikes_per_unit random spikes of each unit are chosen, and their
+    snippets are read in order of their position in the file, in chunks of
+    chunk_samples samples. The manifest is written last, so an interrupted
+    build leaves an invalid store that is rebuilt on the next call.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels)
+        Continuous data (usually memory-mapped)
+    spike_times : numpy.ndarray
+        Spike times in samples
+    spike_clusters : numpy.ndarray
+        Cluster IDs for each spike time
+    templates : numpy.ndarray (templates x samples x channels)
+        Templates, used to find the peak channel of each unit
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    channel_pos : numpy.ndarray (channels x 2)
+        Positions (in um) of the channels in channel_map
+    store_directory : String
+        Folder for the store (created if it doesn't exist)
+    spikes_per_unit : Int
+        Maximum number of snippets per unit
+    pre_samples : Int
+        Number of samples before the spike time
+    samples_per_spike : Int
+        Number of samples in each snippet
+    site_radius_um : float
+        Sites within this distance of the peak channel are stored
+    random_seed : Int
+        Seed for choosing the spikes
+    chunk_samples : Int
+        Number of samples read from raw_data at once
+    source_files : list
+        Files the store is built from; their signatures are saved in the manifest
+    spike_templates : numpy.ndarray
+        Template IDs for each spike; if not given, each cluster ID is taken
+        to be its template ID (true before curation)
+    peak_channel_index : numpy.ndarray
+        Peak channel index of each template; computed from templates if not given
+
+    """
+
+    os.makedirs(store_directory, exist_ok=True)
+
+    manifest_file = os.path.join(store_directory, 'snippet_store.json')
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+    spike_clusters = np.squeeze(spike_clusters)
+    total_units = np.max(spike_clusters) + 1
+
+    peak_channels = get_unit_peak_channels(spike_clusters, spike_templates, templates, channel_map, total_units,
+                                           peak_channel_index)
+    kept_sites = get_kept_sites(peak_channels, channel_map, channel_pos[:,0], channel_pos[:,1],
+                                site_radius_um, raw_data.shape[1])
+
+    # random spikes of each unit: the spikes_per_unit with the smallest random keys
+    spike_index = SpikeIndex(spike_times, spike_clusters, total_units)
+    rng = np.random.default_rng(random_seed)
+    keys = rng.random(spike_index.num_spikes)
+    order = np.lexsort((keys, spike_index.spike_clusters))
+    rank = np.arange(order.size) - spike_index.cluster_offsets[spike_index.spike_clusters[order]]
+    chosen = np.sort(order[rank < spikes_per_unit])
+
+    times = spike_index.spike_times[chosen].astype('int64')
+    clusters = spike_index.spike_clusters[chosen].astype('int64')
+    starts = times - pre_samples
+    valid = (starts >= 0) & (starts + samples_per_spike <= raw_data.shape[0])
+    times, clusters, starts = times[valid], clusters[valid], starts[valid]
+
+    # snippets are stored by unit, and in time order within each unit
+    store_order = np.lexsort((times, clusters))
+    destination = np.empty(store_order.shape, dtype='int64')
+    destination[store_order] = np.arange(store_order.size)
+
+    unit_offsets = np.zeros((total_units + 1,), dtype='int64')
+    unit_offsets[1:] = np.cumsum(np.bincount(clusters, minlength=total_units))
+
+    snippets = np.lib.format.open_memmap(os.path.join(store_directory, 'snippets.npy'), mode='w+', dtype='int16',
+                                         shape=(times.size, kept_sites.shape[1], samples_per_spike))
+
+    for i, j, chunk_snippets in iterate_snippets(raw_data, starts, samples_per_spike, chunk_samples,
+                                                 clusters, kept_sites):
+        printProgressBar(j, starts.size)
+        snippets[destination[i:j]] = np.transpose(chunk_snippets, (0, 2, 1))
+
+    snippets.flush()
+    del snippets
+
+    np.save(os.path.join(store_directory, 'snippet_times.npy'), times[store_order])
+    np.save(os.path.join(store_directory, 'unit_offsets.npy'), unit_offsets)
+    np.save(os.path.join(store_directory, 'kept_sites.npy'), kept_sites)
+
+    manifest = {'version' : STORE_VERSION,
+                'params' : {'spikes_per_unit' : spikes_per_unit,
+                            'pre_samples' : pre_samples,
+                            'samples_per_spike' : samples_per_spike,
+                            'site_radius_um' : site_radius_um,
+                            'random_seed' : random_seed},
+                'num_snippets' : int(times.size),
+                'source_files' : {os.path.basename(f) : file_signature(f, hash_contents = f.endswith('.npy'))
+                                  for f in source_files}}
+
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def snippet_store_is_valid(store_directory, source_files, params = None):
+
+    """
+    Checks whether a snippet store was built from the current source files (and with params)
+
+    A source file matches if its size and modification time are unchanged, or,
+    for files whose contents were hashed (the .npy files), if the contents are
+    unchanged. So a spike_clusters.npy re-saved after curation invalidates the
+    store only if the cluster IDs actually changed. When a file is hashed and
+    matches, its new modification time is saved in the manifest, so it is not
+    hashed again on the next call.
+
+    """
+
+    manifest_file = os.path.join(store_directory, 'snippet_store.json')
+
+    if not os.path.exists(manifest_file):
+        return False
+
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != STORE_VERSION:
+        return False
+
+    if params is not None and any(manifest['params'].get(name) != value for name, value in params.items()):
+        return False
+
+    refreshed = False
+
+    for source_file in source_files:
+
+        saved = manifest['source_files'].get(os.path.basename(source_file))
+
+        if saved is None or not os.path.exists(source_file) or os.path.getsize(source_file) != saved['size']:
+            return False
+
+        if os.path.getmtime(source_file) != saved['mtime']:
+            if 'sha1' not in saved or file_sha1(source_file) != saved['sha1']:
+                return False
+            saved['mtime'] = os.path.getmtime(source_file)
+            refreshed = True
+
+    if refreshed:
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    return True
+
+
+def file_signature(path, hash_contents = True):
+
+    """ Size, modification time and (optionally) SHA-1 of a file """
+
+    signature = {'size' : os.path.getsize(path), 'mtime' : os.path.getmtime(path)}
+
+    if hash_contents:
+        signature['sha1'] = file_sha1(path)
+
+    return signature
+
+
+def file_sha1(path, block_size = 2**24):
+
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def iterate_snippets(raw_data, snippet_starts, samples_per_spike, chunk_samples = 150000,
+                     snippet_groups = None, group_sites = None):
+
+    """
+    Reads snippets from raw_data in chunks
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels)
+    snippet_starts : numpy.ndarray
+        First sample of each snippet, in increasing order
+    samples_per_spike : Int
+    chunk_samples : Int
+        Number of samples read from raw_data at once
+    snippet_groups : numpy.ndarray
+        Group of each snippet (only needed with group_sites)
+    group_sites : numpy.ndarray (num_groups x num_sites)
+        If given, only these channels are read for each group (-1 for padding, read as channel 0)
+
+    Outputs (yielded for each chunk):
+    --------
+    i, j : Int
+        The chunk holds snippets i:j
+    snippets : numpy.ndarray (j - i x samples_per_spike x channels (or num_sites))
+        Raw data of the snippets
+
+    """
+
+    # snippets are kept to about the size of one chunk of raw data (as float64 by the caller)
+    max_snippets = max(1, chunk_samples // (4 * samples_per_spike))
+    sample_offsets = np.arange(samples_per_spike)
+
+    i = 0
+    while i < snippet_starts.size:
+
+        chunk_start = snippet_starts[i]
+        j = min(np.searchsorted(snippet_starts, chunk_start + chunk_samples, side='left'), i + max_snippets)
+        chunk_end = snippet_starts[j-1] + samples_per_spike
+
+        chunk = np.asarray(raw_data[chunk_start:chunk_end, :])
+
+        if group_sites is None:
+            snippets = chunk[(snippet_starts[i:j] - chunk_start)[:, np.newaxis] + sample_offsets, :]
+        else:
+            snippets = chunk[(snippet_starts[i:j] - chunk_start)[:, np.newaxis, np.newaxis] + sample_offsets[:, np.newaxis],
+                             np.maximum(group_sites[snippet_groups[i:j]], 0)[:, np.newaxis, :]]
+
+        yield i, j, snippets
+
+        i = j
+
+
+def get_unit_peak_channels(spike_clusters, spike_templates, templates, channel_map, total_units,
+                           peak_channel_index = None):
+
+    """
+    Peak channel of each unit, from its majority template
+
+    After merges and splits in phy, cluster IDs no longer match template IDs
+    (and can exceed the number of templates), so as in getSortResults the
+    peak channel of a unit is that of its most common template.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray
+        Template IDs for each spike (None if every cluster ID is its template ID)
+    templates : numpy.ndarray (templates x samples x channels)
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    total_units : Int
+        Number of cluster IDs
+    peak_channel_index : numpy.ndarray (optional)
+        Index (into channel_map) of the peak channel of each template, as from
+        KilosortDataset.peak_channel_index; computed from templates if not given
+
+    Outputs:
+    --------
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel (one of channel_map) of each unit; units without spikes
+        get the peak channel of template 0
+
+    """
+
+    if peak_channel_index is None:
+        peak_channel_index = np.argmax(np.max(templates,1) - np.min(templates,1),1)
+
+    template_peaks = np.ravel(channel_map)[peak_channel_index]
+
+    if spike_templates is None:
+        if total_units > templates.shape[0]:
+            raise ValueError('Cluster IDs exceed the number of templates; spike_templates is needed after curation')
+        return template_peaks[:total_units]
+
+    majority_templates = get_majority_templates(spike_clusters, spike_templates, total_units)
+
+    return template_peaks[np.maximum(majority_templates, 0)]
+
+
+def get_kept_sites(peak_channels, channel_map, site_x, site_y, site_radius_um, num_channels):
+
+    """
+    Channels within site_radius_um of each unit's peak channel
+
+    Inputs:
+    -------
+    peak_channels : numpy.ndarray (num_units x 0)
+        Peak channel of each unit (one of channel_map)
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    site_x, site_y : numpy.ndarray
+        Positions (in um) of the channels in channel_map
+    site_radius_um : float
+        Radius around the peak channel
+    num_channels : Int
+        Number of channels in the data
+
+    Outputs:
+    --------
+    kept_sites : numpy.ndarray (num_units x max kept sites)
+        Kept channels of each unit in channel_map order, padded with -1
+
+    """
+
+    channel_map = np.ravel(channel_map)
+
+    map_index = np.full((num_channels,), -1, dtype='int64')
+    map_index[channel_map] = np.arange(channel_map.size)
+    peak_index = map_index[peak_channels]
+
+    distance = np.sqrt(np.square(site_x[np.newaxis, :] - site_x[peak_index][:, np.newaxis]) + \
+                       np.square(site_y[np.newaxis, :] - site_y[peak_index][:, np.newaxis]))
+    within = distance <= site_radius_um
+
+    num_sites = np.max(np.sum(within, 1))
+
+    # kept channels first, in channel_map order
+    order = np.argsort(~within, axis=1, kind='stable')[:, :num_sites]
+    kept = np.take_along_axis(within, order, 1)
+
+    return np.where(kept, channel_map[order], -1).astype('int64')
@@ -0,0 +1,170 @@
+import numpy as np
+
+
+class SpikeIndex():
+
+    """
+    Time-sorted index of spikes, with the spikes of each cluster in time order
+
+    Every epoch maps to a contiguous [start, stop) range of the time-sorted
+    spikes, so per-epoch arrays are slices (views) of the sorted arrays, and
+    the spikes of each cluster within an epoch are found without a mask over
+    all spikes.
+
+    Kilosort writes spikes in time order; if spike_times are not sorted, the
+    arrays passed to sort() are reordered once.
+
+    """
+
+    def __init__(self, spike_times, spike_clusters, total_units = None, sample_rate = None):
+
+        """
+        spike_times : numpy.ndarray (num_spikes x 0)
+            Spike times in seconds, or in samples if sample_rate is given
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike time
+        total_units : Int
+            Number of cluster IDs (default is max cluster ID + 1)
+        sample_rate : float
+            If given, epoch times (in seconds) are compared with spike_times / sample_rate
+        """
+
+        spike_times = np.squeeze(spike_times)
+        spike_clusters = np.squeeze(spike_clusters)
+
+        if np.all(spike_times[1:] >= spike_times[:-1]):
+            self.time_order = None
+        else:
+            self.time_order = np.argsort(spike_times, kind='stable')
+
+        self.spike_times = self.sort(spike_times)
+        self.spike_clusters = self.sort(spike_clusters)
+        self.num_spikes = spike_times.size
+        self.sample_rate = sample_rate
+
+        if total_units is None:
+            total_units = np.max(spike_clusters) + 1
+        self.total_units = total_units
+
+        # positions (in the time-sorted arrays) of each cluster's spikes, in time order
+        self.cluster_order = np.argsort(self.spike_clusters, kind='stable')
+        self.cluster_offsets = np.zeros((total_units + 1,), dtype='int64')
+        self.cluster_offsets[1:] = np.cumsum(np.bincount(self.spike_clusters, minlength=total_units))
+        self._cluster_keys = None   # built on the first call to cluster_ranges
+
+    def sort(self, values):
+
+        """ Returns values (one per spike) in time order; values itself if spikes are already sorted """
+
+        if self.time_order is None:
+            return values
+
+        return values[self.time_order]
+
+    def original_indices(self, start = 0, stop = None):
+
+        """ Indices into the unsorted arrays (e.g. pc_features) of the sorted spikes start:stop """
+
+        if stop is None:
+            stop = self.num_spikes
+
+        if self.time_order is None:
+            return np.arange(start, stop)
+
+        return self.time_order[start:stop]
+
+    def epoch_range(self, epoch, include_start = True, include_end = True):
+
+        """ Range of time-sorted spikes within an epoch
+
+        Input:
+        ------
+        epoch : Epoch
+            Epoch with start and end times in seconds
+        include_start, include_end : bool
+            Whether spikes exactly at the start/end time are in the epoch
+
+        Output:
+        -------
+        start, stop : Int
+            Spikes of the epoch are start:stop of the sorted arrays
+
+        """
+
+        start = self._search(epoch.start_time, 'left' if include_start else 'right')
+        stop = self._search(epoch.end_time, 'right' if include_end else 'left')
+
+        return start, max(start, stop)
+
+    def grouped(self, start = 0, stop = None):
+
+        """ Spikes start:stop ordered by cluster (and by time within each cluster)
+
+        Same output as group_spikes_by_cluster(spike_clusters[start:stop], total_units, spike_times[start:stop]),
+        from the cluster order built once for all spikes.
+
+        Output:
+        -------
+        order : numpy.ndarray
+            Indices (relative to start) that sort the spikes by (cluster, time)
+        offsets : numpy.ndarray (total_units + 1 x 0)
+            Spikes of cluster i are order[offsets[i]:offsets[i+1]]
+
+        """
+
+        if stop is None:
+            stop = self.num_spikes
+
+        if start == 0 and stop == self.num_spikes:
+            return self.cluster_order, self.cluster_offsets
+
+        starts, stops = self.cluster_ranges(start, stop)
+
+        offsets = np.zeros((self.total_units + 1,), dtype='int64')
+        offsets[1:] = np.cumsum(stops - starts)
+
+        # concatenate each cluster's contiguous run of cluster_order
+        runs = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], stops - starts)
+        order = self.cluster_order[runs] - start
+
+        return order, offsets
+
+    def cluster_ranges(self, start, stop):
+
+        """ For each cluster, the range of cluster_order holding its spikes within start:stop
+
+        Within a cluster, positions in cluster_order increase, so (cluster, position)
+        is sorted and both ends are found with one searchsorted call.
+
+        """
+
+        clusters = np.arange(self.total_units, dtype='int64')
+
+        if self._cluster_keys is None:
+            self._cluster_keys = np.repeat(clusters, np.diff(self.cluster_offsets)) * (self.num_spikes + 1) + \
+                                 self.cluster_order
+
+        starts = np.searchsorted(self._cluster_keys, clusters * (self.num_spikes + 1) + start)
+        stops = np.searchsorted(self._cluster_keys, clusters * (self.num_spikes + 1) + stop)
+
+        return starts, stops
+
+    def _search(self, time, side):
+
+        # first sorted spike at or after (side='left') or after (side='right') time, in seconds
+        if self.sample_rate is None:
+            return int(np.searchsorted(self.spike_times, time, side))
+
+        # searchsorted on samples, then corrected so the comparison is made in seconds
+        if side == 'left':
+            in_range = lambda t: t / self.sample_rate >= time
+        else:
+            in_range = lambda t: t / self.sample_rate > time
+
+        i = int(np.searchsorted(self.spike_times, time * self.sample_rate, side))
+        while i > 0 and in_range(self.spike_times[i-1]):
+            i -= 1
+        while i < self.num_spikes and not in_range(self.spike_times[i]):
+            i += 1
+
+        return i
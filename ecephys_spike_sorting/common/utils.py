@@ -221,7 +221,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -232,6 +232,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        If not None, memory-map the file with this mode (see numpy.load)
 
     Outputs:
     --------
@@ -240,7 +242,250 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
+
+
+class KilosortDataset():
+
+    """
+    Kilosort output directory, with each file loaded on first access
+
+    Per-spike arrays and features are memory-mapped (see mmap_mode), so a
+    module only pays for the files it actually reads. Derived values
+    (unwhitened templates, peak channels, template amplitudes, spike times
+    in seconds) are computed once and cached. With an ArtifactCache, the
+    unwhitened templates, peak channels and majority templates are also kept
+    on disk for the modules that run next.
+
+    """
+
+    __slots__ = ('folder', 'sample_rate', 'use_master_clock', 'mmap_mode', 'features_mmap_mode', 'cache',
+                 '_spike_times', '_spike_times_seconds', '_spike_clusters', '_spike_templates',
+                 '_amplitudes', '_whitened_templates', '_template_zero_padding', '_templates',
+                 '_whitening_mat_inv', '_channel_map', '_channel_pos', '_pc_features',
+                 '_pc_feature_ind', '_template_features', '_cluster_ids', '_cluster_amplitude',
+                 '_peak_channel_index', '_template_amplitudes', '_majority_templates')
+
+    def __init__(self, folder, sample_rate = None, use_master_clock = False, mmap_mode = 'r',
+                 features_mmap_mode = 'r', cache = None):
+
+        """
+        folder : String
+            Location of Kilosort output directory
+        sample_rate : float (optional)
+            AP band sample rate in Hz (needed for spike_times_seconds)
+        use_master_clock : bool (optional)
+            Flags whether to load spike times that have been converted to the master clock timebase
+        mmap_mode : String (optional)
+            Mode used to memory-map the per-spike arrays (None reads them into memory)
+        features_mmap_mode : String (optional)
+            Mode used to memory-map pc_features and template_features
+        cache : ArtifactCache (optional)
+            On-disk cache for derived arrays (see common.artifact_cache)
+        """
+
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.use_master_clock = use_master_clock
+        self.mmap_mode = mmap_mode
+        self.features_mmap_mode = features_mmap_mode
+        self.cache = cache
+
+        # everything after the settings above is filled in on first access
+        for name in self.__slots__[6:]:
+            setattr(self, name, None)
+
+    def _cached(self, name, compute):
+
+        # value of slot name, computed on first access
+        value = getattr(self, name)
+        if value is None:
+            value = compute()
+            setattr(self, name, value)
+        return value
+
+    def _artifact(self, name, source_files, compute):
+
+        # computed, or read from the artifact cache if there is one
+        if self.cache is None:
+            return compute()
+        return self.cache.get(name, [os.path.join(self.folder, filename) for filename in source_files], compute)
+
+    def _load_optional(self, filename, mmap_mode = None):
+
+        # pc and template features files were not created by some versions of KS
+        if os.path.isfile(os.path.join(self.folder, filename)):
+            return load(self.folder, filename, mmap_mode)
+        return np.asarray([])
+
+    @property
+    def spike_times(self):
+        """ Spike times in samples (N x 0) """
+        filename = 'spike_times_master_clock.npy' if self.use_master_clock else 'spike_times.npy'
+        return self._cached('_spike_times', lambda: np.squeeze(load(self.folder, filename, self.mmap_mode)))
+
+    @property
+    def spike_times_seconds(self):
+        """ Spike times in seconds (N x 0) """
+        if self.sample_rate is None:
+            raise ValueError('sample_rate is needed to convert spike times to seconds')
+        return self._cached('_spike_times_seconds', lambda: self.spike_times / self.sample_rate)
+
+    @property
+    def spike_clusters(self):
+        """ Cluster IDs for each spike (N x 0) """
+        return self._cached('_spike_clusters',
+                            lambda: np.squeeze(load(self.folder, 'spike_clusters.npy', self.mmap_mode)))
+
+    @property
+    def spike_templates(self):
+        """ Template IDs for each spike """
+        return self._cached('_spike_templates', lambda: load(self.folder, 'spike_templates.npy', self.mmap_mode))
+
+    @property
+    def amplitudes(self):
+        """ Template scaling amplitudes for each spike """
+        return self._cached('_amplitudes', lambda: load(self.folder, 'amplitudes.npy', self.mmap_mode))
+
+    @property
+    def whitening_mat_inv(self):
+        return self._cached('_whitening_mat_inv', lambda: load(self.folder, 'whitening_mat_inv.npy'))
+
+    @property
+    def channel_map(self):
+        return self._cached('_channel_map', lambda: load(self.folder, 'channel_map.npy'))
+
+    @property
+    def channel_pos(self):
+        """ X and Z coordinates for each channel used in the sort (channels x 2) """
+        return self._cached('_channel_pos', lambda: load(self.folder, 'channel_positions.npy'))
+
+    @property
+    def num_templates(self):
+        # read from the file header, without loading the templates
+        if self._whitened_templates is not None:
+            return self._whitened_templates.shape[0]
+        return load(self.folder, 'templates.npy', 'r').shape[0]
+
+    @property
+    def whitened_templates(self):
+        """ Templates as saved by Kilosort, without NaNs or leading zero padding (M x samples x channels) """
+        if self._whitened_templates is None:
+            self._load_templates()
+        return self._whitened_templates
+
+    @property
+    def template_zero_padding(self):
+        """ Number of zero samples removed from the beginning of each template """
+        if self._template_zero_padding is None:
+            self._load_templates()
+        return self._template_zero_padding
+
+    def _load_templates(self):
+
+        templates = load(self.folder, 'templates.npy')
+
+        # fix any nans in templates
+        if np.sum(np.isnan(templates)):
+            templates = np.nan_to_num(templates)
+            np.save(os.path.join(self.folder, 'templates.npy'), templates)
+
+        # zero padding differs between sort versions, so derive from the
+        # values in the templates
+        s1 = np.nansum(templates,axis=0)
+        s2 = np.nansum(s1,axis=1)
+        wz = np.where(s2==0)
+        template_zero_padding = 0
+        if np.any(wz[0]):
+            template_zero_padding = np.max(wz) + 1
+            print('template zero padding: ' + repr(template_zero_padding))
+            templates = templates[:,template_zero_padding:,:] # remove zeros
+
+        self._whitened_templates = templates
+        self._template_zero_padding = template_zero_padding
+
+    @property
+    def templates(self):
+        """ Unwhitened templates (M x samples x channels) """
+        return self._cached('_templates',
+                            lambda: self._artifact('unwhitened_templates', ['templates.npy', 'whitening_mat_inv.npy'],
+                                                   self._unwhiten_templates))
+
+    def _unwhiten_templates(self):
+
+        # one batched product instead of a loop over templates
+        return np.matmul(np.ascontiguousarray(self.whitened_templates),
+                         np.ascontiguousarray(self.whitening_mat_inv)).astype('float64')
+
+    @property
+    def peak_channel_index(self):
+        """ Index (into channel_map) of the channel with the largest peak-to-peak amplitude of each template """
+        return self._cached('_peak_channel_index',
+                            lambda: self._artifact('peak_channel_index', ['templates.npy', 'whitening_mat_inv.npy'],
+                                                   lambda: np.argmax(np.max(self.templates,1) - np.min(self.templates,1),1)))
+
+    @property
+    def peak_channels(self):
+        """ Peak channel of each template, from channel_map """
+        return np.squeeze(self.channel_map[self.peak_channel_index])
+
+    @property
+    def template_amplitudes(self):
+        """ Peak-to-peak amplitude of each unwhitened template on its peak channel """
+        return self._cached('_template_amplitudes',
+                            lambda: np.max(np.max(self.templates,1) - np.min(self.templates,1),1))
+
+    @property
+    def majority_templates(self):
+        """ Most common template of each cluster (max cluster ID + 1 x 0), -1 for IDs without spikes """
+        return self._cached('_majority_templates',
+                            lambda: self._artifact('majority_templates', ['spike_clusters.npy', 'spike_templates.npy'],
+                                                   lambda: get_majority_templates(self.spike_clusters,
+                                                                                  self.spike_templates,
+                                                                                  np.max(self.spike_clusters) + 1)))
+
+    @property
+    def pc_features(self):
+        """ PC features for each spike (N x channels x num_PCs), or an empty array """
+        return self._cached('_pc_features', lambda: self._load_optional('pc_features.npy', self.features_mmap_mode))
+
+    @property
+    def pc_feature_ind(self):
+        """ Channels used for PC calculation for each unit (M x channels), or an empty array """
+        return self._cached('_pc_feature_ind', lambda: self._load_optional('pc_feature_ind.npy'))
+
+    @property
+    def template_features(self):
+        """ Projections onto template features for each spike, or an empty array """
+        return self._cached('_template_features',
+                            lambda: self._load_optional('template_features.npy', self.features_mmap_mode))
+
+    @property
+    def cluster_ids(self):
+        # removed option to read cluster_ids from cluster_group_tsv because this file is changed by phy.
+        return self._cached('_cluster_ids', lambda: np.unique(self.spike_clusters))
+
+    @property
+    def cluster_quality(self):
+        return ['unsorted'] * self.cluster_ids.size
+
+    @property
+    def cluster_amplitude(self):
+        """ Average amplitude for each cluster from cluster_Amplitude.tsv file """
+        return self._cached('_cluster_amplitude', self._load_cluster_amplitude)
+
+    def _load_cluster_amplitude(self):
+
+        cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(self.folder, 'cluster_Amplitude.tsv'))
+
+        # check that cluster_amplitude has the same number of entries as templates
+        # if highest index units have no spikes, they will not have an entry in cluster_Amplitudes.tsv
+        diff = self.num_templates - cluster_amplitude.size
+        if diff > 0:
+            pad = np.zeros((diff,))
+            cluster_amplitude = np.append(cluster_amplitude,pad)
+
+        return cluster_amplitude
 
 
 def load_kilosort_data(folder, 
@@ -248,7 +493,9 @@ def load_kilosort_data(folder,
                        convert_to_seconds = True, 
                        use_master_clock = False, 
                        include_pcs = False,
-                       template_zero_padding= 21):
+                       template_zero_padding= 21,
+                       mmap_mode = None,
+                       cache = None):
 
     """
     Loads Kilosort output files from a directory
@@ -267,6 +514,11 @@ def load_kilosort_data(folder,
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_mode : String (optional)
+        If not None (e.g. 'r'), pc_features and template_features are memory-mapped
+        instead of read into memory
+    cache : ArtifactCache (optional)
+        If given, the unwhitened templates are read from (or saved to) this cache
 
     Outputs:
     --------
@@ -299,84 +551,22 @@ def load_kilosort_data(folder,
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder,'spike_times_master_clock.npy')
-    else:
-        spike_times = load(folder,'spike_times.npy')
-        
-    spike_clusters = load(folder,'spike_clusters.npy')
-    spike_templates = load(folder, 'spike_templates.npy')
-    amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
-    channel_map = load(folder, 'channel_map.npy')
-    channel_pos = load(folder, 'channel_positions.npy')
-
-    # pc and template features files were not created by some versions of KS.
-    # skip if absent, or caller has specfied include_pcs=False
-    if include_pcs and os.path.isfile(os.path.join(folder, 'pc_features.npy')):
-        pc_features = load(folder, 'pc_features.npy')
-    else:
-        pc_features = np.asarray([])
-    if include_pcs and os.path.isfile(os.path.join(folder, 'pc_feature_ind.npy')):
-        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-    else:
-        pc_feature_ind = np.asarray([])
-    if include_pcs and os.path.isfile(os.path.join(folder, 'template_features.npy')):
-        template_features = load(folder, 'template_features.npy') 
+    dataset = KilosortDataset(folder, sample_rate, use_master_clock,
+                              mmap_mode = None, features_mmap_mode = mmap_mode, cache = cache)
+
+    if convert_to_seconds and sample_rate is not None:
+        spike_times = dataset.spike_times_seconds
     else:
-        template_features = np.asarray([])
+        spike_times = dataset.spike_times
 
-    # fix any nans in templates
-    if np.sum(np.isnan(templates)):
-        templates = np.nan_to_num(templates)
-        np.save(os.path.join(folder,'templates.npy'),templates)
-    
-    # zero padding differs between sort versions, so derive from the
-    # values in the templates
-    s1 = np.nansum(templates,axis=0)
-    s2 = np.nansum(s1,axis=1)
-    wz = np.where(s2==0)
-    if np.any(wz[0]):       
-        template_zero_padding = np.max(wz) + 1
-        print('template zero padding: ' + repr(template_zero_padding))
-        templates = templates[:,template_zero_padding:,:] # remove zeros
-        
-    spike_clusters = np.squeeze(spike_clusters) # fix dimensions
-    spike_times = np.squeeze(spike_times)# fix dimensions
+    outputs = (spike_times, dataset.spike_clusters, dataset.spike_templates, dataset.amplitudes,
+               dataset.templates, dataset.channel_map, dataset.channel_pos, dataset.cluster_ids,
+               dataset.cluster_quality, dataset.cluster_amplitude)
 
-    if convert_to_seconds and sample_rate is not None:
-       spike_times = spike_times / sample_rate 
-                    
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-    
-    # removed option to read cluster_ids from cluster_group_tsv because this file is changed by phy.                
-    # try:
-    #     cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    # except OSError:
-    cluster_ids = np.unique(spike_clusters)
-    cluster_quality = ['unsorted'] * cluster_ids.size
-        
-    cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(folder, 'cluster_Amplitude.tsv'))
-    
-    # check that cluster_amplitude has the same number of entries as templates
-    # if highest index units have no spikes, they will not have an entry in cluster_Amplitudes.tsv
-    diff = templates.shape[0] - cluster_amplitude.size
-    if diff > 0:
-        pad = np.zeros((diff,))
-        cluster_amplitude = np.append(cluster_amplitude,pad)
-        
     if not include_pcs:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-                   channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude                 
+        return outputs
     else:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-           channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude, \
-           pc_features, pc_feature_ind, template_features
+        return outputs + (dataset.pc_features, dataset.pc_feature_ind, dataset.template_features)
 
 def get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq, pc_feature_ind, channel_pos):
 
@@ -465,6 +655,39 @@ def get_spike_amplitudes(spike_templates, templates, amplitudes):
     return np.squeeze(spike_amplitudes)
 
 
+def get_majority_templates(spike_clusters, spike_templates, total_units):
+
+    """ Most common template for the spikes of each unit
+
+    Ties go to the lowest template ID, as with np.argmax(np.bincount(...)).
+
+    Outputs:
+    --------
+    template_ids : numpy.ndarray (total_units x 0)
+        Majority template of each unit (-1 for units without spikes)
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    spike_templates = np.squeeze(spike_templates).astype('int64')
+
+    template_ids = -np.ones((total_units,), dtype='int64')
+
+    if spike_clusters.size == 0:
+        return template_ids
+
+    num_templates = np.max(spike_templates) + 1
+    pairs, counts = np.unique(spike_clusters * num_templates + spike_templates, return_counts=True)
+    pair_clusters = pairs // num_templates
+    pair_templates = pairs % num_templates
+
+    # within each unit, order by count (descending) and then by template
+    order = np.lexsort((pair_templates, -counts, pair_clusters))
+    first = np.concatenate(([True], np.diff(pair_clusters[order]) != 0))
+
+    template_ids[pair_clusters[order][first]] = pair_templates[order][first]
+
+    return template_ids
 
 def get_repo_commit_date_and_hash(repo_location):
 
@@ -619,44 +842,31 @@ def catGT_ex_params_from_str(ex_str):
 
     return ex_type, stream_index, prb_index, ex_name_str
 
-def getSortResults(output_dir, clu_version):
+def getSortResults(output_dir, clu_version, cache = None):
     # load results from phy for run logging and creation of the table for C_Waves
+    # if cache (an ArtifactCache) is given, the majority templates and peak channels are reused from it
 
-    cluLabel = np.load(os.path.join(output_dir, 'spike_clusters.npy'))
-    spkTemplate = np.load(os.path.join(output_dir,'spike_templates.npy'))
-    cluLabel = np.squeeze(cluLabel)
-    spkTemplate = np.squeeze(spkTemplate)
+    dataset = KilosortDataset(output_dir, cache = cache)
+    cluLabel = dataset.spike_clusters
 
-    unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
+    # one bincount instead of sorting all spikes with np.unique
+    allCounts = np.bincount(cluLabel)
+    unqLabel = np.nonzero(allCounts)[0]
+    labelCounts = allCounts[unqLabel]
     nTot = cluLabel.shape[0]
-    nLabel = unqLabel.shape[0]
     maxLabel = np.max(unqLabel)
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
-    channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
-    channel_map = np.squeeze(channel_map)
-    
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nLabel,],'uint32')
-    
+    channel_map = np.squeeze(dataset.channel_map)
    
     # After manual splits or merges, some labels will have spikes found with
     # different templats.
-    # for each label in the list unqLabel, get the most common template
-    # For that template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nLabel):
-        curr_spkTemplate = spkTemplate[np.where(cluLabel==unqLabel[i])]
-        template_mode = np.argmax(np.bincount(curr_spkTemplate))
-        currT = templates[template_mode,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+    # for each label in the list unqLabel, get the most common template, and
+    # the peak channel of that template (largest peak-to-peak amplitude of the
+    # unwhitened template; the whitening matrix of Kilosort is symmetric, so
+    # this is the same as multiplying by the transpose of the template)
+    labelTemplate = dataset.majority_templates[unqLabel]
+    peak_channels = channel_map[dataset.peak_channel_index[labelTemplate]].astype('uint32')
+    nTemplate = dataset.peak_channel_index.size
 
     clus_Table = np.zeros((maxLabel+1, 2), dtype='uint32')
     clus_Table[unqLabel, 0] = labelCounts
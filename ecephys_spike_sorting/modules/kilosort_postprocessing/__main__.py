@@ -5,10 +5,13 @@ import time
 
 import numpy as np
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset
+from ...common.artifact_cache import get_artifact_cache
 
-from .postprocessing import remove_double_counted_spikes
+from .postprocessing import find_double_counted_spikes
+from .postprocessing import write_kept_spikes
 from .postprocessing import align_spike_times
+from .postprocessing import align_spike_times_from_templates
 
 def run_postprocessing(args):
 
@@ -20,55 +23,81 @@ def run_postprocessing(args):
     #print(args['directories'].keys())
 
     start = time.time()
-    
+
+    cache = get_artifact_cache(args)
        
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                    args['ephys_params']['sample_rate'], \
-                    convert_to_seconds = False, \
-                    use_master_clock = False, \
-                    include_pcs = True )
+    # one dataset, so the template peak channels are found once (or read from the cache)
+    dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                args['ephys_params']['sample_rate'], \
+                use_master_clock = False, \
+                mmap_mode = None, \
+                features_mmap_mode = 'r', \
+                cache = cache)
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, channel_pos, cluster_amplitude = \
+                dataset.spike_times, dataset.spike_clusters, dataset.spike_templates, dataset.amplitudes, \
+                dataset.templates, dataset.channel_map, dataset.channel_pos, dataset.cluster_amplitude
+    pc_features, template_features = dataset.pc_features, dataset.template_features
+    peak_channel_index = dataset.peak_channel_index
 
         
-    if args['ks_postprocessing_params']['align_avg_waveform']: 
+    if args['ks_postprocessing_params']['align_avg_waveform'] and \
+       args['ks_postprocessing_params']['align_method'] == 'template':
+        rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+        data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+        spike_times, ambiguous_units = align_spike_times_from_templates(spike_times,
+                                        spike_clusters,
+                                        templates,
+                                        amplitudes,
+                                        channel_map,
+                                        channel_pos,
+                                        data,
+                                        args['ephys_params']['bit_volts'],
+                                        ambiguity_margin = args['ks_postprocessing_params']['align_ambiguity_margin'],
+                                        peak_channel_index = peak_channel_index)
+    elif args['ks_postprocessing_params']['align_avg_waveform']: 
         spike_times = align_spike_times(spike_times,
                                         spike_clusters,
                                         args['ephys_params']['ap_band_file'], 
                                         args['directories']['kilosort_output_directory'], 
-                                        args['ks_postprocessing_params']['cWaves_path'])
+                                        args['ks_postprocessing_params']['cWaves_path'],
+                                        cache = cache)
         
     if args['ks_postprocessing_params']['remove_duplicates']:
-        spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-        template_features, overlap_matrix, overlap_summary = \
-            remove_double_counted_spikes(spike_times, 
-                                         spike_clusters,
-                                         spike_templates, 
-                                         amplitudes, 
-                                         channel_map,
-                                         channel_pos,
-                                         templates, 
-                                         pc_features, 
-                                         pc_feature_ind, 
-                                         template_features,
-                                         cluster_amplitude,
-                                         args['ephys_params']['sample_rate'],
-                                         args['ks_postprocessing_params'])
+        keep, overlap_matrix, overlap_summary = \
+            find_double_counted_spikes(spike_times, 
+                                       spike_clusters,
+                                       channel_map,
+                                       channel_pos,
+                                       templates, 
+                                       cluster_amplitude,
+                                       args['ephys_params']['sample_rate'],
+                                       args['ks_postprocessing_params'],
+                                       peak_channel_index = peak_channel_index)
+    else:
+        keep = np.ones((spike_clusters.size,), dtype = bool)
 
 
     print("Saving data...")
 
     # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
     output_dir = args['directories']['kilosort_output_directory']
-    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
-    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
-    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)    
-    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
-    
-    if pc_features.size > 0:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-    if template_features.size > 0: 
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+
+    arrays = {'spike_times.npy' : spike_times,
+              'amplitudes.npy' : amplitudes,
+              'spike_clusters.npy' : spike_clusters,
+              'spike_templates.npy' : spike_templates}
+
+    # the feature files are only rewritten if spikes were removed; they are
+    # memory-mapped by write_kept_spikes, so our own memory maps are released first
+    if not np.all(keep):
+        if pc_features.size > 0:
+            arrays['pc_features.npy'] = None
+        if template_features.size > 0:
+            arrays['template_features.npy'] = None
+    del pc_features, template_features, dataset
+
+    write_kept_spikes(output_dir, keep, arrays, args['ks_postprocessing_params']['chunk_spikes'])
     
     if args['ks_postprocessing_params']['remove_duplicates']:
         np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
@@ -1,7 +1,7 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean
-from ...common.schemas import EphysParams, Directories
+from ...common.schemas import EphysParams, Directories, ArtifactCacheParams
 
 
 class PostprocessingParams(DefaultSchema):
@@ -11,11 +11,15 @@ class PostprocessingParams(DefaultSchema):
     deletion_mode = String(required=False, default='lowAmpCluster', help='lowAmpCluster or deleteFirst')   
     remove_duplicates = Boolean(required=False, default=True, help='Set to True for duplicate removal')
     align_avg_waveform = Boolean(required=False, default=True, help='Set to true to set spike times for mean waveform min = t0')
+    align_method = String(required=False, default='C_Waves', help='C_Waves (mean waveforms of all units from the AP band file) or template (peak times from the templates; the AP band file is read only for ambiguous units)')
+    align_ambiguity_margin = Float(required=False, default=1.5, help='For template alignment, units whose alignment decision would change with amplitudes scaled by up to this factor are aligned from the AP band file')
     cWaves_path = InputDir(require=False, help='directory containing the CWaves executable.')
+    chunk_spikes = Int(required=False, default=100000, help='Number of spikes copied at once when rewriting the phy files without the removed spikes')
 
 class InputParameters(ArgSchema):
     
     ks_postprocessing_params = Nested(PostprocessingParams)
+    artifact_cache_params = Nested(ArtifactCacheParams)
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
     
@@ -6,11 +6,12 @@ from collections import OrderedDict
 
 from ...common.utils import printProgressBar
 from ...common.utils import getSortResults
+from ...common.snippet_store import get_kept_sites, iterate_snippets
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
                                  pc_feature_ind, template_features, cluster_amplitude, 
-                                 sample_rate, params, epochs = None):
+                                 sample_rate, params, epochs = None, peak_channel_index = None):
 
     """ Remove putative double-counted spikes from Kilosort outputs
 
@@ -42,6 +43,9 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         'between_unit_channel_distance' : number of channels over which to search for overlapping spikes
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    peak_channel_index : numpy.ndarray (num_units x 0)
+        Index (into channel_map) of the peak channel of each template, as from
+        KilosortDataset.peak_channel_index; computed from templates if not given
 
     
     Outputs:
@@ -63,7 +67,47 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     """
 
-    peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, channel_map, 
+                                                                       channel_pos, templates, cluster_amplitude, 
+                                                                       sample_rate, params, peak_channel_index)
+
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
+                                                                         spike_clusters,
+                                                                         spike_templates, 
+                                                                         amplitudes, 
+                                                                         pc_features, 
+                                                                         template_features, 
+                                                                         np.where(~keep)[0])
+
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+
+def find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, templates, 
+                               cluster_amplitude, sample_rate, params, peak_channel_index = None):
+
+    """ Find putative double-counted spikes, without removing them
+
+    Both the within-unit and the between-unit overlaps are found before
+    any spike is removed, and combined into one mask, so the per-spike
+    files can be rewritten once (see write_kept_spikes).
+
+    Inputs are the same as for remove_double_counted_spikes.
+
+    Outputs:
+    --------
+    keep : numpy.ndarray (num_spikes x 0)
+        False for the spikes to remove
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        Matrix indicating number of spikes removed for each pair of clusters
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        For each unit: cluster ID, spikes kept, spikes removed within the unit,
+        spikes removed between units, and the unit with the most removed spikes
+
+    """
+
+    if peak_channel_index is None:
+        peak_channel_index = np.argmax(np.max(templates,1) - np.min(templates,1),1)
+    peak_chan_idx = np.squeeze(peak_channel_index)
 
     # to accomdate case where matlab writes out chan map as (1,nchan) instead of (nchan,1)
     channel_map = np.squeeze(channel_map);
@@ -77,90 +121,328 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     
     sorted_unit_list = unit_list[order]
 
+    # position of each unit in sorted_unit_list, which indexes overlap_matrix
+    unit_rank = np.zeros((num_clusters,), dtype = 'int64')
+    unit_rank[sorted_unit_list] = np.arange(num_clusters)
+
     overlap_matrix = np.zeros((num_clusters, num_clusters), dtype = 'int')
     
 
     within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
     between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
 
+    spike_clusters = np.squeeze(spike_clusters)
+
     print('Removing within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    within_to_remove, within_counts = find_within_unit_overlaps(spike_times, spike_clusters, num_clusters,
+                                                                within_unit_overlap_samples)
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+    overlap_matrix[unit_rank, unit_rank] = within_counts
 
-        printProgressBar(idx1+1, len(unit_list))
+    print('Removing between-unit overlapping spikes...')
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+    kept = np.ones((spike_clusters.size,), dtype = bool)
+    kept[within_to_remove] = False
+    kept_indices = np.where(kept)[0]
 
-        to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
+    unit1, unit2 = get_neighbor_pairs(channel_pos[peak_chan_idx], unit_rank, params['between_unit_dist_um'])
 
-        overlap_matrix[idx1, idx1] = len(to_remove)
+    between_to_remove, count1, count2 = find_between_unit_overlaps(spike_times[kept_indices], 
+                                                                   spike_clusters[kept_indices], 
+                                                                   unit_rank, unit1, unit2, 
+                                                                   cluster_amplitude, 
+                                                                   between_unit_overlap_samples, 
+                                                                   params['deletion_mode'])
 
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
+    np.add.at(overlap_matrix, (unit_rank[unit1], unit_rank[unit2]), count1)
+    np.add.at(overlap_matrix, (unit_rank[unit2], unit_rank[unit1]), count2)
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove)
+    # between-unit indices refer to the spikes kept after removing within-unit overlaps
+    kept[kept_indices[between_to_remove]] = False
+    kept_clusters = spike_clusters[kept]
                                                                         
+#   build overlap summary 
+    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
+    overlap_summary[:,0] = sorted_unit_list
+    overlap_summary[:,1] = np.bincount(kept_clusters[kept_clusters < num_clusters], minlength = num_clusters)[sorted_unit_list]
+    overlap_summary[:,2] = np.diag(overlap_matrix)
+    overlap_summary[:,3] = np.sum(overlap_matrix, 1) - np.diag(overlap_matrix)
+    overlap_summary[:,4] = sorted_unit_list[np.argmax(overlap_matrix, 1)]
+#   sort by label
+    new_order = np.argsort(overlap_summary[:,0])
+    overlap_summary = overlap_summary[new_order,:]
 
-    print('Removing between-unit overlapping spikes...')
+    return kept, overlap_matrix, overlap_summary
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+def find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, overlap_window = 5):
 
-        printProgressBar(idx1+1, len(unit_list))
+    """
+    find_within_unit_overlap for every unit at once
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
-        
-        for idx2, unit_id2 in enumerate(sorted_unit_list):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
-            
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
-            
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
-                
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+    The spikes are grouped by cluster once (keeping their original order
+    within each cluster), so consecutive spikes of the same cluster are
+    neighbours in a single array.
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes (the earlier spike of each overlapping pair)
+    counts : numpy.ndarray (num_clusters x 0)
+        Number of spikes removed from each unit
 
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+    """
 
-                spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+    grouped = np.argsort(spike_clusters, kind = 'stable')
+    grouped_clusters = spike_clusters[grouped]
 
+    overlapping = (np.diff(spike_times[grouped]) < overlap_window) & \
+                  (grouped_clusters[1:] == grouped_clusters[:-1]) & (grouped_clusters[1:] < num_clusters)
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove))
-                                                                        
-#   build overlap summary 
-    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-        overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
-        overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
-#   sort by label
-    new_order = np.argsort(overlap_summary[:,0])
-    overlap_summary = overlap_summary[new_order,:]
+    spikes_to_remove = np.sort(grouped[:-1][overlapping])
+    counts = np.bincount(grouped_clusters[:-1][overlapping], minlength = num_clusters)
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+    return spikes_to_remove, counts
+
+
+def get_neighbor_pairs(peak_positions, unit_rank, max_distance, block_size = 1024):
+
+    """
+    Pairs of units whose peak channels are less than max_distance apart
+
+    Inputs
+    ------
+    peak_positions : numpy.ndarray (num_clusters x 2)
+        X and Z coordinates of the peak channel of each unit
+    unit_rank : numpy.ndarray (num_clusters x 0)
+        Order of the units; in each pair, unit1 comes first
+    max_distance : float
+        Distance in um
+
+    Outputs
+    -------
+    unit1, unit2 : numpy.ndarray
+        Unit IDs of each pair, sorted by (unit_rank[unit1], unit_rank[unit2])
+
+    """
+
+    sorted_units = np.argsort(unit_rank)
+    positions = peak_positions[sorted_units]
+
+    unit1 = []
+    unit2 = []
+
+    # distances are calculated for blocks of rows, so memory stays bounded for thousands of units
+    for start in range(0, sorted_units.size, block_size):
+
+        deltaX = positions[np.newaxis,:,0] - positions[start:start+block_size,np.newaxis,0]
+        deltaZ = positions[np.newaxis,:,1] - positions[start:start+block_size,np.newaxis,1]
+
+        dist = np.power(np.power(deltaX,2) + np.power(deltaZ,2), 0.5)
+
+        rows, cols = np.where((dist < max_distance) & \
+                              (np.arange(sorted_units.size)[np.newaxis,:] > np.arange(start, start + dist.shape[0])[:,np.newaxis]))
+
+        unit1.append(sorted_units[rows + start])
+        unit2.append(sorted_units[cols])
+
+    return np.concatenate(unit1).astype('int64'), np.concatenate(unit2).astype('int64')
+
+
+def find_between_unit_overlaps(spike_times, spike_clusters, unit_rank, unit1, unit2, cluster_amplitude,
+                               overlap_window = 5, deletionMode = 'lowAmpCluster'):
+
+    """
+    find_between_unit_overlap for many pairs of units at once
+
+    All spikes are merged into one stream, sorted by time (with ties in
+    the order of unit_rank, then of spike index). Two spikes of units a
+    and b are neighbours in the merged spike train of the pair if no spike
+    of a or b lies between them in the stream, so the neighbouring spikes of
+    every pair are found in one sweep over spikes less than the histogram
+    range of find_between_unit_overlap apart. The deletion rules are then
+    applied to each pair, from these candidates only.
+
+    If the lowAmpCluster rule would also remove spikes further apart than
+    the histogram range (when its peak is in the last interior bin), that
+    pair is passed to find_between_unit_overlap.
+
+    Inputs
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    unit_rank : numpy.ndarray (num_clusters x 0)
+        Order of the units (unit1 of each pair comes first)
+    unit1, unit2 : numpy.ndarray
+        Pairs of units to compare (see get_neighbor_pairs)
+    cluster_amplitude : numpy.ndarray (num_clusters x 0)
+        Amplitude of each unit
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+    deletionMode : 'lowAmpCluster' or 'deleteFirst'
+
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes
+    count1, count2 : numpy.ndarray
+        For each pair, the number of spikes removed from unit1 and unit2
+
+    """
+
+    num_clusters = unit_rank.size
+    num_pairs = unit1.size
+
+    count1 = np.zeros((num_pairs,), dtype = 'int64')
+    count2 = np.zeros((num_pairs,), dtype = 'int64')
+
+    # as in find_between_unit_overlap
+    cent_bin_edges = np.arange(0, (overlap_window+4),2)
+    num_bins = cent_bin_edges.size - 1
+    max_diff = overlap_window - 1 if deletionMode == 'deleteFirst' else cent_bin_edges[-1]
+
+    # pairs are looked up by key
+    pair_keys = unit1 * num_clusters + unit2
+    key_order = np.argsort(pair_keys)
+    sorted_keys = pair_keys[key_order]
+
+    def find_pairs(a, b):
+        # pair index of units (a, b) in either order, or -1 if they are not compared
+        if num_pairs == 0:
+            return np.full(a.shape, -1)
+        first = np.where(unit_rank[a] < unit_rank[b], a, b)
+        keys = first * num_clusters + (a + b - first)
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), num_pairs - 1)
+        return np.where(sorted_keys[pos] == keys, key_order[pos], -1)
+
+    # one time-sorted stream of the spikes of all units
+    in_units = np.where(spike_clusters < num_clusters)[0]
+    stream = in_units[np.lexsort((in_units, unit_rank[spike_clusters[in_units]], spike_times[in_units]))]
+    times = spike_times[stream].astype('int64')
+    units = spike_clusters[stream].astype('int64')
+    num_spikes = stream.size
+
+    # next and previous spike of the same unit in the stream
+    by_unit = np.argsort(units, kind = 'stable')
+    unit_offsets = np.zeros((num_clusters + 1,), dtype = 'int64')
+    unit_offsets[1:] = np.cumsum(np.bincount(units, minlength = num_clusters))
+    same_unit = units[by_unit][1:] == units[by_unit][:-1]
+    next_same = np.full((num_spikes,), num_spikes, dtype = 'int64')
+    prev_same = np.full((num_spikes,), -1, dtype = 'int64')
+    next_same[by_unit[:-1][same_unit]] = by_unit[1:][same_unit]
+    prev_same[by_unit[1:][same_unit]] = by_unit[:-1][same_unit]
+
+    # candidates: neighbouring spikes of two units in their merged spike train
+    early = []
+    late = []
+    # short gaps between spikes of one unit, which are in the histogram of every pair with that unit,
+    # except those pairs with a spike of the other unit in the gap
+    gap_start = []
+    gap_unit = []
+
+    active = np.arange(num_spikes - 1)
+    lag = 1
+
+    while active.size > 0:
+
+        active = active[active + lag < num_spikes]
+        active = active[times[active + lag] - times[active] <= max_diff]
+
+        i = active
+        j = active + lag
+
+        neighbours = (units[i] != units[j]) & (next_same[i] > j) & (prev_same[j] < i)
+        early.append(i[neighbours])
+        late.append(j[neighbours])
+
+        if deletionMode != 'deleteFirst':
+            # first spike of unit j within the gap between spike i and the next spike of its unit
+            in_gap = (next_same[i] > j) & (times[np.minimum(next_same[i], num_spikes - 1)] - times[i] <= max_diff) & \
+                     (next_same[i] < num_spikes) & (prev_same[j] < i) & (units[i] != units[j])
+            gap_start.append(i[in_gap])
+            gap_unit.append(units[j[in_gap]])
+
+        lag += 1
+
+    early = np.concatenate(early) if len(early) > 0 else np.zeros((0,), dtype = 'int64')
+    late = np.concatenate(late) if len(late) > 0 else np.zeros((0,), dtype = 'int64')
+
+    candidate_pairs = find_pairs(units[early], units[late])
+    early, late, candidate_pairs = early[candidate_pairs >= 0], late[candidate_pairs >= 0], candidate_pairs[candidate_pairs >= 0]
+    diffs = times[late] - times[early]
+
+    late_is_unit1 = units[late] == unit1[candidate_pairs]
+
+    if deletionMode == 'deleteFirst':
+
+        # always remove the later spike
+        spikes_to_remove = stream[late]
+        count1 = np.bincount(candidate_pairs[late_is_unit1], minlength = num_pairs)
+        count2 = np.bincount(candidate_pairs[~late_is_unit1], minlength = num_pairs)
+
+        return np.unique(spikes_to_remove), count1, count2
+
+    # histogram of the gaps in the merged spike train of each pair
+    pair_hist = np.bincount(candidate_pairs * num_bins + np.minimum(diffs // 2, num_bins - 1),
+                            minlength = num_pairs * num_bins).reshape((num_pairs, num_bins))
+
+    has_gap = next_same < num_spikes
+    gaps = np.where(has_gap)[0]
+    gaps = gaps[times[next_same[gaps]] - times[gaps] <= max_diff]
+    gap_bins = np.minimum((times[next_same[gaps]] - times[gaps]) // 2, num_bins - 1)
+    unit_hist = np.bincount(units[gaps] * num_bins + gap_bins,
+                            minlength = num_clusters * num_bins).reshape((num_clusters, num_bins))
+    pair_hist += unit_hist[unit1] + unit_hist[unit2]
+
+    gap_start = np.concatenate(gap_start) if len(gap_start) > 0 else np.zeros((0,), dtype = 'int64')
+    gap_unit = np.concatenate(gap_unit) if len(gap_unit) > 0 else np.zeros((0,), dtype = 'int64')
+    gap_pairs = find_pairs(units[gap_start], gap_unit)
+    gap_start, gap_pairs = gap_start[gap_pairs >= 0], gap_pairs[gap_pairs >= 0]
+    np.subtract.at(pair_hist, (gap_pairs, np.minimum((times[next_same[gap_start]] - times[gap_start]) // 2, num_bins - 1)), 1)
+
+    # peak of each histogram, with the rules of find_between_unit_overlap
+    cent_max = np.amax(pair_hist, 1)
+    cent_max_ind = np.argmax(pair_hist, 1)
+    rem_range = 2
+    has_peak = (cent_max_ind < num_bins - 1) & (cent_max > 10*np.amin(pair_hist, 1)) & (cent_max > 20)
+    peak_val = cent_max_ind + 1
+    min_rem = np.maximum(peak_val - rem_range, 1)
+    max_rem = np.minimum(peak_val + rem_range, num_bins + 1)
+
+    # pairs whose removal range is open-ended are done separately
+    open_ended = has_peak & (max_rem == num_bins + 1)
+
+    # digitized gaps (num_bins + 1 for gaps at or above the last edge)
+    cent_dig = np.minimum(diffs // 2 + 1, num_bins + 1)
+    remove = (has_peak & ~open_ended)[candidate_pairs] & (cent_dig >= min_rem[candidate_pairs]) & (cent_dig <= max_rem[candidate_pairs])
+
+    # remove the spike of the unit with the lower amplitude
+    remove_from_unit1 = cluster_amplitude[unit1] <= cluster_amplitude[unit2]
+    from_unit1 = remove_from_unit1[candidate_pairs]
+    spikes_to_remove = [stream[np.where(late_is_unit1 == from_unit1, late, early)[remove]]]
+
+    count1 = np.bincount(candidate_pairs[remove & from_unit1], minlength = num_pairs)
+    count2 = np.bincount(candidate_pairs[remove & ~from_unit1], minlength = num_pairs)
+
+    # the removal range of these pairs includes gaps longer than the histogram range
+    for pair in np.where(open_ended)[0]:
+
+        for_unit1 = np.sort(stream[by_unit[unit_offsets[unit1[pair]]:unit_offsets[unit1[pair]+1]]])
+        for_unit2 = np.sort(stream[by_unit[unit_offsets[unit2[pair]]:unit_offsets[unit2[pair]+1]]])
+
+        to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+                                                           cluster_amplitude[unit1[pair]], cluster_amplitude[unit2[pair]],
+                                                           overlap_window, deletionMode)
+
+        count1[pair] = len(to_remove1)
+        count2[pair] = len(to_remove2)
+        spikes_to_remove.append(for_unit1[to_remove1])
+        spikes_to_remove.append(for_unit2[to_remove2])
+
+    return np.unique(np.concatenate(spikes_to_remove)), count1, count2
 
                 
 def find_within_unit_overlap(spike_train, overlap_window = 5):
@@ -220,7 +502,7 @@ def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_wi
     original_inds = np.concatenate( (np.arange(len(spike_train1)), np.arange(len(spike_train2)) ) )
     cluster_ids = np.concatenate( (np.zeros((len(spike_train1),), dtype = 'int'), np.ones((len(spike_train2),),dtype = 'int')) )
 
-    order = np.argsort(spike_train)
+    order = np.argsort(spike_train, kind = 'stable')
     sorted_train = spike_train[order]
 #   trim off the first member of the array of cluster labels; means the later spike will be picked for any pair
     sorted_cluster_ids = cluster_ids[order][1:]
@@ -337,12 +619,74 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
-def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path):
+def write_kept_spikes(output_dir, keep, arrays, chunk_spikes = 100000):
+
+    """
+    Rewrites per-spike .npy files with only the kept spikes
+
+    Each file is copied in chunks of chunk_spikes spikes to a temporary .npy
+    file in output_dir (through a memory map), so large files such as
+    pc_features.npy are never fully loaded. Once every file is written, the
+    temporary files replace the originals with os.replace; if writing fails,
+    the original files are unchanged.
+
+    Inputs:
+    ------
+    output_dir : String
+        Folder with the phy files
+    keep : numpy.ndarray (num_spikes x 0)
+        Boolean mask of the spikes to keep
+    arrays : dict
+        File name (e.g. 'pc_features.npy') : data with one row per spike. If the
+        data is None, the file in output_dir is read through a memory map
+        (the caller should not hold its own memory map of that file).
+    chunk_spikes : Int
+        Number of spikes copied at once
+
+    """
+
+    temp_files = []
+
+    try:
+        for file_name, data in arrays.items():
+
+            output_file = os.path.join(output_dir, file_name)
+
+            if data is None:
+                data = np.load(output_file, mmap_mode = 'r')
+
+            temp_file = os.path.join(output_dir, os.path.splitext(file_name)[0] + '.tmp.npy')
+            temp_files.append((temp_file, output_file))
+
+            kept_data = np.lib.format.open_memmap(temp_file, mode = 'w+', dtype = data.dtype,
+                                                  shape = (int(np.sum(keep)),) + data.shape[1:])
+
+            print('  ' + file_name)
+            idx = 0
+            for start in range(0, data.shape[0], chunk_spikes):
+                chunk = np.asarray(data[start:start+chunk_spikes])[keep[start:start+chunk_spikes]]
+                kept_data[idx:idx+chunk.shape[0]] = chunk
+                idx += chunk.shape[0]
+
+            kept_data.flush()
+            del kept_data, data
+
+    except BaseException:
+        for temp_file, output_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        raise
+
+    for temp_file, output_file in temp_files:
+        os.replace(temp_file, output_file)
+
+
+def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path, cache = None):
     
     print('Calculating mean waveforms for aligh_spike_times using C_waves.')
 
     # assume cluster table version = 0;
-    getSortResults(output_dir, 0)
+    getSortResults(output_dir, 0, cache = cache)
      
     # build paths to cluster and times tables, which are generated by
     # kilosort_helper module
@@ -385,39 +729,228 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     
     peak_t = 19   #because pre_samples in C_Waves set to 20
     
-    # Loop over units
-    for i in range(nClu):
-        nSpike = snr_array[i,1]
-        if nSpike > 10:
-            # only try to correct if we some spikes to average
-            curr_wave = mean_waveforms[i,:,:]
-            max_site = np.argmax(np.max(curr_wave,1) - np.min(curr_wave,1))
-            max_site_wave = curr_wave[max_site,:]
-            
-            min_v = abs(np.min(max_site_wave))
-            max_v = abs(np.max(max_site_wave))
-            min_t = np.argmin(max_site_wave)
-            max_t = np.argmax(max_site_wave)
-            
-            # align to min or max?
-            if min_v > 30 and max_v > 30:
-                # set spike to to earlier of the two
-                if min_t <= max_t:               
-                   mean_peak_time = min_t
-                else:
-                   mean_peak_time = max_t
-            else:
-                # only one substantial peak, align to larger
-                if min_v >= max_v:
-                   mean_peak_time = min_t
-                else:
-                    mean_peak_time = max_t
-               
-            deltat = peak_t - mean_peak_time
-            # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
-            clu_ind = (spike_clusters == i)
-            spike_times[clu_ind] = spike_times[clu_ind] - deltat
-            
-                
+    # waveform on the site with the largest peak-to-peak amplitude of each unit
+    max_site = np.argmax(np.max(mean_waveforms,2) - np.min(mean_waveforms,2),1)
+    max_site_waves = mean_waveforms[np.arange(nClu), max_site, :]
+
+    deltat, ambiguous = get_alignment_shifts(max_site_waves, peak_t)
+
+    # only try to correct if we some spikes to average
+    shift = np.zeros((max(nClu, np.max(spike_clusters) + 1),), dtype = 'int64')
+    shift[:nClu] = np.where(snr_array[:,1] > 10, deltat, 0)
     
-    return spike_times
\ No newline at end of file
+    return shift_spike_times(spike_times, spike_clusters, shift)
+
+
+def align_spike_times_from_templates(spike_times, spike_clusters, templates, amplitudes, channel_map, channel_pos,
+                                     raw_data, bit_volts, pre_samples = 20, num_spikes = 5000,
+                                     ambiguity_margin = 1.5, site_radius_um = 50, chunk_samples = 150000,
+                                     peak_channel_index = None):
+
+    """
+    align_spike_times with the peak times estimated from the templates
+
+    The mean waveform of each unit on its peak channel is estimated as the
+    unwhitened template scaled by the unit's mean amplitude (in uV), and the
+    alignment rule of align_spike_times is applied to it. Units for which
+    the rule's decision is close to a threshold (see get_alignment_shifts)
+    are ambiguous: for these units only, up to num_spikes snippets are
+    read from the raw data on the sites around the template peak channel,
+    and the rule is applied to their mean, as with C_Waves.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    templates : numpy.ndarray (num_units x num_samples x num_channels)
+        Unwhitened templates (from load_kilosort_data); the spike time is at sample pre_samples
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates for each channel in channel_map
+    raw_data : numpy.ndarray (samples x channels)
+        AP band data (usually memory-mapped); only read for ambiguous units
+    bit_volts : float
+        Scale factor from raw data to uV
+    pre_samples : Int
+        Sample of the spike time in the templates and in the raw snippets
+    num_spikes : Int
+        Max number of spikes read for each ambiguous unit
+    ambiguity_margin : float
+        See get_alignment_shifts
+    site_radius_um : float
+        Sites within this distance of the template peak channel are read for ambiguous units
+    peak_channel_index : numpy.ndarray (num_units x 0)
+        Index (into channel_map) of the peak channel of each template, as from
+        KilosortDataset.peak_channel_index; computed from templates if not given
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Aligned spike times
+    ambiguous_units : numpy.ndarray
+        Units that were aligned from the raw data
+
+    """
+
+    peak_t = pre_samples - 1   # as for C_Waves
+
+    spike_clusters = np.squeeze(spike_clusters)
+    channel_map = np.squeeze(channel_map)
+    num_templates = templates.shape[0]
+    total_units = max(num_templates, np.max(spike_clusters) + 1)
+
+    spike_counts = np.bincount(spike_clusters, minlength = total_units)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_amplitude = np.bincount(spike_clusters, np.squeeze(amplitudes), minlength = total_units) / spike_counts
+
+    if peak_channel_index is None:
+        peak_channel_index = np.argmax(np.max(templates,1) - np.min(templates,1),1)
+    peak_chan_idx = np.asarray(peak_channel_index)
+    peak_waves = templates[np.arange(num_templates), :, peak_chan_idx] * \
+                 (mean_amplitude[:num_templates] * bit_volts)[:, np.newaxis]
+
+    deltat, ambiguous = get_alignment_shifts(peak_waves, peak_t, margin = ambiguity_margin)
+
+    # only units with some spikes are aligned (units without a template are not)
+    aligned = spike_counts[:num_templates] > 10
+    ambiguous_units = np.where(aligned & ambiguous)[0]
+
+    shift = np.zeros((total_units,), dtype = 'int64')
+    shift[:num_templates] = np.where(aligned, deltat, 0)
+
+    if ambiguous_units.size > 0:
+
+        print('Reading raw data for ' + repr(ambiguous_units.size) + ' of ' + repr(int(np.sum(aligned))) + ' units...')
+
+        mean_waves = get_raw_mean_waveforms(raw_data, spike_times, spike_clusters, ambiguous_units,
+                                            channel_map[peak_chan_idx[ambiguous_units]], channel_map, channel_pos,
+                                            bit_volts, pre_samples, num_spikes, site_radius_um, chunk_samples)
+
+        max_site = np.argmax(np.max(mean_waves,2) - np.min(mean_waves,2),1)
+        raw_deltat, raw_ambiguous = get_alignment_shifts(mean_waves[np.arange(ambiguous_units.size), max_site, :], peak_t)
+
+        shift[ambiguous_units] = raw_deltat
+
+    return shift_spike_times(spike_times, spike_clusters, shift), ambiguous_units
+
+
+def get_alignment_shifts(waveforms, peak_t, threshold = 30, margin = None):
+
+    """
+    Shift of each unit that puts the peak of its mean waveform at peak_t
+
+    If both the trough and the peak are larger than threshold (in uV), the
+    earlier of the two is aligned to peak_t; otherwise the larger of the two.
+
+    Inputs:
+    -------
+    waveforms : numpy.ndarray (num_units x num_samples)
+        Mean waveform of each unit (in uV) on its peak site
+    peak_t : Int
+        Sample the peak is aligned to
+    threshold : float
+        Amplitude (uV) above which both the trough and the peak count
+    margin : float
+        If given, a unit is ambiguous if its decision would change with the
+        amplitudes scaled by a factor of up to margin: the smaller extremum
+        is within a factor of margin of threshold, or (with only one
+        extremum above threshold) the two extrema are within a factor of
+        margin of each other.
+
+    Outputs:
+    --------
+    deltat : numpy.ndarray (num_units x 0)
+        Number of samples to subtract from the spike times of each unit
+    ambiguous : numpy.ndarray (num_units x 0)
+        True for ambiguous units (all False if margin is None)
+
+    """
+
+    min_v = np.abs(np.min(waveforms,1))
+    max_v = np.abs(np.max(waveforms,1))
+    min_t = np.argmin(waveforms,1)
+    max_t = np.argmax(waveforms,1)
+
+    # align to min or max?
+    both_peaks = (min_v > threshold) & (max_v > threshold)
+    mean_peak_time = np.where(both_peaks, np.minimum(min_t, max_t), np.where(min_v >= max_v, min_t, max_t))
+
+    deltat = peak_t - mean_peak_time
+
+    if margin is None:
+        ambiguous = np.zeros(deltat.shape, dtype = bool)
+    else:
+        smaller = np.minimum(min_v, max_v)
+        larger = np.maximum(min_v, max_v)
+        ambiguous = ((smaller > threshold / margin) & (smaller <= threshold * margin)) | \
+                    (~both_peaks & (larger < smaller * margin)) | ~np.isfinite(larger)
+        # the decision only matters if the trough and the peak give different shifts
+        ambiguous &= (min_t != max_t)
+
+    return deltat, ambiguous
+
+
+def get_raw_mean_waveforms(raw_data, spike_times, spike_clusters, units, peak_channels, channel_map, channel_pos,
+                           bit_volts, pre_samples = 20, num_spikes = 5000, site_radius_um = 50,
+                           chunk_samples = 150000, samples_per_spike = 82, seed = 0):
+
+    """
+    Mean waveforms of a few units, read from the raw data on the sites around their peak channels
+
+    Outputs:
+    --------
+    mean_waves : numpy.ndarray (units.size x num_sites x samples_per_spike)
+        Mean waveform (uV) on each site within site_radius_um of the peak channel
+        (padding sites are zero)
+
+    """
+
+    rng = np.random.default_rng(seed)
+
+    kept_sites = get_kept_sites(peak_channels, channel_map, channel_pos[:,0], channel_pos[:,1],
+                                site_radius_um, raw_data.shape[1])
+
+    # up to num_spikes random spikes of each unit, away from the ends of the data
+    unit_index = np.full((np.max(spike_clusters) + 1,), -1, dtype = 'int64')
+    unit_index[units] = np.arange(units.size)
+
+    spikes = np.where(unit_index[spike_clusters] >= 0)[0]
+    starts = spike_times[spikes].astype('int64') - pre_samples
+    spikes = spikes[(starts >= 0) & (starts + samples_per_spike <= raw_data.shape[0])]
+    spikes = spikes[rng.permutation(spikes.size)]
+    groups = unit_index[spike_clusters[spikes]]
+    order = np.argsort(groups, kind = 'stable')
+    rank = np.arange(order.size) - np.searchsorted(groups[order], groups[order])
+    spikes = spikes[order[rank < num_spikes]]
+
+    # in file order
+    spikes = spikes[np.argsort(spike_times[spikes], kind = 'stable')]
+    starts = spike_times[spikes].astype('int64') - pre_samples
+    groups = unit_index[spike_clusters[spikes]]
+
+    sums = np.zeros((units.size, samples_per_spike, kept_sites.shape[1]))
+    counts = np.bincount(groups, minlength = units.size)
+
+    for i, j, snippets in iterate_snippets(raw_data, starts, samples_per_spike, chunk_samples, groups, kept_sites):
+        np.add.at(sums, groups[i:j], snippets)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_waves = np.transpose(sums, (0, 2, 1)) / counts[:, np.newaxis, np.newaxis] * bit_volts
+
+    mean_waves[kept_sites < 0] = 0
+
+    return np.nan_to_num(mean_waves)
+
+
+def shift_spike_times(spike_times, spike_clusters, shift):
+
+    """ Subtracts shift[cluster] from the spike times of each cluster (spike times stay >= 0, and keep their dtype) """
+
+    shifted = spike_times.astype('int64') - shift[spike_clusters]
+
+    return np.maximum(shifted, 0).astype(spike_times.dtype)
\ No newline at end of file
@@ -9,11 +9,15 @@ import numpy as np
 import pandas as pd
 from scipy.io import loadmat
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset
 from ...common.utils import getSortResults
 from ...common.utils import getFileVersion
+from ...common.epoch import Epoch
+from ...common.schemas import SnippetStoreParams
+from ...common.artifact_cache import get_artifact_cache
+from ...common.snippet_store import get_snippet_store
 
-from .extract_waveforms import extract_waveforms, writeDataAsNpy
+from .extract_waveforms import extract_waveforms, writeDataAsNpy, load_kept_sites
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
 
@@ -22,6 +26,8 @@ def calculate_mean_waveforms(args):
     print('ecephys spike sorting: mean waveforms module')
     
     start = time.time()
+
+    cache = get_artifact_cache(args)
     
     if args['mean_waveform_params']['use_C_Waves']:
         
@@ -37,7 +43,7 @@ def calculate_mean_waveforms(args):
         #version = 0 if no clu_Table exists, file = clus_Table.npy
         #version = 1 or higher, new clus_Table = clus_Table_version.npy
         
-        getSortResults(output_dir, clu_version)
+        getSortResults(output_dir, clu_version, cache = cache)
         
         # build paths to cluster and times tables, which are generated by
         # kilosort_helper module
@@ -122,14 +128,14 @@ def calculate_mean_waveforms(args):
         # call version of calculate_waveform_metrics that will use these files
         
         # load in kilosort output needed for these calculations
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                    args['ephys_params']['sample_rate'], \
-                    convert_to_seconds = False)
+        dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                    args['ephys_params']['sample_rate'], cache = cache)
+        spike_times, spike_clusters, templates, channel_map, channel_pos = \
+                dataset.spike_times, dataset.spike_clusters, dataset.templates, \
+                dataset.channel_map, dataset.channel_pos
                 
         # read in inverse of whitening matrix
-        w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
+        w_inv = dataset.whitening_mat_inv
         
         # the channel_pos loaded from the phy output omits any sites excluded
         # as noise by the kilosort_helper module, or excluded fow low spike rete
@@ -262,25 +268,76 @@ def calculate_mean_waveforms(args):
         rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
         data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
     
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                    args['ephys_params']['sample_rate'], \
-                    convert_to_seconds = False)
+        dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                    args['ephys_params']['sample_rate'], cache = cache)
+        spike_times, spike_clusters, spike_templates, templates, channel_map, channel_pos = \
+                dataset.spike_times, dataset.spike_clusters, dataset.spike_templates, dataset.templates, \
+                dataset.channel_map, dataset.channel_pos
     
+        # the python path does not version its output
+        clu_version = 0
+        wm_fullpath = args['waveform_metrics']['waveform_metrics_file']
+        dest, wavefile = os.path.split(args['mean_waveform_params']['mean_waveforms_file'])
+
+        if args['mean_waveform_params']['calc_half_run']:
+            # For UnitMatch: the two halves of the recording are extra epochs,
+            # accumulated in the same pass as the complete session (which stays last)
+            endsecs = float(np.max(spike_times))/args['ephys_params']['sample_rate']
+            epochs = [Epoch('first_half', 0, endsecs/2.0),
+                      Epoch('second_half', endsecs/2.0, np.inf),
+                      Epoch('complete_session', 0, np.inf)]
+        else:
+            epochs = None
+
+        if args['mean_waveform_params']['use_snippet_store']:
+            # snippets in the store have the length of the mean waveforms
+            store_params = SnippetStoreParams().load(args.get('snippet_store_params') or {})
+            store_params['samples_per_spike'] = args['mean_waveform_params']['samples_per_spike']
+            store_params['pre_samples'] = args['mean_waveform_params']['pre_samples']
+            snippet_store = get_snippet_store(args['directories']['kilosort_output_directory'],
+                                              data, args['ephys_params']['ap_band_file'],
+                                              spike_times, spike_clusters, templates, channel_map, channel_pos,
+                                              store_params, spike_templates = spike_templates,
+                                              peak_channel_index = dataset.peak_channel_index)
+        else:
+            snippet_store = None
+
         print("Calculating mean waveforms...")
     
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
+        waveforms, spike_counts, coords, labels, metrics, kept_sites = extract_waveforms(data, spike_times, \
                     spike_clusters,
                     templates,
                     channel_map,
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'],
+                    epochs = epochs,
+                    channel_pos = channel_pos,
+                    chunk_samples = args['mean_waveform_params']['chunk_samples'],
+                    num_workers = args['mean_waveform_params']['num_workers'],
+                    raw_data_file = args['ephys_params']['ap_band_file'],
+                    waveform_dtype = args['mean_waveform_params']['waveform_dtype'],
+                    site_radius_um = args['mean_waveform_params']['site_radius_um'],
+                    snippet_store = snippet_store,
+                    spike_templates = spike_templates,
+                    peak_channel_index = dataset.peak_channel_index)
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'], index=False)
+        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'], kept_sites)
+
+        if args['mean_waveform_params']['calc_half_run']:
+            writeDataAsNpy(waveforms, os.path.join(dest, 'first_half_mean_waveforms.npy'), kept_sites, epoch_idx = 0)
+            writeDataAsNpy(waveforms, os.path.join(dest, 'second_half_mean_waveforms.npy'), kept_sites, epoch_idx = 1)
+
+            create_UnitMatch_input(np.bincount(spike_clusters), 
+                                   'first_half_mean_waveforms.npy', 
+                                   'second_half_mean_waveforms.npy', 
+                                   args['ephys_params']['num_sync_channels'], dest,
+                                   num_channels = args['ephys_params']['num_channels'])
+
+            metrics = metrics[metrics['epoch_name'] == 'complete_session']
+
+        metrics.to_csv(wm_fullpath, index=False)
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
@@ -305,7 +362,7 @@ def calculate_mean_waveforms(args):
     return {"execution_time" : execution_time} # output manifest
 
 
-def create_UnitMatch_input(clu_counts, fh_name, sh_name, num_sync, dest ):
+def create_UnitMatch_input(clu_counts, fh_name, sh_name, num_sync, dest, num_channels = None ):
     # parse mean_waveform files from the first and second half of run for 
     # input to UnitMatch
     # clu_counts = array of counts for each spike label, 0 to maximum spike label
@@ -313,23 +370,35 @@ def create_UnitMatch_input(clu_counts, fh_name, sh_name, num_sync, dest ):
     # sh_name = name for mean_waveforms.npy file for the 2nd half
     # dest = phy directory of output, inclluding the means_waveforms files
     # and the RawWaveforms directory
+    # num_channels = number of channels in the binary, needed if the
+    # mean_waveforms files are compact (saved with _sites.npy files)
     
     # checkfor directory 'RawWaveforms'
     wave_dir = os.path.join(dest,'RawWaveforms')
     if not os.path.exists(wave_dir):
         os.makedirs(wave_dir)
         
-    fh_waves = np.load(os.path.join(dest,fh_name))
-    sh_waves = np.load(os.path.join(dest,sh_name))
+    fh_waves = np.load(os.path.join(dest,fh_name), mmap_mode='r')
+    sh_waves = np.load(os.path.join(dest,sh_name), mmap_mode='r')
+    fh_sites = load_kept_sites(os.path.join(dest,fh_name), fh_waves)
+    sh_sites = load_kept_sites(os.path.join(dest,sh_name), sh_waves)
     [n_clu, n_ch, nt] = fh_waves.shape
+    if fh_sites is not None:
+        n_ch = num_channels
     n_save = n_ch - num_sync  # remove sync channel/status word end of binary
         
         
     for i in range(n_clu):
         if (clu_counts[i] > 0):
             new_wave = np.zeros((nt,n_save,2))
-            new_wave[:,:,0] = np.transpose(fh_waves[i,0:n_save,:])
-            new_wave[:,:,1] = np.transpose(sh_waves[i,0:n_save,:])
+            if fh_sites is None:
+                new_wave[:,:,0] = np.transpose(fh_waves[i,0:n_save,:])
+                new_wave[:,:,1] = np.transpose(sh_waves[i,0:n_save,:])
+            else:
+                # compact waveforms: sites that were not kept stay zero
+                for half, (waves, sites) in enumerate([(fh_waves, fh_sites), (sh_waves, sh_sites)]):
+                    kept = (sites[i] >= 0) & (sites[i] < n_save)
+                    new_wave[:,sites[i][kept],half] = np.transpose(waves[i][kept,:])
             np.save(os.path.join(wave_dir, f'Unit{i}_RawSpikes.npy'),new_wave)          
             
     
@@ -1,7 +1,8 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
-from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
+from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile, SnippetStoreParams, \
+    ArtifactCacheParams
 
 class MeanWaveformParams(DefaultSchema):
     samples_per_spike = Int(required=True, default=82, help='Number of samples to extract for each spike')
@@ -17,13 +18,20 @@ class MeanWaveformParams(DefaultSchema):
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     snr_radius_um = Int(require=False, default=8, help='disk radius (um) about pk-chan for snr calculation in C_waves')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
+    chunk_samples = Int(required=False, default=150000, help='Number of samples read from the AP band file at once when calculating mean waveforms in python')
+    num_workers = Int(required=False, default=1, help='Number of worker processes for calculating mean waveforms in python; each reads a time shard of the AP band file')
+    waveform_dtype = String(required=False, default='float64', help='Data type of the mean waveforms calculated in python (float64 or float32)')
+    site_radius_um = Float(required=False, default=0, help='If > 0, mean waveforms calculated in python keep only the sites within this distance (um) of each peak channel; the kept sites are saved in <mean_waveforms_file>_sites.npy')
     calc_half_run = Bool(require=False, default=False, help='calculate mean waveforms for 1st + 2nd half of recording')
+    use_snippet_store = Bool(required=False, default=False, help='Calculate mean waveforms in python from the snippet store (built if missing or stale) instead of the AP band file')
     
 
 class InputParameters(ArgSchema):
     
     waveform_metrics = Nested(WaveformMetricsFile)
     mean_waveform_params = Nested(MeanWaveformParams)
+    snippet_store_params = Nested(SnippetStoreParams)
+    artifact_cache_params = Nested(ArtifactCacheParams)
     cluster_metrics = Nested(ClusterMetricsFile)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
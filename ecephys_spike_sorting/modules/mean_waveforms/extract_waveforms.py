@@ -6,9 +6,12 @@ import xarray as xr
 import pandas as pd
 
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_waveform_metrics_for_units
 from ...common.epoch import Epoch
+from ...common.spike_index import SpikeIndex
+from ...common.snippet_store import get_kept_sites, get_unit_peak_channels, iterate_snippets
 from ...common.utils import printProgressBar
 
 def extract_waveforms(raw_data, 
@@ -20,11 +23,35 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      channel_pos=None,
+                      chunk_samples=150000,
+                      num_workers=1,
+                      raw_data_file=None,
+                      waveform_dtype='float64',
+                      site_radius_um=0,
+                      snippet_store=None,
+                      spike_templates=None,
+                      peak_channel_index=None):
     
     """
     Calculate mean waveforms for sorted units.
 
+    The spikes of each unit are chosen up front, and their snippets are read
+    in order of their position in the file, in chunks of chunk_samples. The
+    mean and standard deviation of each unit are accumulated chunk by chunk
+    (see accumulate_mean_waveforms), so the raw data is read once, front to
+    back, and memory does not depend on spikes_per_epoch. With num_workers > 1,
+    the recording is split into time shards that are read in parallel, each
+    by a worker process that memory-maps raw_data_file.
+
+    With site_radius_um > 0, only the channels within that distance of each
+    unit's peak channel are accumulated and returned, with kept_sites giving
+    the channel of each row.
+
+    With a snippet_store, spikes are chosen among the snippets in the store,
+    which are read instead of raw_data; the sites of the store are kept.
+
     Inputs:
     -------
     raw_data : continuous data as numpy array (samples x channels)
@@ -34,6 +61,18 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    channel_pos : channel positions (in um) for channel_map (optional)
+        if not given, channels are assumed to be in one column, site_spacing apart
+    chunk_samples : number of samples read from raw_data at once
+    num_workers : number of worker processes
+    raw_data_file : path of the binary file of raw_data (int16), required for num_workers > 1
+    waveform_dtype : data type of mean_waveforms ('float64' or 'float32')
+    site_radius_um : if > 0, keep only channels within this distance (um) of the peak channel
+    snippet_store : SnippetStore built from the same spikes (optional)
+    spike_templates : template ID of each spike (optional); if given, the peak channel of
+        each unit is that of its majority template, which is needed after curation
+    peak_channel_index : peak channel index of each template (optional), as from
+        KilosortDataset.peak_channel_index; computed from templates if not given
 
     Outputs:
     -------
@@ -41,7 +80,7 @@ def extract_waveforms(raw_data,
      - 1 : clusterID
      - 2 : epochs
      - 3 : mean (0) or std (1)
-     - 4 : channels
+     - 4 : channels (or kept sites)
      - 5 : samples
     spike_count : numpy array with dims :
      - 1 : clusterID
@@ -49,6 +88,8 @@ def extract_waveforms(raw_data,
     dimCoords : list of coordinates for each dimension
     dimLabels : list of labels for each dimension
     metrics : DataFrame with waveform metrics
+    kept_sites : numpy array (clusterID x kept sites) with the channel of each
+        row of mean_waveforms (-1 for padding), or None if all channels are kept
 
     Parameters:
     ----------
@@ -80,82 +121,472 @@ def extract_waveforms(raw_data,
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
 
+    peak_channels = get_unit_peak_channels(spike_clusters, spike_templates, templates, channel_map, total_units,
+                                           peak_channel_index)
+
+    if channel_pos is None:
+        site_x = np.zeros((len(channel_map),))
+        site_y = np.arange(len(channel_map)) * site_spacing * 1e6
+    else:
+        site_x = channel_pos[:,0]
+        site_y = channel_pos[:,1]
+
+    if snippet_store is None and num_workers > 1 and raw_data_file is None:
+        raise ValueError('raw_data_file is required to read waveforms with num_workers > 1')
+
+    if snippet_store is not None:
+        if (snippet_store.samples_per_spike, snippet_store.pre_samples) != (samples_per_spike, pre_samples) or \
+           snippet_store.num_units != total_units:
+            raise ValueError('Snippet store in ' + snippet_store.store_directory + ' does not match the mean waveform parameters')
+        kept_sites = snippet_store.kept_sites
+        group_sites = None
+        num_rows = kept_sites.shape[1]
+    elif site_radius_um > 0:
+        kept_sites = get_kept_sites(peak_channels, channel_map, site_x, site_y, site_radius_um, raw_data.shape[1])
+        group_sites = np.repeat(kept_sites, total_epochs, axis=0)
+        num_rows = kept_sites.shape[1]
+    else:
+        kept_sites = None
+        group_sites = None
+        num_rows = raw_data.shape[1]
+
+    if kept_sites is not None:
+        # rows of the metrics geometry (channels in channel_map) of each kept site
+        map_index = np.full((raw_data.shape[1],), -1, dtype='int64')
+        map_index[np.ravel(channel_map)] = np.arange(len(site_x))
+        kept_map_sites = np.where(kept_sites >= 0, map_index[np.maximum(kept_sites, 0)], -1)
+
     # allocate array for waveforms, datatype = default, double
     mean_waveforms = np.zeros(
-        (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
-    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
-
-    peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
+        (total_units, total_epochs, 2, num_rows, samples_per_spike), dtype=waveform_dtype)
+
+    if snippet_store is not None:
+        print("Selecting spikes from the snippet store")
+        snippet_indices, snippet_groups, spike_count = select_store_snippets(snippet_store, epochs, spikes_per_epoch,
+                                                                             sample_rate)
+        print("Reading waveforms")
+        count, mean, M2 = accumulate_store_waveforms(snippet_store, snippet_indices, snippet_groups,
+                                                     total_units * total_epochs, bit_volts, chunk_samples)
+    else:
+        print("Selecting spikes")
+        snippet_starts, snippet_groups, spike_count = select_snippets(spike_times, spike_clusters, total_units, epochs,
+                                                                      spikes_per_epoch, pre_samples, samples_per_spike,
+                                                                      raw_data.shape[0], sample_rate)
+        print("Reading waveforms")
+        if num_workers > 1:
+            count, mean, M2 = accumulate_mean_waveforms_sharded(raw_data_file, raw_data.shape, raw_data.dtype,
+                                                                snippet_starts, snippet_groups, total_units * total_epochs,
+                                                                samples_per_spike, bit_volts, chunk_samples, num_workers,
+                                                                group_sites = group_sites)
+        else:
+            count, mean, M2 = accumulate_mean_waveforms(raw_data, snippet_starts, snippet_groups, total_units * total_epochs,
+                                                        samples_per_spike, bit_volts, chunk_samples,
+                                                        group_sites = group_sites)
+
+    count = count.reshape((total_units, total_epochs))
+    mean = mean.reshape((total_units, total_epochs) + mean.shape[1:])
+    M2 = M2.reshape(mean.shape)
+
+    epoch_metrics = []
 
     for epoch_idx, epoch in enumerate(epochs):
 
-        print("Epoch: " + epoch.name)
+        units = np.where(spike_count[:, epoch_idx] > 0)[0]
+
+        if units.size == 0:
+            continue
+
+        with warnings.catch_warnings():
+
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+
+            n = count[units, epoch_idx]
+            unit_mean = np.where((n > 0)[:, np.newaxis, np.newaxis], mean[units, epoch_idx], np.nan)    # no spike could be read
+            unit_std = np.sqrt(M2[units, epoch_idx] / n[:, np.newaxis, np.newaxis])
+
+            if kept_sites is None:
+                peak_rows = peak_channels[units]
+            else:
+                peak_rows = np.argmax(kept_sites[units] == peak_channels[units][:, np.newaxis], 1)
+                unit_mean[kept_sites[units] < 0] = 0
+                unit_std[kept_sites[units] < 0] = 0
+
+            # SNR on the peak channel, from the residuals of all spikes (see calculate_snr)
+            peak = unit_mean[np.arange(units.size), peak_rows]
+            noise = np.sqrt(np.sum(M2[units, epoch_idx, peak_rows], 1) / (n * samples_per_spike))
+            snr = (np.max(peak, 1) - np.min(peak, 1)) / (2 * noise)
+
+        if kept_sites is None:
+            epoch_waveforms = unit_mean[:, channel_map, :]
+            local_peaks = np.argmin(np.abs(np.ravel(channel_map)[np.newaxis, :] - peak_channels[units][:, np.newaxis]), 1)
+            epoch_sites = None
+        else:
+            epoch_waveforms = unit_mean
+            local_peaks = peak_rows
+            epoch_sites = kept_map_sites[units]
+
+        epoch_metrics.append(calculate_waveform_metrics_for_units(epoch_waveforms,
+                                                                  snr,
+                                                                  cluster_ids[units],
+                                                                  peak_channels[units],
+                                                                  local_peaks,
+                                                                  sample_rate,
+                                                                  upsampling_factor,
+                                                                  spread_threshold,
+                                                                  site_range,
+                                                                  site_x,
+                                                                  site_y,
+                                                                  epoch.name,
+                                                                  kept_sites = epoch_sites))
+
+        # remove offset
+        mean_waveforms[units, epoch_idx, 0, :, :] = unit_mean - unit_mean[:, :, :1]
+        mean_waveforms[units, epoch_idx, 1, :, :] = unit_std
+
+    if len(epoch_metrics) > 0:
+        metrics = pd.concat(epoch_metrics)
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
 
-        spike_times_in_epoch = spike_times[in_epoch]
+    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics, kept_sites
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
 
-            printProgressBar(cluster_idx+1, total_units)
+def select_snippets(spike_times, spike_clusters, total_units, epochs, spikes_per_epoch,
+                    pre_samples, samples_per_spike, num_samples, sample_rate):
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+    """
+    Choose up to spikes_per_epoch random spikes for each unit in each epoch
 
-            if np.sum(in_cluster) > 0:
+    The spikes of a unit are shuffled with np.random.shuffle and the first
+    spikes_per_epoch are kept, in the same order as the original per-unit loop,
+    so the selection for a given numpy random state is unchanged.
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+    Outputs:
+    --------
+    snippet_starts : numpy.ndarray
+        First sample of each selected snippet that lies inside the data
+    snippet_groups : numpy.ndarray
+        cluster_id * len(epochs) + epoch index for each snippet
+    spike_count : numpy.ndarray (total_units x len(epochs) + 1)
+        Number of spikes selected for each unit and epoch (including
+        spikes too close to the start or end of the data to be read)
+
+    """
+
+    total_epochs = len(epochs)
+
+    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+    snippet_starts = []
+    snippet_groups = []
+
+    # spikes in time order, so each epoch is a contiguous slice
+    spike_index = SpikeIndex(spike_times, spike_clusters, total_units, sample_rate)
+    spike_times = spike_index.spike_times
+
+    for epoch_idx, epoch in enumerate(epochs):
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+        start, stop = spike_index.epoch_range(epoch, include_start = False, include_end = False)
+        spike_order, unit_offsets = spike_index.grouped(start, stop)
+
+        spike_times_in_epoch = spike_times[start:stop]
+
+        for cluster_id in range(total_units):
+
+            in_cluster = spike_order[unit_offsets[cluster_id]:unit_offsets[cluster_id+1]]
+
+            if in_cluster.size > 0:
+
+                times_for_cluster = spike_times_in_epoch[in_cluster]
 
                 np.random.shuffle(times_for_cluster)
 
                 total_waveforms = np.min(
                     [times_for_cluster.size, spikes_per_epoch])
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
-
-                spike_count[cluster_idx, epoch_idx] = total_waveforms
+                starts = (times_for_cluster[:total_waveforms].astype('float64') - pre_samples).astype('int64')
+
+                # in case spike was at start or end of dataset
+                starts = starts[(starts >= 0) & (starts + samples_per_spike <= num_samples)]
+
+                snippet_starts.append(starts)
+                snippet_groups.append(np.full(starts.shape, cluster_id * total_epochs + epoch_idx))
+
+                spike_count[cluster_id, epoch_idx] = total_waveforms
+
+    if len(snippet_starts) == 0:
+        return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64'), spike_count
+
+    return np.concatenate(snippet_starts), np.concatenate(snippet_groups), spike_count
+
+
+def select_store_snippets(snippet_store, epochs, spikes_per_epoch, sample_rate):
+
+    """
+    Choose up to spikes_per_epoch random snippets of each unit in each epoch from a snippet store
+
+    As in select_snippets, the snippets of a unit within an epoch are shuffled
+    with np.random.shuffle and the first spikes_per_epoch are kept.
+
+    Outputs:
+    --------
+    snippet_indices : numpy.ndarray
+        Index (into the store) of each selected snippet
+    snippet_groups : numpy.ndarray
+        cluster_id * len(epochs) + epoch index for each snippet
+    spike_count : numpy.ndarray (total_units x len(epochs) + 1)
+        Number of snippets selected for each unit and epoch
+
+    """
+
+    total_units = snippet_store.num_units
+    total_epochs = len(epochs)
+
+    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+    snippet_indices = []
+    snippet_groups = []
+
+    unit_offsets = snippet_store.unit_offsets
+    snippet_times = np.asarray(snippet_store.snippet_times)
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        for cluster_id in range(total_units):
+
+            times = snippet_times[unit_offsets[cluster_id]:unit_offsets[cluster_id+1]]
+
+            # times are sorted within each unit; epoch bounds are exclusive, as in select_snippets
+            start = np.searchsorted(times / sample_rate, epoch.start_time, side='right')
+            stop = np.searchsorted(times / sample_rate, epoch.end_time, side='left')
+
+            if stop > start:
+
+                indices = np.arange(start, stop) + unit_offsets[cluster_id]
+
+                np.random.shuffle(indices)
+
+                total_waveforms = np.min([indices.size, spikes_per_epoch])
+
+                snippet_indices.append(indices[:total_waveforms])
+                snippet_groups.append(np.full((total_waveforms,), cluster_id * total_epochs + epoch_idx))
+
+                spike_count[cluster_id, epoch_idx] = total_waveforms
+
+    if len(snippet_indices) == 0:
+        return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64'), spike_count
+
+    return np.concatenate(snippet_indices), np.concatenate(snippet_groups), spike_count
 
-    dimCoords, dimLabels = generateDimLabels(
-        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
 
-    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+def accumulate_store_waveforms(snippet_store, snippet_indices, snippet_groups, num_groups, bit_volts,
+                               chunk_samples = 150000):
+
+    """
+    accumulate_mean_waveforms for snippets read from a snippet store
+
+    The snippets are read in store order, in blocks of about the size of one
+    chunk of raw data.
+
+    Outputs:
+    --------
+    count, mean, M2 : as for accumulate_mean_waveforms, with the sites of the store
+
+    """
+
+    num_sites = snippet_store.kept_sites.shape[1]
+    samples_per_spike = snippet_store.samples_per_spike
+
+    count = np.zeros((num_groups,), dtype='int64')
+    mean = np.zeros((num_groups, num_sites, samples_per_spike))
+    M2 = np.zeros((num_groups, num_sites, samples_per_spike))
+
+    order = np.argsort(snippet_indices, kind='stable')
+    snippet_indices = snippet_indices[order]
+    snippet_groups = snippet_groups[order]
+
+    max_snippets = max(1, chunk_samples // (4 * samples_per_spike))
+
+    for i in range(0, snippet_indices.size, max_snippets):
+
+        printProgressBar(i + 1, snippet_indices.size)
+
+        j = min(i + max_snippets, snippet_indices.size)
+        snippets = snippet_store.snippets[snippet_indices[i:j]] * bit_volts
+
+        update_waveform_accumulators(count, mean, M2, snippet_groups[i:j], snippets)
+
+    printProgressBar(snippet_indices.size, snippet_indices.size)
+
+    return count, mean, M2
+
+
+def accumulate_mean_waveforms(raw_data, snippet_starts, snippet_groups, num_groups, samples_per_spike,
+                              bit_volts, chunk_samples = 150000, show_progress = True, group_sites = None):
+
+    """
+    Mean and sum of squared deviations of the snippets in each group, in one pass over raw_data
+
+    Snippets are sorted by their position in the file and read in chunks of
+    up to chunk_samples samples; chunks only skip ahead over data without
+    snippets. Each chunk updates the running statistics of its groups
+    (see update_waveform_accumulators).
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels), usually memory-mapped
+    snippet_starts : numpy.ndarray
+        First sample of each snippet
+    snippet_groups : numpy.ndarray
+        Group (0 to num_groups - 1) of each snippet
+    num_groups : Int
+    samples_per_spike : Int
+    bit_volts : float
+        Scale factor from raw_data to uV
+    group_sites : numpy.ndarray (num_groups x num_sites)
+        If given, only these channels are accumulated for each group (-1 for padding)
+
+    Outputs:
+    --------
+    count : numpy.ndarray (num_groups x 0)
+        Number of snippets in each group
+    mean : numpy.ndarray (num_groups x channels (or num_sites) x samples_per_spike)
+    M2 : numpy.ndarray (num_groups x channels (or num_sites) x samples_per_spike)
+        Sum of squared deviations from the mean (variance = M2 / count)
+
+    """
+
+    num_channels = raw_data.shape[1] if group_sites is None else group_sites.shape[1]
+
+    count = np.zeros((num_groups,), dtype='int64')
+    mean = np.zeros((num_groups, num_channels, samples_per_spike))
+    M2 = np.zeros((num_groups, num_channels, samples_per_spike))
+
+    order = np.argsort(snippet_starts, kind='stable')
+    snippet_starts = snippet_starts[order]
+    snippet_groups = snippet_groups[order]
+
+    for i, j, snippets in iterate_snippets(raw_data, snippet_starts, samples_per_spike, chunk_samples,
+                                           snippet_groups, group_sites):
+
+        if show_progress:
+            printProgressBar(i + 1, snippet_starts.size)
+
+        snippets = np.transpose(snippets, (0, 2, 1)) * bit_volts
+
+        update_waveform_accumulators(count, mean, M2, snippet_groups[i:j], snippets)
+
+    if show_progress:
+        printProgressBar(snippet_starts.size, snippet_starts.size)
+
+    return count, mean, M2
+
+
+def accumulate_mean_waveforms_sharded(raw_data_file, shape, dtype, snippet_starts, snippet_groups, num_groups,
+                                      samples_per_spike, bit_volts, chunk_samples, num_workers, num_shards = None,
+                                      group_sites = None):
+
+    """
+    accumulate_mean_waveforms with the recording split into time shards
+
+    The snippets, in file order, are split into num_shards contiguous shards
+    (num_workers by default). Each shard is read by a worker process that
+    memory-maps raw_data_file and returns the (count, mean, M2) of the groups
+    in that shard; these are merged in shard order with merge_waveform_accumulators.
+
+    Inputs:
+    -------
+    raw_data_file : String
+        Path of the binary file
+    shape, dtype :
+        Shape (samples x channels) and data type of the binary file
+    num_workers : Int
+        Number of worker processes
+
+    The other inputs and the outputs are the same as for accumulate_mean_waveforms.
+
+    """
+
+    num_channels = shape[1] if group_sites is None else group_sites.shape[1]
+
+    if num_shards is None:
+        num_shards = num_workers
+
+    count = np.zeros((num_groups,), dtype='int64')
+    mean = np.zeros((num_groups, num_channels, samples_per_spike))
+    M2 = np.zeros((num_groups, num_channels, samples_per_spike))
+
+    order = np.argsort(snippet_starts, kind='stable')
+    shards = [shard for shard in np.array_split(order, num_shards) if shard.size > 0]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        futures = [executor.submit(_accumulate_shard, raw_data_file, shape, np.dtype(dtype).str,
+                                   snippet_starts[shard], snippet_groups[shard],
+                                   samples_per_spike, bit_volts, chunk_samples, group_sites) for shard in shards]
+
+        for idx, future in enumerate(futures):
+            groups, shard_count, shard_mean, shard_M2 = future.result()
+            merge_waveform_accumulators(count, mean, M2, groups, shard_count, shard_mean, shard_M2)
+            printProgressBar(idx + 1, len(futures))
+
+    return count, mean, M2
+
+
+def _accumulate_shard(raw_data_file, shape, dtype, snippet_starts, snippet_groups, samples_per_spike,
+                      bit_volts, chunk_samples, group_sites = None):
+
+    # runs in a worker process; only the groups present in the shard are returned
+    raw_data = np.memmap(raw_data_file, dtype=dtype, mode='r', shape=tuple(shape))
+
+    groups, shard_groups = np.unique(snippet_groups, return_inverse=True)
+
+    if group_sites is not None:
+        group_sites = group_sites[groups]
+
+    count, mean, M2 = accumulate_mean_waveforms(raw_data, snippet_starts, shard_groups, groups.size,
+                                                samples_per_spike, bit_volts, chunk_samples, show_progress = False,
+                                                group_sites = group_sites)
+
+    return groups, count, mean, M2
+
+
+def update_waveform_accumulators(count, mean, M2, groups, snippets):
+
+    """
+    Adds a batch of snippets to the running (count, mean, M2) of their groups, in place
+
+    The batch statistics of each group are merged with the running ones
+    with the pairwise update of Chan et al. (Welford's update for a batch).
+
+    """
+
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    snippets = snippets[order]
+
+    batch_groups, first, batch_count = np.unique(groups, return_index=True, return_counts=True)
+    batch_mean = np.add.reduceat(snippets, first, axis=0) / batch_count[:, np.newaxis, np.newaxis]
+    batch_M2 = np.add.reduceat(np.square(snippets - np.repeat(batch_mean, batch_count, axis=0)), first, axis=0)
+
+    merge_waveform_accumulators(count, mean, M2, batch_groups, batch_count, batch_mean, batch_M2)
+
+
+def merge_waveform_accumulators(count, mean, M2, groups, other_count, other_mean, other_M2):
+
+    """
+    Merges (other_count, other_mean, other_M2) into rows groups of (count, mean, M2), in place
+    """
+
+    n_a = count[groups].astype('float64')[:, np.newaxis, np.newaxis]
+    n_b = other_count.astype('float64')[:, np.newaxis, np.newaxis]
+    n = n_a + n_b
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = other_mean - mean[groups]
+        mean[groups] = np.where(n > 0, mean[groups] + delta * (n_b / n), mean[groups])
+        M2[groups] = np.where(n > 0, M2[groups] + other_M2 + np.square(delta) * (n_a * n_b / n), M2[groups])
+
+    count[groups] += other_count
 
 
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
@@ -202,9 +633,45 @@ def writeDataAsXarray(mean_waveforms, spike_count, dimCoords, dimLabels, output_
     ds.to_netcdf(output_file)
 
 
-def writeDataAsNpy(waveforms, output_file):
-    """ Saves mean waveforms as xarray """
+def writeDataAsNpy(waveforms, output_file, kept_sites=None, epoch_idx=-1):
+    """ Saves mean waveforms as npy; kept sites (if any) are saved next to them (see get_sites_file) """
 
-    mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
+    mean_waveforms = waveforms[:, epoch_idx, 0, :, :]  # extract overall mean
 
     np.save(output_file, mean_waveforms)
+
+    sites_file = get_sites_file(output_file)
+    if kept_sites is not None:
+        np.save(sites_file, kept_sites)
+    elif os.path.exists(sites_file):
+        os.remove(sites_file)   # left from an earlier run with compact waveforms
+
+
+def get_sites_file(mean_waveforms_file):
+    """ Path of the kept sites saved with compact mean waveforms """
+
+    return os.path.splitext(mean_waveforms_file)[0] + '_sites.npy'
+
+
+def load_kept_sites(mean_waveforms_file, mean_waveforms):
+
+    """
+    Kept sites of compact mean waveforms, or None if the waveforms include all channels
+
+    The sites file is only used if it matches the waveforms (one row per unit,
+    one column per row of waveforms) and is not older than the waveforms file.
+
+    """
+
+    sites_file = get_sites_file(mean_waveforms_file)
+
+    if not os.path.exists(sites_file) or \
+       os.path.getmtime(sites_file) < os.path.getmtime(mean_waveforms_file):
+        return None
+
+    kept_sites = np.load(sites_file)
+
+    if kept_sites.shape != mean_waveforms.shape[:2]:
+        return None
+
+    return kept_sites
@@ -7,9 +7,9 @@ import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_for_units
+from .extract_waveforms import load_kept_sites
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
 
 def metrics_from_file(mean_waveform_fullpath,
                       snr_fullpath,
@@ -30,6 +30,9 @@ def metrics_from_file(mean_waveform_fullpath,
     """
     Load C_waves output and call waveform_metrics for each cluster
     Does not support epochs, since waveforms are already averaged
+
+    Compact mean waveforms (only the sites around each peak channel, with
+    the kept sites saved next to them, see writeDataAsNpy) are read as they are.
     
     Inputs:
     -------
@@ -87,6 +90,7 @@ def metrics_from_file(mean_waveform_fullpath,
     total_units = len(cluster_ids)
     
     mean_waveforms = np.load(mean_waveform_fullpath)
+    kept_sites = load_kept_sites(mean_waveform_fullpath, mean_waveforms)
     snr_array = np.load(snr_fullpath)
     clus_table = np.load(clus_fullpath)
     peak_channels = clus_table[:,1]
@@ -96,35 +100,38 @@ def metrics_from_file(mean_waveform_fullpath,
     # For any unit that has spikes and a calculable mean waveform, update the
     # estimated peak channel with the measured one.
     
-    if mean_waveforms.shape[1] > nAP:
+    if mean_waveforms.shape[1] > nAP and kept_sites is None:
         # remove digital channel
         mean_waveforms = mean_waveforms[:,0:nAP,:]
     vpp_allchan = np.amax(mean_waveforms,2) - np.amin(mean_waveforms,2)
     vpp_val = np.amax(vpp_allchan,1)
     meas_pkchan = np.argmax(vpp_allchan,1)  
     vpp_nonzero = (vpp_val > 0)  
-    peak_channels[vpp_nonzero] = meas_pkchan[vpp_nonzero]
+    if kept_sites is None:
+        peak_channels[vpp_nonzero] = meas_pkchan[vpp_nonzero]
+        peak_rows = peak_channels
+    else:
+        peak_channels[vpp_nonzero] = kept_sites[vpp_nonzero, meas_pkchan[vpp_nonzero]]
+        peak_rows = np.where(vpp_nonzero, meas_pkchan, np.argmax(kept_sites == peak_channels[:, np.newaxis], 1))
 
     
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
+    # calculate metrics for all clusters with at least one spike at once
+    units = np.where(snr_array[:total_units,1] > 0)[0]
+
+    if units.size > 0:
+        # unless the waveforms are compact, the peak channel is also the row of the peak
+        metrics = calculate_waveform_metrics_for_units(mean_waveforms[units],
+                                                       snr_array[units,0],
+                                                       cluster_ids[units],
+                                                       peak_channels[units],
+                                                       peak_rows[units],
+                                                       sample_rate,
+                                                       upsampling_factor,
+                                                       spread_threshold,
+                                                       site_range,
+                                                       site_x, site_y,
+                                                       'complete_session',
+                                                       kept_sites = None if kept_sites is None else kept_sites[units])
 
 
 
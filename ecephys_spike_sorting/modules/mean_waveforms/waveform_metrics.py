@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import warnings
 import pandas as pd
 
 from scipy.stats import linregress
@@ -13,7 +14,8 @@ def calculate_waveform_metrics(waveforms,
                                upsampling_factor, 
                                spread_threshold,
                                site_range,
-                               site_spacing,
+                               site_x,
+                               site_y,
                                epoch_name):
     
     """
@@ -43,8 +45,8 @@ def calculate_waveform_metrics(waveforms,
         Threshold for computing spread of 2D waveform
     site_range : float
         Number of sites to use for 2D waveform metrics
-    site_spacing : float
-        Average vertical distance between sites (m)
+    site_x, site_y : numpy.ndarray
+        Positions (in um) of the channels in channel_map
 
     Outputs:
     -------
@@ -56,36 +58,45 @@ def calculate_waveform_metrics(waveforms,
     snr = calculate_snr(waveforms[:, peak_channel, :])
 
     mean_2D_waveform = np.squeeze(np.nanmean(waveforms[:, channel_map, :], 0))
-    local_peak = np.argmin(np.abs(channel_map - peak_channel))
 
-    num_samples = waveforms.shape[2]
-    new_sample_count = int(num_samples * upsampling_factor)
+    return calculate_waveform_metrics_from_mean(mean_2D_waveform, snr, cluster_id, peak_channel, channel_map,
+                                                sample_rate, upsampling_factor, spread_threshold, site_range,
+                                                site_x, site_y, epoch_name)
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+def calculate_waveform_metrics_from_mean(mean_2D_waveform,
+                                         snr,
+                                         cluster_id,
+                                         peak_channel,
+                                         channel_map,
+                                         sample_rate,
+                                         upsampling_factor,
+                                         spread_threshold,
+                                         site_range,
+                                         site_x,
+                                         site_y,
+                                         epoch_name):
 
-    duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
-    halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
-    PT_ratio = calculate_waveform_PT_ratio(mean_1D_waveform)
-    repolarization_slope = calculate_waveform_repolarization_slope(
-        mean_1D_waveform, timestamps)
-    recovery_slope = calculate_waveform_recovery_slope(
-        mean_1D_waveform, timestamps)
+    """
+    Calculate metrics from the mean waveform of one unit (see calculate_waveform_metrics)
 
-    amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, spread_threshold, site_range, site_spacing)
+    Inputs:
+    -------
+    mean_2D_waveform : numpy.ndarray (channels in channel_map x num_samples)
+        Mean waveform on the channels in channel_map
+    snr : float
+        Signal-to-noise ratio (see calculate_snr)
 
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
+    The other inputs and the output are the same as for calculate_waveform_metrics.
 
-    metrics = pd.DataFrame(data,
-                           columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
-                                     'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
-                                     'spread', 'velocity_above', 'velocity_below'])
+    """
 
-    return metrics
+    local_peak = np.argmin(np.abs(channel_map - peak_channel))
+
+    return calculate_waveform_metrics_for_units(mean_2D_waveform[np.newaxis, :, :], np.array([snr]),
+                                                np.array([cluster_id]), np.array([peak_channel]),
+                                                np.array([local_peak]), sample_rate, upsampling_factor,
+                                                spread_threshold, site_range, site_x, site_y, epoch_name)
 
 def calculate_waveform_metrics_from_avg(avg_waveform,
                                         snr,
@@ -148,29 +159,100 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     mean_2D_waveform = avg_waveform
     local_peak = peak_channel
 
-    num_samples = mean_2D_waveform.shape[1]
-    new_sample_count = int(num_samples * upsampling_factor)
+    return calculate_waveform_metrics_for_units(mean_2D_waveform[np.newaxis, :, :], np.array([snr]),
+                                                np.array([cluster_id]), np.array([peak_channel]),
+                                                np.array([local_peak]), sample_rate, upsampling_factor,
+                                                spread_threshold, site_range, site_x, site_y, epoch_name)
+
+
+def calculate_waveform_metrics_for_units(mean_2D_waveforms,
+                                         snr,
+                                         cluster_ids,
+                                         peak_channels,
+                                         local_peaks,
+                                         sample_rate,
+                                         upsampling_factor,
+                                         spread_threshold,
+                                         site_range,
+                                         site_x,
+                                         site_y,
+                                         epoch_name,
+                                         kept_sites=None):
+
+    """
+    Calculate metrics from the mean waveforms of many units at once
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    The peak-channel waveforms of all units are upsampled with one FFT
+    resample, the 1D and 2D metrics are computed for all of them with array
+    operations (see calculate_1D_features and calculate_2D_features_for_units),
+    and the table is built once.
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+    Inputs:
+    -------
+    mean_2D_waveforms : numpy.ndarray (num_units x num_channels x num_samples)
+        Mean waveform of each unit
+    snr : numpy.ndarray (num_units x 0)
+        Signal-to-noise ratio of each unit
+    cluster_ids : numpy.ndarray (num_units x 0)
+        ID of each unit
+    peak_channels : numpy.ndarray (num_units x 0)
+        Peak channel of each unit, as reported in the table
+    local_peaks : numpy.ndarray (num_units x 0)
+        Row of mean_2D_waveforms that holds the peak channel of each unit
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_x, site_y : numpy.ndarray
+        Positions (in um) of the channels (rows) of mean_2D_waveforms
+    epoch_name : str or numpy.ndarray (num_units x 0)
+    kept_sites : numpy.ndarray (num_units x num_channels)
+        If given, the waveforms are compact: row j of unit i is site kept_sites[i, j]
+        (-1 for padding), and sites that were not kept count as flat
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row of metrics per unit
+
+    """
 
-    duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
-    halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
-    PT_ratio = calculate_waveform_PT_ratio(mean_1D_waveform)
-    repolarization_slope = calculate_waveform_repolarization_slope(
-        mean_1D_waveform, timestamps)
-    recovery_slope = calculate_waveform_recovery_slope(
-        mean_1D_waveform, timestamps)
+    num_units, num_channels, num_samples = mean_2D_waveforms.shape
+    new_sample_count = int(num_samples * upsampling_factor)
 
-    amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
+    mean_1D_waveforms = resample(
+        mean_2D_waveforms[np.arange(num_units), local_peaks, :], new_sample_count, axis=1)
 
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
+    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
 
-    metrics = pd.DataFrame(data,
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope = \
+        calculate_1D_features(mean_1D_waveforms, timestamps)
+
+    if kept_sites is None:
+        peak_sites = local_peaks
+    else:
+        peak_sites = kept_sites[np.arange(num_units), local_peaks]
+
+    amplitude, spread, velocity_above, velocity_below = calculate_2D_features_for_units(
+        mean_2D_waveforms, timestamps, peak_sites, site_x, site_y, spread_threshold, site_range, kept_sites)
+
+    metrics = pd.DataFrame({'cluster_id' : cluster_ids,
+                            'epoch_name' : epoch_name,
+                            'peak_channel' : peak_channels,
+                            'snr' : snr,
+                            'duration' : duration,
+                            'halfwidth' : halfwidth,
+                            'PT_ratio' : PT_ratio,
+                            'repolarization_slope' : repolarization_slope,
+                            'recovery_slope' : recovery_slope,
+                            'amplitude' : amplitude,
+                            'spread' : spread,
+                            'velocity_above' : velocity_above,
+                            'velocity_below' : velocity_below},
                            columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
                                      'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
                                      'spread', 'velocity_above', 'velocity_below'])
@@ -184,6 +266,70 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 # ==========================================================
 
 
+def calculate_1D_features(waveforms, timestamps, window=20):
+
+    """
+    1D metrics of many waveforms at once
+
+    Same results as calculate_waveform_duration, calculate_waveform_halfwidth,
+    calculate_waveform_PT_ratio, calculate_waveform_repolarization_slope and
+    calculate_waveform_recovery_slope applied to each row of waveforms.
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N samples)
+    timestamps : numpy.ndarray (N samples)
+    window : int
+        Window (in samples) for the linear regression of the slopes
+
+    Outputs:
+    --------
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope : numpy.ndarray (num_units x 0)
+
+    """
+
+    num_units, num_samples = waveforms.shape
+    rows = np.arange(num_units)
+    samples = np.arange(num_samples)[np.newaxis, :]
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+    trough = waveforms[rows, trough_idx]
+    peak = waveforms[rows, peak_idx]
+
+    # measure from the peak if it is larger than the trough, otherwise from the trough;
+    # with sign = -1 the waveform is flipped, so both cases look for the same crossings
+    peak_first = peak > np.abs(trough)
+    center = np.where(peak_first, peak_idx, trough_idx)
+    signed = np.where(peak_first, 1.0, -1.0)[:, np.newaxis] * waveforms
+    after = samples >= center[:, np.newaxis]
+
+    # duration: to the first minimum (maximum) after the peak (trough)
+    end_idx = np.argmin(np.where(after, signed, np.inf), 1)
+    duration = (timestamps[end_idx] - timestamps[center]) * 1e3
+
+    # halfwidth: first crossing of half the peak (trough) before it, and first crossing back after it
+    threshold = (signed[rows, center] * 0.5)[:, np.newaxis]
+    crossing_1 = (signed > threshold) & ~after
+    crossing_2 = (signed < threshold) & after
+    found = np.any(crossing_1, 1) & np.any(crossing_2, 1)
+    halfwidth = np.full((num_units,), np.nan)
+    halfwidth[found] = (timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)])[found] * 1e3
+
+    PT_ratio = np.abs(peak / trough)
+
+    # slopes, with the waveform inverted if the maximum deflection is a peak
+    max_point = np.argmax(np.abs(waveforms), 1)
+    inverted = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis]
+
+    repolarization_slope = get_window_slopes(inverted, timestamps, max_point, window) * 1e-6
+
+    recovery_start = np.argmax(np.where(samples >= max_point[:, np.newaxis], inverted, -np.inf), 1)
+    recovery_slope = get_window_slopes(inverted, timestamps, recovery_start, window) * 1e-6
+
+    return duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope
+
+
 def calculate_snr(W):
     
     """
@@ -391,103 +537,199 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
 
     """
 
+    amplitude, spread, velocity_above, velocity_below = calculate_2D_features_for_units(
+        waveform[np.newaxis, :, :], timestamps, np.array([peak_channel]), site_x, site_y, spread_threshold, site_range)
+
+    return amplitude[0], spread[0], velocity_above[0], velocity_below[0]
+
+
+def calculate_2D_features_for_units(waveforms, timestamps, peak_channels, site_x, site_y, spread_threshold = 0.12,
+                                    site_range=16, kept_sites=None):
+
+    """
+    Compute features of the 2D waveforms of many units at once
+
+    The sites sampled around each peak site are looked up in a table built
+    once per peak site (see get_site_neighborhoods); amplitude, spread and
+    velocities are then computed for all units with array operations.
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N channels x M samples)
+    timestamps : numpy.ndarray (M samples)
+    peak_channels : numpy.ndarray (num_units x 0)
+        Peak channel (site) of each unit
+    spread_threshold : float
+    site_range: int
+    site_x, site_y : numpy.ndarray (N channels)
+    kept_sites : numpy.ndarray (num_units x num_rows)
+        If given, waveforms has one row per kept site (see gather_site_waveforms)
+
+    Outputs:
+    --------
+    amplitude : numpy.ndarray (num_units x 0), uV
+    spread : numpy.ndarray (num_units x 0), um
+    velocity_above : numpy.ndarray (num_units x 0), s / m
+    velocity_below : numpy.ndarray (num_units x 0), s / m
+
+    """
+
     assert site_range % 2 == 0 # must be even
-    
-    # sample sites that are in the same "column" as the peak channel
-    # first find nn with y ~= y_peak
-    # x = x_peak or x_nn. For NP 1.0, this will select either the 
-    # two left or two right hand columns.
-    
-    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
-    ydiff = ( site_y != site_y[peak_channel])
-    n_channel = site_x.size
-    min_dist = 1e6   # a value larger than the  distance to nn
-    x_nn = -1
-    amp_nn = 0
-    x_peak = site_x[peak_channel]
-    
-    for i in range(n_channel):
-        if ydiff[i] and dist[i] <= min_dist:  #only consider nn at diff y
-            min_dist = dist[i]
-            # to break ties between columns at the same distance, pick nn with
-            # largest amplitude
-            currAmp = np.max(waveform[i,:]) - np.min(waveform[i,:])
-            if currAmp > amp_nn:
-                x_nn = site_x[i]
-            
-    # select among sites with x = x_peak and x_nn for sites to sample
-    inCol = (site_x == x_peak) | (site_x == x_nn)   
-    sort_dist_ind = np.argsort(dist)
-    sites_to_sample = np.zeros(site_range+1, dtype='int32')
-    
-    nfound = 0
-    i = 0
-    # walk over all sites in order of distance from the peak_channel, add to
-    # list of channels to sample
-    while nfound < site_range and i < n_channel:
-        curr_chan = sort_dist_ind[i]
-        if inCol[curr_chan]:
-            sites_to_sample[nfound] = curr_chan
-            nfound = nfound + 1           
-            # print('site, dist: ' + repr(curr_chan) + ',' + repr(dist[curr_chan]))
-        i = i+1
-            
-    
-    # original implentation for NP 1.0, assuming all sites in one bank, pick 
-    # even or odd sites 
-    # sites_to_sample = np.arange(-site_range, site_range+1, 2) + peak_channel
-    # sites_to_sample = sites_to_sample[(sites_to_sample > 0) * (sites_to_sample < waveform.shape[0])]
 
-    # take only as many sites as we "found"
-    sites_to_sample = sites_to_sample[0:nfound]
-    wv = waveform[sites_to_sample, :]
+    num_units = waveforms.shape[0]
+    rows = np.arange(num_units)[:, np.newaxis]
 
-    #smoothed_waveform = np.zeros((wv.shape[0]-1,wv.shape[1]))
-    #for i in range(wv.shape[0]-1):
-    #    smoothed_waveform[i,:] = np.mean(wv[i:i+2,:],0)
+    peak_sites, site_index = np.unique(peak_channels, return_inverse=True)
+    nn_candidates, sites_table = get_site_neighborhoods(site_x, site_y, peak_sites, site_range)
 
-    trough_idx = np.argmin(wv, 1)
-    trough_amplitude = np.min(wv, 1)
+    # the nearest neighbor in another row is the last candidate with a nonzero amplitude
+    candidates = nn_candidates[site_index]
+    candidate_waveforms = gather_site_waveforms(waveforms, candidates, kept_sites)
+    usable = (candidates >= 0) & (np.max(candidate_waveforms, 2) - np.min(candidate_waveforms, 2) > 0)
+    num_candidates = candidates.shape[1]
+    choice = np.where(np.any(usable, 1), num_candidates - 1 - np.argmax(usable[:, ::-1], 1), num_candidates)
 
-    peak_idx = np.argmax(wv, 1)
-    peak_amplitude = np.max(wv, 1)
+    sites_to_sample = sites_table[site_index, choice]
+    sampled = sites_to_sample >= 0
+    wv = gather_site_waveforms(waveforms, sites_to_sample, kept_sites)
 
-    duration = np.abs(timestamps[peak_idx] - timestamps[trough_idx])
+    trough_idx = np.argmin(wv, 2)
+    overall_amplitude = np.where(sampled, np.max(wv, 2) - np.min(wv, 2), -np.inf)
+    amplitude = np.max(overall_amplitude, 1)
+    max_chan = np.argmax(overall_amplitude, 1)
 
-    overall_amplitude = peak_amplitude - trough_amplitude
-    amplitude = np.max(overall_amplitude)
-    max_chan = np.argmax(overall_amplitude)
+    points_above_thresh = sampled & (overall_amplitude > (amplitude * spread_threshold)[:, np.newaxis])
 
-    points_above_thresh = np.where(overall_amplitude > (amplitude * spread_threshold))[0]
-    
-    if len(points_above_thresh) > 1:
-        points_above_thresh = points_above_thresh[isnot_outlier(points_above_thresh)]
-        
-    yDist = site_y[sites_to_sample] - site_y[peak_channel]
-    yDist = yDist[points_above_thresh]
-    
-    # debug print to understand what sites are selected
-#    for i in range(numpts):
-#        print('i, ydist:' + repr(i) + ', ' + repr(yDist[i]))
-    if len(yDist) > 0:
-        spread = np.max(yDist) - np.min(yDist)
-    else:
-        spread = 0
+    # remove outliers (see isnot_outlier) among the indices of the points above threshold
+    num_points = np.sum(points_above_thresh, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        index = np.arange(site_range, dtype='float64')[np.newaxis, :]
+        median = np.nanmedian(np.where(points_above_thresh, index, np.nan), 1)
+        diff = np.sqrt(np.square(index - median[:, np.newaxis]))
+        med_abs_deviation = np.nanmedian(np.where(points_above_thresh, diff, np.nan), 1)
+        modified_z_score = 0.6745 * diff / med_abs_deviation[:, np.newaxis]
+    points_above_thresh &= (modified_z_score <= 1.5) | (num_points <= 1)[:, np.newaxis]
 
-    # original channel based calculation of spread
-    
-    # spread = len(points_above_thresh) * site_spacing * 1e6
-    # channels = sites_to_sample - peak_channel
-    # channels = channels[points_above_thresh]
+    yDist = site_y[np.maximum(sites_to_sample, 0)] - site_y[peak_channels][:, np.newaxis]
+
+    spread = np.zeros((num_units,))
+    has_points = np.any(points_above_thresh, 1)
+    spread[has_points] = (np.max(np.where(points_above_thresh, yDist, -np.inf), 1) - \
+                          np.min(np.where(points_above_thresh, yDist, np.inf), 1))[has_points]
 
-    trough_times = timestamps[trough_idx] - timestamps[trough_idx[max_chan]]
-    trough_times = trough_times[points_above_thresh]
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[rows[:, 0], max_chan]][:, np.newaxis]
+
+    velocity_above = get_velocity_for_units(yDist, trough_times, points_above_thresh & (yDist >= 0))
+    velocity_below = get_velocity_for_units(yDist, trough_times, points_above_thresh & (yDist <= 0))
 
-    velocity_above, velocity_below = get_velocity(yDist, trough_times)
- 
     return amplitude, spread, velocity_above, velocity_below
 
 
+def gather_site_waveforms(waveforms, sites, kept_sites=None):
+
+    """
+    Waveforms of given sites for each unit
+
+    Inputs:
+    -------
+    waveforms : numpy.ndarray (num_units x num_rows x M samples)
+    sites : numpy.ndarray (num_units x num_sites)
+        Sites to gather for each unit (-1 for padding)
+    kept_sites : numpy.ndarray (num_units x num_rows)
+        Site of each row of waveforms; if None, row i is site i
+
+    Outputs:
+    --------
+    site_waveforms : numpy.ndarray (num_units x num_sites x M samples)
+        Sites that were not kept (and padding) are flat
+
+    """
+
+    rows = np.arange(waveforms.shape[0])[:, np.newaxis]
+
+    if kept_sites is None:
+        return waveforms[rows, np.maximum(sites, 0), :]
+
+    match = (kept_sites[:, np.newaxis, :] == sites[:, :, np.newaxis]) & (sites >= 0)[:, :, np.newaxis]
+
+    site_waveforms = waveforms[rows, np.argmax(match, 2), :]
+    site_waveforms[~np.any(match, 2)] = 0
+
+    return site_waveforms
+
+
+def get_site_neighborhoods(site_x, site_y, peak_sites, site_range=16):
+
+    """
+    Sites sampled for the 2D features around each peak site
+
+    Sites are sampled in the same "column" as the peak site: the sites with
+    x = x_peak or x = x_nn, where the nearest neighbor (nn) is the closest site
+    with a different y. For NP 1.0, this selects either the two left or the
+    two right hand columns. The site_range sites closest to the peak are taken.
+
+    The nearest neighbor depends on the waveform when sites are tied (the last
+    one visited with a nonzero amplitude is used), so the sites to sample are
+    stored for every candidate neighbor.
+
+    Inputs:
+    -------
+    site_x, site_y : numpy.ndarray (N channels)
+        Site positions in um
+    peak_sites : numpy.ndarray (num_peak_sites x 0)
+        Peak sites to build the table for
+    site_range : int
+        Number of sites to sample
+
+    Outputs:
+    --------
+    nn_candidates : numpy.ndarray (num_peak_sites x max_candidates)
+        Sites that can be the nearest neighbor, in the order they are visited; -1 if unused
+    sites_to_sample : numpy.ndarray (num_peak_sites x max_candidates + 1 x site_range)
+        Sites to sample, in order of distance from the peak, for each candidate
+        (the last entry is for no neighbor); -1 if fewer sites are found
+
+    """
+
+    candidate_list = []
+    sites_list = []
+
+    for peak_site in peak_sites:
+
+        dist = np.sqrt(( pow((site_x - site_x[peak_site]),2) + pow((site_y - site_y[peak_site]),2)))
+        ydiff = ( site_y != site_y[peak_site])
+        x_peak = site_x[peak_site]
+
+        # visiting sites in order, a site is a candidate if it is at a different y
+        # and at least as close as all the earlier sites at a different y
+        previous_min = np.minimum.accumulate(np.concatenate(([1e6], np.where(ydiff, dist, np.inf)[:-1])))
+        candidates = np.where(ydiff & (dist <= previous_min))[0]
+
+        # walk over all sites in order of distance from the peak site
+        sort_dist_ind = np.argsort(dist)
+        sites = []
+        for x_nn in list(site_x[candidates]) + [-1]:
+            inCol = (site_x == x_peak) | (site_x == x_nn)
+            sites.append(sort_dist_ind[inCol[sort_dist_ind]][:site_range])
+
+        candidate_list.append(candidates)
+        sites_list.append(sites)
+
+    max_candidates = max([len(candidates) for candidates in candidate_list] + [0])
+
+    nn_candidates = np.full((len(peak_sites), max_candidates), -1, dtype='int64')
+    sites_to_sample = np.full((len(peak_sites), max_candidates + 1, site_range), -1, dtype='int64')
+
+    for idx, (candidates, sites) in enumerate(zip(candidate_list, sites_list)):
+        nn_candidates[idx, :len(candidates)] = candidates
+        for candidate_idx, candidate_sites in enumerate(sites[:-1]):
+            sites_to_sample[idx, candidate_idx, :len(candidate_sites)] = candidate_sites
+        sites_to_sample[idx, -1, :len(sites[-1])] = sites[-1]
+
+    return nn_candidates, sites_to_sample
+
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
@@ -544,6 +786,99 @@ def get_velocity(yDist, times):
     return velocity_above, velocity_below
 
 
+def get_window_slopes(waveforms, timestamps, starts, window):
+
+    """
+    Slopes of linear regressions over a window of each waveform
+
+    Inputs:
+    -------
+    waveforms : numpy.ndarray (num_units x N samples)
+    timestamps : numpy.ndarray (N samples)
+    starts : numpy.ndarray (num_units x 0)
+        First sample of the window of each waveform
+    window : int
+        Window length (shorter at the end of the waveform)
+
+    Outputs:
+    --------
+    slopes : numpy.ndarray (num_units x 0)
+        Slope of waveforms[i, starts[i]:starts[i]+window] vs. timestamps, as
+        from linregress; NaN if the window has fewer than 2 samples
+
+    """
+
+    idx = starts[:, np.newaxis] + np.arange(window)[np.newaxis, :]
+    valid = idx < waveforms.shape[1]
+    idx = np.minimum(idx, waveforms.shape[1] - 1)
+
+    slopes = get_slopes(timestamps[idx], np.take_along_axis(waveforms, idx, 1), valid)
+    slopes[np.sum(valid, 1) < 2] = np.nan
+
+    return slopes
+
+
+def get_slopes(x, y, mask):
+
+    """
+    Least-squares slopes of y vs. x for each row, using the points in mask
+
+    Inputs:
+    -------
+    x, y : numpy.ndarray (num_rows x num_points)
+    mask : numpy.ndarray (num_rows x num_points)
+        Points to include
+
+    Outputs:
+    --------
+    slopes : numpy.ndarray (num_rows x 0)
+        Same as the slope from linregress; NaN if x has no variance
+
+    """
+
+    n = np.sum(mask, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(mask, x, 0)
+        y = np.where(mask, y, 0)
+        dx = np.where(mask, x - (np.sum(x, 1) / n)[:, np.newaxis], 0)
+        dy = np.where(mask, y - (np.sum(y, 1) / n)[:, np.newaxis], 0)
+        slopes = np.sum(dx * dy, 1) / np.sum(dx * dx, 1)
+
+    return slopes
+
+
+def get_velocity_for_units(yDist, times, mask):
+
+    """
+    Calculate slope of trough time vs. distance for many units (see get_velocity)
+
+    Inputs:
+    -------
+    yDist : numpy.ndarray (num_units x num_sites)
+        distance of site to soma, in um
+    times : numpy.ndarray (num_units x num_sites)
+        Trough time relative to peak channel
+    mask : numpy.ndarray (num_units x num_sites)
+        Sites above (or below) the soma to include
+
+    Outputs:
+    --------
+    velocity : numpy.ndarray (num_units x 0)
+        Inverse of velocity of spike propagation (s / m); NaN if the sites
+        span no distance
+
+    """
+
+    spread = np.max(np.where(mask, yDist, -np.inf), 1) - np.min(np.where(mask, yDist, np.inf), 1)
+    has_spread = (np.sum(mask, 1) > 1) & (spread > 0)
+
+    velocity = np.full((yDist.shape[0],), np.nan)
+    velocity[has_spread] = get_slopes(yDist, times, mask)[has_spread] * 1e6     #convert slope to s / m
+
+    return velocity
+
+
 def isnot_outlier(points, thresh=1.5):
 
     """
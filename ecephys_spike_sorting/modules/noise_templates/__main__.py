@@ -7,7 +7,8 @@ import numpy as np
 
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
-from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.utils import write_cluster_group_tsv, KilosortDataset
+from ...common.artifact_cache import get_artifact_cache
 
 
 def classify_noise_templates(args):
@@ -16,20 +17,21 @@ def classify_noise_templates(args):
     
     start = time.time()
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                args['ephys_params']['sample_rate'], \
-                convert_to_seconds = True)
+    cache = get_artifact_cache(args)
+
+    # only the files used by the classifier are read
+    dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                args['ephys_params']['sample_rate'], cache = cache)
 
     if args['noise_waveform_params']['use_random_forest']:
         # use random forest classifier
-        cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, \
-                    cluster_ids, templates, args['noise_waveform_params'])
+        cluster_ids, is_noise = id_noise_templates_rf(dataset.spike_times_seconds, dataset.spike_clusters, \
+                    dataset.cluster_ids, dataset.templates, args['noise_waveform_params'], \
+                    peak_channel_index = dataset.peak_channel_index)
     else:
         # use heuristics to identify templates that look like noise
-        cluster_ids, is_noise = id_noise_templates(cluster_ids, templates,  \
-            channel_pos, args['noise_waveform_params'])
+        cluster_ids, is_noise = id_noise_templates(dataset.cluster_ids, dataset.templates,  \
+            dataset.channel_pos, args['noise_waveform_params'])
 
     mapping = {False: 'good', True: 'noise'}
     labels = [mapping[value] for value in is_noise]
@@ -1,7 +1,7 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean, NumpyArray
-from ...common.schemas import EphysParams, Directories
+from ...common.schemas import EphysParams, Directories, ArtifactCacheParams
 
 class NoiseWaveformParams(DefaultSchema):
     classifier_path = String(required=True, help='Path to pre-trained waveform classifier')
@@ -39,6 +39,7 @@ class NoiseWaveformParams(DefaultSchema):
 class InputParameters(ArgSchema):
     
     noise_waveform_params = Nested(NoiseWaveformParams)
+    artifact_cache_params = Nested(ArtifactCacheParams)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
     
@@ -13,7 +13,7 @@ from functools import partial
 
 import pickle
 
-def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params):
+def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params, peak_channel_index = None):
 
     """
     Uses a random forest classifier to identify noise units based on waveform shape
@@ -24,6 +24,8 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
     spike_clusters : cluster IDs for each spike time []
     cluster_ids : all unique cluster ids
     templates : template for each unit output by Kilosort
+    peak_channel_index : peak channel of each template (optional), as from
+        KilosortDataset.peak_channel_index; computed from templates if not given
 
     Outputs:
     -------
@@ -46,7 +48,9 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
 
     feature_matrix = np.zeros((cluster_ids.size, 61, 32))
 
-    peak_channels = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    if peak_channel_index is None:
+        peak_channel_index = np.argmax(np.max(templates,1) - np.min(templates,1),1)
+    peak_channels = np.squeeze(peak_channel_index)
 
     for idx, unit in enumerate(cluster_ids):
         
@@ -8,11 +8,13 @@ import pathlib
 import numpy as np
 import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset
+from ...common.artifact_cache import get_artifact_cache
 from ...common.utils import getFileVersion
 from ...common.epoch import get_epochs_from_nwb_file
 
 from .metrics import calculate_metrics
+from .metrics import unit_fingerprints, calculate_peak_channels, find_units_to_update
 from .ibl_metrics import calculate_ibl_metrics
 
 
@@ -34,26 +36,61 @@ def calculate_quality_metrics(args):
     print(args['directories']['kilosort_output_directory'])
     print("Loading data...")
 
+    cache = get_artifact_cache(args)
 
     try:
+        # one dataset, so the majority templates are counted from the arrays loaded here
+        # (or read from the cache)
+        dataset = KilosortDataset(args['directories']['kilosort_output_directory'],
+                                  args['ephys_params']['sample_rate'],
+                                  use_master_clock = False,
+                                  mmap_mode = None,
+                                  features_mmap_mode = 'r' if args['quality_metrics_params']['memmap_pc_features'] else None,
+                                  cache = cache)
+
+        spike_times = dataset.spike_times_seconds
+        spike_clusters = dataset.spike_clusters
+        spike_templates = dataset.spike_templates
+        amplitudes = dataset.amplitudes
+        templates = dataset.templates
+        channel_map = dataset.channel_map
+        channel_pos = dataset.channel_pos
+
         if include_pc_metrics:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = True)
+            pc_features = dataset.pc_features
+            pc_feature_ind = dataset.pc_feature_ind
         else:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = False)
             pc_features = []
             pc_feature_ind = []
+
+        fingerprints = None
+        previous_metrics = None
+        units_to_update = None
+        majority_templates = None
+        peak_channels = None
+
+        if include_pc_metrics:
+            majority_templates = dataset.majority_templates
+
+            if args['quality_metrics_params']['incremental']:
+                # the peak channels of the fingerprints are reused for the whole-session PC metrics
+                fingerprints, peak_channels = get_fingerprints(spike_clusters, pc_features, pc_feature_ind, majority_templates)
+                previous_file = get_previous_version(output_file_args, metrics_version)
+                if previous_file is not None and os.path.exists(get_fingerprint_file(previous_file)):
+                    previous_metrics = pd.read_csv(previous_file)
+                    units_to_update = find_units_to_update(fingerprints, 
+                                                           pd.read_csv(get_fingerprint_file(previous_file)), 
+                                                           channel_pos, 
+                                                           args['quality_metrics_params']['max_radius_um'])
+                    print('Updating PC metrics for ' + repr(units_to_update.size) + ' of ' + repr(len(fingerprints)) + ' units')
+                else:
+                    print('No fingerprints found for a previous metrics file; computing PC metrics for all units')
                     
-        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'], units_to_update = units_to_update, majority_templates = majority_templates, peak_channels = peak_channels)
+
+        if previous_metrics is not None:
+            metrics = reuse_pc_metrics(metrics, previous_metrics, units_to_update)
+
         if args['quality_metrics_params']['include_ibl']:
             ibl_metrics = calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, args['quality_metrics_params'], args['ephys_params']['sample_rate'])
         
@@ -86,6 +123,9 @@ def calculate_quality_metrics(args):
    
     metrics.to_csv(output_file, index=False )
 
+    if fingerprints is not None:
+        fingerprints.to_csv(get_fingerprint_file(output_file), index=False)
+
     execution_time = time.time() - start
 
     print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
@@ -95,6 +135,63 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : output_file} # output manifest
 
 
+def get_fingerprints(spike_clusters, pc_features, pc_feature_ind, template_ids):
+
+    # spike membership and peak channel of each unit, saved next to the metrics file
+    # so that an incremental run can find the units that changed
+    # template_ids is the majority template of each unit
+    # also returns the peak channels of all units, for calculate_metrics
+
+    total_units = np.max(spike_clusters) + 1
+
+    fingerprints = unit_fingerprints(spike_clusters, total_units)
+    cluster_ids = fingerprints['cluster_id'].values
+
+    peak_channels = calculate_peak_channels(np.squeeze(spike_clusters), total_units, cluster_ids, template_ids, pc_features, pc_feature_ind)
+
+    fingerprints['peak_channel'] = peak_channels[cluster_ids]
+
+    return fingerprints, peak_channels
+
+
+def get_fingerprint_file(metrics_file):
+
+    return os.path.join(pathlib.Path(metrics_file).parent, pathlib.Path(metrics_file).stem + '_fingerprints.csv')
+
+
+def get_previous_version(input_filePath, next_version):
+
+    # latest existing file in the series named by getFileVersion, or None
+    
+    if next_version == 0:
+        return None
+    elif next_version == 1:
+        return input_filePath
+    else:
+        return os.path.join(pathlib.Path(input_filePath).parent, 
+                            pathlib.Path(input_filePath).stem + '_' + repr(next_version - 1) + pathlib.Path(input_filePath).suffix)
+
+
+def reuse_pc_metrics(metrics, previous_metrics, units_to_update):
+
+    # PC metrics of units that were not updated are copied from the previous metrics file
+
+    pc_metrics = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
+
+    # one row per unit and epoch; the saved file may have been merged with the waveform metrics
+    previous = previous_metrics.rename(columns={'epoch_name_quality_metrics' : 'epoch_name'})
+    keys = ['cluster_id', 'epoch_name'] if 'epoch_name' in previous.columns else ['cluster_id']
+    previous = previous[keys + pc_metrics].drop_duplicates(keys)
+
+    matched = metrics[keys].merge(previous, on=keys, how='left', indicator=True)
+    reuse = np.invert(metrics['cluster_id'].isin(units_to_update).values) & (matched['_merge'] == 'both').values
+
+    for column in pc_metrics:
+        metrics.loc[reuse, column] = matched[column].values[reuse]
+
+    return metrics
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
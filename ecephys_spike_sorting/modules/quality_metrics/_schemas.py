@@ -1,12 +1,13 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean
-from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean, List
+from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile, ArtifactCacheParams
 
 
 class QualityMetricsParams(DefaultSchema):
     isi_threshold = Float(required=False, default=0.0015, help='Maximum time (in seconds) for ISI violation')
     min_isi = Float(required=False, default=0.00, help='Minimum time (in seconds) for ISI violation')
+    isi_threshold_sweep = List(Float, required=False, default=[], help='Additional ISI thresholds (in seconds); each adds isi_viol, num_viol and contam_rate columns computed in the same pass')
     tbin_sec = Float(required=False, default=0.001, help='time bin in seconds for ccg in contam_rate calculation')
     max_radius_um = Int(required=False, default=68, help='Maximum radius for computing PC metrics, in um')
     max_spikes_for_unit = Int(required=False, default=500, help='Number of spikes to subsample for computing PC metrics')
@@ -18,10 +19,16 @@ class QualityMetricsParams(DefaultSchema):
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
     include_pc_metrics = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
     include_ibl = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    pc_metrics_workers = Int(required=False, default=1, help='Number of worker processes for PC metrics; units are split into depth bands when > 1')
+    pc_metrics_max_memory_gb = Float(required=False, default=16.0, help='Approximate ceiling (in GB) for the PC features held by all PC metrics workers at once')
+    memmap_pc_features = Boolean(required=False, default=False, help='Memory-map pc_features.npy instead of loading it; only the spikes used by each metric are read')
+    incremental = Boolean(required=False, default=False, help='Only recompute PC metrics for units whose spikes changed since the last metrics file (and units within max_radius_um of them); other parameters must be unchanged. Unit fingerprints are saved next to the metrics file for the next incremental run')
+    random_seed = Int(required=False, default=None, allow_none=True, help='Seed for spike subsampling in PC metrics; if set, results do not depend on pc_metrics_workers')
 
 class InputParameters(ArgSchema):
     
     quality_metrics_params = Nested(QualityMetricsParams)
+    artifact_cache_params = Nested(ArtifactCacheParams)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
     waveform_metrics = Nested(WaveformMetricsFile)
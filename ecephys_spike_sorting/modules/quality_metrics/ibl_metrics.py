@@ -3,10 +3,10 @@ import pandas as pd
 import scipy.stats as stats
 from collections import OrderedDict
 
-from phylib.stats import correlograms
-
 from ...common.epoch import Epoch
+from ...common.spike_index import SpikeIndex
 from ...common.utils import printProgressBar
+from .metrics import grouped_lag_histograms, group_spikes_by_cluster
 
 def calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, params, sample_rate, epochs = None):
 
@@ -61,16 +61,25 @@ def calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, params, sampl
 
     cluster_ids = np.arange(total_units)
 
+    # spikes in time order, so each epoch is a contiguous slice
+    spike_index = SpikeIndex(spike_times, spike_clusters, total_units)
+    spike_times = spike_index.spike_times
+    spike_clusters = spike_index.spike_clusters
+    amplitudes = spike_index.sort(np.squeeze(amplitudes))
 
     for epoch in epochs:
 
-        in_epoch = (spike_times >= epoch.start_time) * (spike_times <= epoch.end_time)
+        start, stop = spike_index.epoch_range(epoch)
+        in_epoch = slice(start, stop)
+        spike_order, unit_offsets = spike_index.grouped(start, stop)
 
         print("Calculating slidingRP")
-        SRP_pass = calculate_slidingRP(spike_times[in_epoch], spike_clusters[in_epoch], total_units, sample_rate )
+        SRP_pass = calculate_slidingRP(spike_times[in_epoch], spike_clusters[in_epoch], total_units, sample_rate,
+                                       spike_order, unit_offsets)
         
         print("Calculating nongaussian noise cutoff")
-        nc_pass = calculate_noise_cutoff(np.squeeze(amplitudes[in_epoch]), spike_clusters[in_epoch], total_units)
+        nc_pass = calculate_noise_cutoff(amplitudes[in_epoch], spike_clusters[in_epoch], total_units,
+                                         spike_order, unit_offsets)
                 
         metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
                                 ('slidingRP' , SRP_pass),
@@ -81,36 +90,64 @@ def calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, params, sampl
 
 
 
-def calculate_slidingRP(spike_times, spike_clusters, total_units, sample_rate):
+def calculate_slidingRP(spike_times, spike_clusters, total_units, sample_rate, spike_order = None, unit_offsets = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    # all units are computed at once, from one (cluster, time)-sorted stream of spikes
 
-    SRP_pass = np.zeros((total_units,))
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units, spike_times)
+    order, offsets = spike_order, unit_offsets
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    SRP_pass = grouped_slidingRP_viol(spike_times[order], offsets, sample_rate = sample_rate)
 
-        printProgressBar(idx+1, len(cluster_ids))
+    return SRP_pass.astype('float64')
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        SRP_pass[cluster_id] = slidingRP_viol(ts = spike_times[for_this_cluster], sample_rate = sample_rate) 
 
-    return SRP_pass
+def calculate_noise_cutoff(spike_amps, spike_clusters, total_units, spike_order = None, unit_offsets = None):
 
+    # histograms for all units are computed in one pass
 
-def calculate_noise_cutoff(spike_amps, spike_clusters, total_units):
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units)
+    order, offsets = spike_order, unit_offsets
 
-    cluster_ids = np.unique(spike_clusters)
+    nc_pass = grouped_noise_cutoff(spike_amps[order], offsets)
 
-    nc_pass = np.zeros((total_units,))
+    return nc_pass.astype('float64')
 
-    for idx, cluster_id in enumerate(cluster_ids):
+def acg_lag_counts(ts, bin_size, sample_rate, window_size):
+    """
+    One-sided autocorrelogram of a single spike train, binned as in
+    phylib.stats.correlograms(..., symmetrize=False): spike times are
+    truncated to samples, lags are counted in bins of int(sample_rate * bin_size)
+    samples, up to half of window_size.
 
-        printProgressBar(idx+1, len(cluster_ids))
+    Parameters
+    ----------
+    ts : ndarray_like
+        The sorted timestamps (in s) of the spikes.
+    bin_size : float
+        Bin size in seconds.
+    sample_rate : float
+        Sample rate used to convert times to samples.
+    window_size : float
+        Total (two-sided) window in seconds.
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        nc_pass[cluster_id] = noise_cutoff(amps = spike_amps[for_this_cluster])[0] 
+    Returns
+    -------
+    counts : ndarray
+        Number of spike pairs in each lag bin, starting at zero lag.
+    """
+    bin_size = np.clip(bin_size, 1e-5, 1e5)
+    window_size = np.clip(window_size, 1e-5, 1e5)
+    bin_size_samples = int(sample_rate * bin_size)
+    winsize_bins = 2 * int(.5 * window_size / bin_size) + 1
+
+    spike_samples = (np.asarray(ts, dtype=np.float64) * sample_rate).astype(np.int64)
+
+    return grouped_lag_histograms(spike_samples, np.zeros(spike_samples.shape, dtype='int64'), 1,
+                                  bin_size_samples, winsize_bins // 2)[0]
 
-    return nc_pass
 
 def _max_acceptable_cont(FR, RP, rec_duration, acceptableCont, thresh):
     """
@@ -184,20 +221,18 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=
     if len(ts) > 0 and ts[-1] > ts[0]:  # only do this for units with samples
         recDur = (ts[-1] - ts[0])
         # compute acg
-        c0 = correlograms(ts, np.zeros(len(ts), dtype='int8'), cluster_ids=[0],
-                          bin_size=bin_size / 1000, sample_rate=sample_rate,
-                          window_size=2,
-                          symmetrize=False)
+        c0 = acg_lag_counts(ts, bin_size=bin_size / 1000, sample_rate=sample_rate,
+                            window_size=2)
         # cumulative sum of acg, i.e. number of total spikes occuring from 0
         # to end of that bin
-        cumsumc0 = np.cumsum(c0[0, 0, :])
+        cumsumc0 = np.cumsum(c0)
         # cumulative sum at each of the testing bins
         res = cumsumc0[bTestIdx]
         total_spike_count = len(ts)
 
         # divide each bin's count by the total spike count and the bin size
-        bin_count_normalized = c0[0, 0] / total_spike_count / bin_size * 1000
-        num_bins_2s = len(c0[0, 0])  # number of total bins that equal 2 secs
+        bin_count_normalized = c0 / total_spike_count / bin_size * 1000
+        num_bins_2s = len(c0)  # number of total bins that equal 2 secs
         num_bins_1s = int(num_bins_2s / 2)  # number of bins that equal 1 sec
         # compute fr based on the  mean of bin_count_normalized from 1 to 2 s
         # instead of as before (len(ts)/recDur) for a better estimate
@@ -214,6 +249,87 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=
     return didpass
 
 
+def grouped_slidingRP_viol(sorted_ts, offsets, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=30000):
+    """
+    slidingRP_viol for all units at once.
+
+    The autocorrelograms of all units are counted from one (cluster, time)-sorted
+    stream of spikes, and the maximum acceptable number of violations is
+    computed for every unit and test bin with one (vectorized) Poisson
+    quantile call per distinct expected count.
+
+    Parameters
+    ----------
+    sorted_ts : ndarray_like
+        The timestamps (in s) of all spikes, sorted by cluster and then by time.
+    offsets : ndarray_like
+        The spikes of unit i are sorted_ts[offsets[i]:offsets[i+1]].
+    (other parameters as in slidingRP_viol)
+
+    Returns
+    -------
+    didpass : ndarray
+        didpass of each unit (0 for units without spikes)
+    """
+
+    b = np.arange(0, 10.25, bin_size) / 1000 + 1e-6  # bins in seconds
+    bTestIdx = [5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40]
+    bTest = np.array([b[i] for i in bTestIdx])
+
+    total_units = offsets.size - 1
+    counts = np.diff(offsets)
+
+    didpass = np.zeros((total_units,), dtype='int64')
+
+    has_spikes = counts > 0
+    recDur = np.zeros((total_units,))
+    recDur[has_spikes] = sorted_ts[offsets[1:][has_spikes] - 1] - sorted_ts[offsets[:-1][has_spikes]]
+
+    units = np.where(recDur > 0)[0]  # only do this for units with samples
+    if units.size == 0:
+        return didpass
+
+    # acg of every unit, binned as in acg_lag_counts
+    bin_size_samples = int(sample_rate * bin_size / 1000)
+    winsize_bins = 2 * int(.5 * 2 / (bin_size / 1000)) + 1
+    spike_samples = (np.asarray(sorted_ts, dtype=np.float64) * sample_rate).astype(np.int64)
+    spike_clusters = np.repeat(np.arange(total_units), counts)
+
+    c0 = grouped_lag_histograms(spike_samples, spike_clusters, total_units, bin_size_samples, winsize_bins // 2)[units]
+
+    # cumulative sum of acg at each of the testing bins
+    res = np.cumsum(c0, axis=1)[:, bTestIdx]
+
+    # firing rate from the mean normalized acg from 1 to 2 s, as in slidingRP_viol
+    num_bins_2s = c0.shape[1]
+    num_bins_1s = int(num_bins_2s / 2)
+    fr = np.array([np.sum((c / n / bin_size * 1000)[num_bins_1s:num_bins_2s]) / num_bins_1s
+                   for c, n in zip(c0, counts[units])])
+
+    # maximum allowed number of spikes per testing bin (see _max_acceptable_cont)
+    time_for_viol = bTest[np.newaxis, :] * 2 * fr[:, np.newaxis] * recDur[units][:, np.newaxis]
+    expected_count = (fr * acceptThresh)[:, np.newaxis] * time_for_viol
+    m = _max_acceptable_counts(expected_count, thresh)
+
+    didpass[units] = np.any(np.less_equal(res, m), axis=1).astype('int64')
+
+    return didpass
+
+
+def _max_acceptable_counts(expected_count, thresh):
+    """
+    Vectorized _max_acceptable_cont: Poisson quantiles for an array of
+        expected counts, computed once for each distinct value
+    """
+    table_keys, inverse = np.unique(expected_count, return_inverse=True)
+
+    table = stats.poisson.ppf(thresh, table_keys)
+    table[(table == 0) & (stats.poisson.pmf(0, table_keys) > 0)] = -1
+
+    return np.reshape(table[inverse], expected_count.shape)
+
+
+
 
 def noise_cutoff(amps, quantile_length=.25, n_bins=100, nc_threshold=5, percent_threshold=0.10):
     """
@@ -259,28 +375,114 @@ def noise_cutoff(amps, quantile_length=.25, n_bins=100, nc_threshold=5, percent_
     if amps.size > 1:  # ensure there are amplitudes available to analyze
         bins_list = np.linspace(0, np.max(amps), n_bins)  # list of bins to compute the amplitude histogram
         n, bins = np.histogram(amps, bins=bins_list)  # construct amplitude histogram
-        idx_peak = np.argmax(n)  # peak of amplitude distribution
-        # don't count zeros #len(n) - idx_peak, compute the length of the top half of the distribution -- ignoring zero bins
-        length_top_half = len(np.where(n[idx_peak:-1] > 0)[0])
-        # the remaining part of the distribution, which we will compare the low quantile to
-        high_quantile = 2 * quantile_length
-        # the first bin (index) of the high quantile part of the distribution
-        high_quantile_start_ind = int(np.ceil(high_quantile * length_top_half + idx_peak))
-        # bins to consider in the high quantile (of all non-zero bins)
-        indices_bins_high_quantile = np.arange(high_quantile_start_ind, len(n))
-        idx_use = np.where(n[indices_bins_high_quantile] >= 1)[0]
-
-        if len(n[indices_bins_high_quantile]) > 0:  # ensure there are amplitudes in these bins
-            # mean of all amp values in high quantile bins
-            mean_high_quantile = np.mean(n[indices_bins_high_quantile][idx_use])
-            std_high_quantile = np.std(n[indices_bins_high_quantile][idx_use])
-            if std_high_quantile > 0:
-                first_low_quantile = n[(n != 0)][1]  # take the second bin
-                cutoff = (first_low_quantile - mean_high_quantile) / std_high_quantile
-                peak_bin_height = np.max(n)
-                percent_of_peak = percent_threshold * peak_bin_height
-
-                fail_criteria = (cutoff > nc_threshold) & (first_low_quantile > percent_of_peak)
+        fail_criteria, cutoff, first_low_quantile = _noise_cutoff_from_histogram(n, quantile_length, nc_threshold, percent_threshold)
 
     nc_pass = ~fail_criteria
-    return nc_pass, cutoff, first_low_quantile
\ No newline at end of file
+    return nc_pass, cutoff, first_low_quantile
+
+
+def _noise_cutoff_from_histogram(n, quantile_length, nc_threshold, percent_threshold):
+    """
+    Noise cutoff test on an amplitude histogram, called by noise_cutoff
+        and grouped_noise_cutoff
+
+    Returns fail_criteria, cutoff, first_low_quantile
+    """
+    cutoff = np.float64(np.nan)
+    first_low_quantile = np.float64(np.nan)
+    fail_criteria = np.ones(1).astype(bool)[0]
+
+    idx_peak = np.argmax(n)  # peak of amplitude distribution
+    # don't count zeros #len(n) - idx_peak, compute the length of the top half of the distribution -- ignoring zero bins
+    length_top_half = len(np.where(n[idx_peak:-1] > 0)[0])
+    # the remaining part of the distribution, which we will compare the low quantile to
+    high_quantile = 2 * quantile_length
+    # the first bin (index) of the high quantile part of the distribution
+    high_quantile_start_ind = int(np.ceil(high_quantile * length_top_half + idx_peak))
+    # bins to consider in the high quantile (of all non-zero bins)
+    indices_bins_high_quantile = np.arange(high_quantile_start_ind, len(n))
+    idx_use = np.where(n[indices_bins_high_quantile] >= 1)[0]
+
+    if len(n[indices_bins_high_quantile]) > 0:  # ensure there are amplitudes in these bins
+        # mean of all amp values in high quantile bins
+        mean_high_quantile = np.mean(n[indices_bins_high_quantile][idx_use])
+        std_high_quantile = np.std(n[indices_bins_high_quantile][idx_use])
+        if std_high_quantile > 0:
+            first_low_quantile = n[(n != 0)][1]  # take the second bin
+            cutoff = (first_low_quantile - mean_high_quantile) / std_high_quantile
+            peak_bin_height = np.max(n)
+            percent_of_peak = percent_threshold * peak_bin_height
+
+            fail_criteria = (cutoff > nc_threshold) & (first_low_quantile > percent_of_peak)
+
+    return fail_criteria, cutoff, first_low_quantile
+
+
+def grouped_noise_cutoff(sorted_amps, offsets, quantile_length=.25, n_bins=100, nc_threshold=5, percent_threshold=0.10):
+    """
+    noise_cutoff for all units, with the amplitude histograms of all units
+    computed in a single 2-D histogram pass.
+
+    Parameters
+    ----------
+    sorted_amps : ndarray_like
+        The amplitudes of all spikes, sorted by cluster.
+    offsets : ndarray_like
+        The amplitudes of unit i are sorted_amps[offsets[i]:offsets[i+1]].
+    (other parameters as in noise_cutoff)
+
+    Returns
+    -------
+    nc_pass : ndarray
+        nc_pass of each unit (False for units with fewer than 2 spikes)
+    """
+    total_units = offsets.size - 1
+    counts = np.diff(offsets)
+
+    nc_pass = np.zeros((total_units,), dtype=bool)
+
+    units = np.where(counts > 1)[0]
+    if units.size == 0:
+        return nc_pass
+
+    sorted_amps = np.asarray(sorted_amps, dtype=np.float64)
+    starts = offsets[units]
+    max_amps = np.maximum.reduceat(sorted_amps, starts)
+    min_amps = np.minimum.reduceat(sorted_amps, starts)
+
+    # the 2-D pass assumes bins from 0 to a positive maximum that contain every amplitude
+    regular = (min_amps >= 0) & (max_amps > 0)
+
+    for unit in units[np.invert(regular)]:
+        nc_pass[unit] = noise_cutoff(sorted_amps[offsets[unit]:offsets[unit+1]], quantile_length,
+                                     n_bins, nc_threshold, percent_threshold)[0]
+
+    units = units[regular]
+    starts = starts[regular]
+    max_amps = max_amps[regular]
+
+    if units.size == 0:
+        return nc_pass
+
+    # the same bin edges as np.linspace(0, np.max(amps), n_bins) for each unit
+    edges = np.linspace(0, max_amps, n_bins, axis=1)
+    num_bins = n_bins - 1
+
+    in_units = np.zeros((total_units,), dtype=bool)
+    in_units[units] = True
+    amps = sorted_amps[np.repeat(in_units, counts)]
+    rows = np.repeat(np.arange(units.size), counts[units])
+
+    # estimate the bin, then correct it against the edges, as np.histogram does;
+    # the last bin includes its right edge
+    indices = np.clip((amps / max_amps[rows] * num_bins).astype(np.intp), 0, num_bins - 1)
+    indices[amps < edges[rows, indices]] -= 1
+    increment = (amps >= edges[rows, indices + 1]) & (indices != num_bins - 1)
+    indices[increment] += 1
+
+    hist = np.reshape(np.bincount(rows * num_bins + indices, minlength=units.size * num_bins), (units.size, num_bins))
+
+    for idx, unit in enumerate(units):
+        nc_pass[unit] = ~_noise_cutoff_from_histogram(hist[idx], quantile_length, nc_threshold, percent_threshold)[0]
+
+    return nc_pass
@@ -4,21 +4,24 @@ import psutil
 from collections import OrderedDict
 
 import warnings
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
 
 from scipy.spatial.distance import cdist
+from scipy.linalg import solve_triangular, cho_factor, cho_solve
 from scipy.stats import chi2
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import special
 
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar, get_spike_depths
+from ...common.spike_index import SpikeIndex
+from ...common.utils import printProgressBar, get_spike_depths, get_majority_templates
 
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None, units_to_update = None, majority_templates = None, peak_channels = None):
 
     """ Calculate metrics for all units on one probe
 
@@ -40,13 +43,26 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         Templates to which the spikes are assigned
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
+        (can be memory-mapped; only the spikes used by each metric are read)
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
         Channel indices of PCs for each unit
     params : dict of parameters
         'isi_threshold' : minimum time for isi violations
         'tbin_sec' : time bin for ccg for contam_rate
+        'isi_threshold_sweep' : additional isi thresholds; each adds isi_viol, num_viol
+            and contam_rate columns (e.g. isi_viol_1ms), computed in the same pass
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    units_to_update : numpy.ndarray (optional)
+        If given, PC metrics (isolation distance, L-ratio, d-prime, nearest neighbors)
+        are only computed for these units, and are zero for all others
+    majority_templates : numpy.ndarray (optional)
+        Majority template of each unit over all spikes (e.g. from the artifact cache);
+        used for epochs that contain every spike instead of counting again
+    peak_channels : numpy.ndarray (optional)
+        Peak channel of each unit over all spikes, from calculate_peak_channels with
+        the majority templates; used for epochs that contain every spike instead of
+        reading the first PC of every spike again
 
     
     Outputs:
@@ -75,7 +91,13 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     print('total unite: ' + repr(total_units))
     
     template_ids = np.zeros((total_units,), dtype='uint16')
-    spike_templates = np.squeeze(spike_templates)
+
+    # spikes in time order, so each epoch is a contiguous slice
+    spike_index = SpikeIndex(spike_times, spike_clusters, total_units)
+    spike_times = spike_index.spike_times
+    spike_clusters = spike_index.spike_clusters
+    spike_templates = spike_index.sort(np.squeeze(spike_templates))
+    amplitudes = spike_index.sort(np.squeeze(amplitudes))
     
     
 #    earlier versions assumed num clusters = num templates
@@ -83,25 +105,33 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     
     total_epochs = len(epochs)
 
-    for epoch in epochs:
-
-        in_epoch = (spike_times >= epoch.start_time) * (spike_times <= epoch.end_time)
+    # the first threshold gives the standard columns, the rest are optional sweep columns
+    isi_thresholds = np.concatenate(([params['isi_threshold']], params.get('isi_threshold_sweep') or []))
 
-        print("Calculating isi violations")
-        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
-        
-        print("Calculating contamination rate")
-        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'])
+    for epoch in epochs:
 
-        print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        start, stop = spike_index.epoch_range(epoch)
+        in_epoch = slice(start, stop)
+        spike_order, unit_offsets = spike_index.grouped(start, stop)
+
+        # PC features are not copied per epoch; the metrics read them through this index
+        pc_index = spike_index.original_indices(start, stop)
+
+        print("Calculating isi violations, contamination rate, presence ratio, firing rate and amplitude cutoff")
+        isi_viol_sweep, num_viol_sweep, contam_rate_sweep, presence_ratio, firing_rate, amplitude_cutoff = \
+            calculate_spike_train_metrics(spike_times[in_epoch],
+                                          spike_clusters[in_epoch],
+                                          amplitudes[in_epoch],
+                                          total_units,
+                                          isi_thresholds,
+                                          params['min_isi'],
+                                          params['tbin_sec'],
+                                          spike_order = spike_order,
+                                          unit_offsets = unit_offsets)
+        isi_viol = isi_viol_sweep[:,0]
+        num_viol = num_viol_sweep[:,0]
+        contam_rate = contam_rate_sweep[:,0]
 
-        print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
-        
-        print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
-        
         if include_pc_metrics:
             
             # determine template this is the best match for each cluster id
@@ -109,10 +139,12 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
             template_ids = template_ids + total_units + 10  # unassigned template_ids out of range
             curr_spike_clusters = spike_clusters[in_epoch]
             curr_spike_templates = spike_templates[in_epoch]
-            curr_cluster_ids = np.unique(curr_spike_clusters)
-            for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
-                template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
+            curr_cluster_ids = np.where(np.diff(unit_offsets) > 0)[0]
+            whole_session = start == 0 and stop == spike_index.num_spikes
+            if majority_templates is not None and whole_session:
+                template_ids[curr_cluster_ids] = majority_templates[curr_cluster_ids]
+            else:
+                template_ids[curr_cluster_ids] = get_majority_templates(curr_spike_clusters, curr_spike_templates, total_units)[curr_cluster_ids]
 
             print("Calculating PC-based metrics")
             isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
@@ -120,22 +152,31 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                                                                                 total_units,
                                                                                                 curr_cluster_ids,
                                                                                                 template_ids,
-                                                                                                pc_features[in_epoch,:,:],
+                                                                                                pc_features,
                                                                                                 pc_feature_ind,
                                                                                                 channel_pos,
                                                                                                 params['max_radius_um'],
                                                                                                 params['max_spikes_for_unit'],
                                                                                                 params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+                                                                                                params['n_neighbors'],
+                                                                                                params['pc_metrics_workers'],
+                                                                                                params['pc_metrics_max_memory_gb'],
+                                                                                                params['random_seed'],
+                                                                                                pc_index,
+                                                                                                units_to_update,
+                                                                                                spike_order,
+                                                                                                unit_offsets,
+                                                                                                peak_channels if whole_session else None)
   
             print("Calculating silhouette score")
             nSpikes = spike_times[in_epoch].size
             the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
                                                        spike_templates[in_epoch],
                                                        total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
+                                                       pc_features,
                                                        pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
+                                                       min(nSpikes, params['n_silhouette']),
+                                                       pc_index)
 
 
             print("Calculating drift metrics")
@@ -144,11 +185,12 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                                        spike_templates[in_epoch],
                                                        template_ids,
                                                        total_units,
-                                                       pc_features[in_epoch,:,:],
+                                                       pc_features,
                                                        pc_feature_ind,
                                                        channel_pos,
                                                        params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+                                                       params['drift_metrics_min_spikes_per_interval'],
+                                                       pc_index)
         else:
             # fill in empty arrays for dataframe            
             isolation_distance = np.zeros((total_units,))
@@ -165,6 +207,13 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
         epoch_name = [epoch.name] * len(cluster_ids)
 
+        sweep_columns = []
+        for idx, threshold in enumerate(isi_thresholds[1:]):
+            suffix = '_' + format(threshold * 1000, 'g') + 'ms'
+            sweep_columns += [('isi_viol' + suffix, isi_viol_sweep[:,idx+1]),
+                              ('num_viol' + suffix, num_viol_sweep[:,idx+1]),
+                              ('contam_rate' + suffix, contam_rate_sweep[:,idx+1])]
+
         metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
                                 ('firing_rate' , firing_rate),
                                 ('presence_ratio' , presence_ratio),
@@ -181,7 +230,7 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                 ('max_drift', max_drift),
                                 ('cumulative_drift', cumulative_drift),
                                 ('epoch_name' , epoch_name),
-                                )))))
+                                ) + tuple(sweep_columns)))))
 
     return metrics 
 
@@ -191,13 +240,108 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
 # ===============================================================
 
+def calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units,
+                                  isi_threshold, min_isi, tbin_sec,
+                                  num_presence_bins = 100, num_amplitude_bins = 500,
+                                  spike_order = None, unit_offsets = None):
+
+    """ Calculate all metrics that depend only on spike times and amplitudes
+
+    Spikes are sorted by (cluster, time) once, and each metric is computed
+    from the contiguous per-cluster segments with segmented reductions. The
+    results are identical to calculate_isi_violations, calculate_contam_rate,
+    calculate_presence_ratio, calculate_firing_rate and calculate_amplitude_cutoff,
+    without building a full-length mask for every cluster.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    total_units : Int
+        Size of the output arrays (max cluster ID + 1)
+    isi_threshold : float or numpy.ndarray (num_thresholds x 0)
+        Maximum time (in seconds) for ISI violation; also the refractory period for contam_rate
+    min_isi : float
+        Minimum time (in seconds) for ISI violation
+    tbin_sec : float
+        Time bin in seconds for the ccg used in contam_rate
+    spike_order, unit_offsets : numpy.ndarray (optional)
+        Output of group_spikes_by_cluster (with spike_times), if already known
+
+    Outputs:
+    --------
+    isi_viol, num_viol, contam_rate, presence_ratio, firing_rate, amplitude_cutoff : numpy.ndarray (total_units x 0)
+        If isi_threshold is an array, isi_viol, num_viol and contam_rate are
+        (total_units x num_thresholds), computed from the same isis and autocorrelograms
+
+    """
+
+    spike_times = np.squeeze(spike_times)
+    spike_clusters = np.squeeze(spike_clusters)
+    amplitudes = np.squeeze(amplitudes)
+
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units, spike_times)
+    order, offsets = spike_order, unit_offsets
+    sorted_times = spike_times[order]
+    sorted_clusters = spike_clusters[order]
+    counts = np.diff(offsets)
+    cluster_ids = np.where(counts > 0)[0]
+
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+    duration = max_time - min_time
+
+    # firing rate
+    firing_rate = counts / duration
+
+    # presence ratio: mark every (cluster, time bin) pair that holds a spike
+    edges = np.linspace(min_time, max_time, num_presence_bins)
+    time_bin = np.searchsorted(edges, sorted_times, side='right') - 1
+    time_bin[time_bin == num_presence_bins - 1] = num_presence_bins - 2   # last bin includes the right edge
+    occupied = np.zeros((total_units, num_presence_bins - 1), dtype='bool')
+    occupied[sorted_clusters, time_bin] = True
+    presence_ratio = np.sum(occupied, 1) / num_presence_bins
+
+    # isi violations: drop duplicate spikes, then count short isis within each cluster
+    duplicate = np.zeros(sorted_times.shape, dtype='bool')
+    duplicate[1:] = (sorted_clusters[1:] == sorted_clusters[:-1]) & (np.diff(sorted_times) <= min_isi)
+    kept_times = sorted_times[~duplicate]
+    kept_clusters = sorted_clusters[~duplicate]
+    within_cluster = kept_clusters[1:] == kept_clusters[:-1]
+
+    num_spikes = np.bincount(kept_clusters, minlength=total_units)[cluster_ids]
+    num_viol = grouped_isi_violation_counts(np.diff(kept_times)[within_cluster], kept_clusters[1:][within_cluster],
+                                            total_units, isi_threshold)
+
+    isi_viol = np.zeros(num_viol.shape)
+    isi_viol[cluster_ids] = isi_fp_rate(num_viol[cluster_ids], num_spikes, duration, isi_threshold, min_isi)
+
+    # amplitude cutoff: one histogram row per cluster
+    amplitude_cutoff = np.zeros((total_units,))
+    if cluster_ids.size > 0:
+        amplitude_cutoff[cluster_ids] = grouped_amplitude_cutoff(amplitudes[order], offsets[cluster_ids], counts[cluster_ids], num_amplitude_bins)
+
+    # contamination rate: autocorrelograms of all units with more than 10 spikes in one pass
+    contam_rate = np.ones((total_units,) + np.shape(isi_threshold))
+    contam_ids = np.where(counts > 10)[0]
+    if contam_ids.size > 0:
+        contam_rate[contam_ids] = grouped_contamination_rate(sorted_times, offsets, contam_ids, tbin_sec, isi_threshold)
+
+    return isi_viol, num_viol, contam_rate, presence_ratio, firing_rate, amplitude_cutoff
+
+
 def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
 
     cluster_ids = np.unique(spike_clusters)
 
-    viol_rates = np.zeros((total_units,))
+    viol_rates = np.zeros((total_units,) + np.shape(isi_threshold))
     
-    num_viol =np.zeros((total_units,))
+    num_viol =np.zeros((total_units,) + np.shape(isi_threshold))
 
     for idx, cluster_id in enumerate(cluster_ids):
 
@@ -273,7 +417,7 @@ def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, re
 
     cluster_ids = np.unique(spike_clusters)
 
-    contam_rate = np.ones((total_units,))
+    contam_rate = np.ones((total_units,) + np.shape(refPer_sec))
 
     for idx, cluster_id in enumerate(cluster_ids):
 
@@ -298,169 +442,360 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         num_workers = 1,
+                         max_memory_gb = None,
+                         seed = None,
+                         pc_index = None,
+                         units_to_compute = None,
+                         spike_order = None,
+                         unit_offsets = None,
+                         peak_channels = None):
+
+    """ Calculate isolation distance, L-ratio, d-prime and nearest neighbor hit/miss rates
+
+    If pc_index is given, the PCs of spike i are pc_features[pc_index[i]];
+    pc_features can then be the full (memory-mapped) array for all spikes,
+    and only the spikes used for each unit are read from it.
+
+    With num_workers > 1, the probe is split into depth bands and each band
+    is computed in a separate process (see calculate_pc_metrics_sharded).
+    If seed is set, each unit draws its spike subsample from its own random
+    generator, seeded with (seed, cluster_id), so the serial and sharded
+    results are identical.
+
+    If units_to_compute is given, metrics are only calculated for those units
+    (a subset of cluster_ids); the other units are still used as neighbors.
+
+    spike_order and unit_offsets (from group_spikes_by_cluster) and
+    peak_channels (from calculate_peak_channels) are computed here if not given.
+
+    """
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
 #    half_spread = int((num_channels_to_compare - 1) / 2)
 
 
-    peak_channels = np.zeros((total_units,), dtype='uint16')
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units)
+
+    if peak_channels is None:
+        peak_channels = calculate_peak_channels(spike_clusters, total_units, cluster_ids, template_ids,
+                                                pc_features, pc_feature_ind, pc_index, spike_order, unit_offsets)
+
+    # neighbors are chosen among all cluster_ids, but only these units are computed
+    if units_to_compute is None:
+        units_to_compute = cluster_ids
+    else:
+        units_to_compute = np.intersect1d(cluster_ids, units_to_compute)
+
+    if num_workers > 1:
+        return calculate_pc_metrics_sharded(spike_clusters, spike_templates, total_units, units_to_compute,
+                                            template_ids, peak_channels, pc_features, pc_feature_ind,
+                                            channel_pos, max_radius_um, max_spikes_for_cluster,
+                                            max_spikes_for_nn, n_neighbors, num_workers, max_memory_gb, seed, pc_index)
+
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
-    
 
-# pc_feature_ind is NOT updated by phy during manual clustering
+    index = make_pc_metrics_index(spike_clusters, total_units, units_to_compute, template_ids, peak_channels,
+                                  pc_feature_ind, channel_pos, max_radius_um, spike_order, unit_offsets)
 
-    for idx, cluster_id in enumerate(cluster_ids):
-            
-        # individual pcs are stored for each spike, independent of cluster id
-        for_unit = np.squeeze(spike_clusters == cluster_id)
-        pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
-        
-        # pc_feature_ind are stored according to template, using the 
-        # most common template for spikes in this cluster in this epoch
-        peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
+    for idx, cluster_id in enumerate(units_to_compute):
 
-    for idx, cluster_id in enumerate(cluster_ids):
+        printProgressBar(idx + 1, len(units_to_compute))
 
-        
-        printProgressBar(idx + 1, len(cluster_ids))
+        isolation_distances[cluster_id], l_ratios[cluster_id], d_primes[cluster_id], \
+            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = \
+            unit_pc_metrics(cluster_id, index, spike_templates, peak_channels,
+                            pc_features, pc_feature_ind,
+                            max_spikes_for_cluster, max_spikes_for_nn, n_neighbors,
+                            unit_random_generator(seed, cluster_id), pc_index)
 
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+def calculate_pc_metrics_sharded(spike_clusters,
+                                 spike_templates,
+                                 total_units,
+                                 cluster_ids,
+                                 template_ids,
+                                 peak_channels,
+                                 pc_features,
+                                 pc_feature_ind,
+                                 channel_pos,
+                                 max_radius_um,
+                                 max_spikes_for_cluster,
+                                 max_spikes_for_nn,
+                                 n_neighbors,
+                                 num_workers,
+                                 max_memory_gb = None,
+                                 seed = None,
+                                 pc_index = None):
+
+    """ Calculate PC metrics in depth bands on a pool of worker processes
+
+    Units are assigned to depth bands by the y-position of their peak channel.
+    A unit is only compared with units whose peak channel lies within
+    max_radius_um, so each band is sent to a worker together with the spikes
+    of all units within max_radius_um of the band (the halo). At most
+    num_workers bands are in flight at once; the number of bands is doubled
+    until the PC features of num_workers bands fit within max_memory_gb.
+
+    A memory-mapped pc_features array is reopened by each worker, which then
+    reads only the spikes it uses, instead of being copied to the worker.
+
+    Outputs are the same as calculate_pc_metrics.
+
+    """
+
+    isolation_distances = np.zeros((total_units,))
+    l_ratios = np.zeros((total_units,))
+    d_primes = np.zeros((total_units,))
+    nn_hit_rates = np.zeros((total_units,))
+    nn_miss_rates = np.zeros((total_units,))
+
+    if len(cluster_ids) == 0:
+        return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates
+
+    spike_counts = np.bincount(spike_clusters, minlength=total_units)
+    bytes_per_spike = pc_features[0].nbytes
+
+    if isinstance(pc_features, np.memmap) and str(pc_features.filename).endswith('.npy'):
+        memmap_file = str(pc_features.filename)
+    else:
+        memmap_file = None
+
+    num_shards = num_workers
+    while True:
+        shards = make_depth_shards(cluster_ids, peak_channels, channel_pos, max_radius_um, num_shards)
+        shard_bytes = max([np.sum(spike_counts[halo]) for owned, halo in shards]) * bytes_per_spike
+        if max_memory_gb is None or shard_bytes * num_workers <= max_memory_gb * 1024**3:
+            break
+        if num_shards >= len(cluster_ids):
+            print('PC metrics shards exceed the memory limit, using ' + repr(num_shards) + ' shards')
+            break
+        num_shards = num_shards * 2
+
+    print('Calculating PC metrics in ' + repr(len(shards)) + ' depth bands with ' + repr(num_workers) + ' workers')
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        pending = set()
+        next_shard = 0
+        done_shards = 0
+
+        while next_shard < len(shards) or pending:
+
+            # only num_workers shards of spikes are copied at any one time
+            while next_shard < len(shards) and len(pending) < num_workers:
+                owned, halo = shards[next_shard]
+                in_shard = np.where(np.isin(spike_clusters, halo))[0]
+                if memmap_file is not None:
+                    shard_pcs = memmap_file
+                    shard_index = in_shard if pc_index is None else pc_index[in_shard]
+                else:
+                    shard_pcs = gather_pcs(pc_features, in_shard, pc_index)
+                    shard_index = None
+                pending.add(executor.submit(_pc_metrics_for_shard, owned,
+                                            spike_clusters[in_shard], spike_templates[in_shard],
+                                            template_ids, peak_channels, shard_pcs,
+                                            pc_feature_ind, channel_pos, max_radius_um,
+                                            max_spikes_for_cluster, max_spikes_for_nn, n_neighbors, seed,
+                                            shard_index))
+                next_shard += 1
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                owned, results = future.result()
+                isolation_distances[owned], l_ratios[owned], d_primes[owned], \
+                    nn_hit_rates[owned], nn_miss_rates[owned] = results
+                done_shards += 1
+                printProgressBar(done_shards, len(shards))
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates
+
+
+def _pc_metrics_for_shard(owned,
+                          spike_clusters,
+                          spike_templates,
+                          template_ids,
+                          peak_channels,
+                          pc_features,
+                          pc_feature_ind,
+                          channel_pos,
+                          max_radius_um,
+                          max_spikes_for_cluster,
+                          max_spikes_for_nn,
+                          n_neighbors,
+                          seed,
+                          pc_index):
+
+    # worker for calculate_pc_metrics_sharded; spikes are those of the shard and its halo
+    # pc_features is either the PCs of those spikes, or the path of a .npy file to memory-map
+
+    if isinstance(pc_features, str):
+        pc_features = np.load(pc_features, mmap_mode='r')
+
+    results = np.zeros((5, owned.size))
+
+    index = make_pc_metrics_index(spike_clusters, template_ids.size, owned, template_ids, peak_channels,
+                                  pc_feature_ind, channel_pos, max_radius_um)
+
+    for idx, cluster_id in enumerate(owned):
+        rng = unit_random_generator(seed, cluster_id)
+        if rng is np.random:
+            # forked workers share the parent's global random state
+            rng = np.random.default_rng()
+        results[:, idx] = unit_pc_metrics(cluster_id, index, spike_templates, peak_channels,
+                                          pc_features, pc_feature_ind, max_spikes_for_cluster,
+                                          max_spikes_for_nn, n_neighbors, rng, pc_index)
+
+    return owned, results
+
+
+def unit_pc_metrics(cluster_id,
+                    index,
+                    spike_templates,
+                    peak_channels,
+                    pc_features,
+                    pc_feature_ind,
+                    max_spikes_for_cluster,
+                    max_spikes_for_nn,
+                    n_neighbors,
+                    rng = np.random,
+                    pc_index = None):
+
+    """ PC metrics for one unit, compared with the units within max_radius_um of its peak channel
+
+    index is the output of make_pc_metrics_index for the same spikes
+
+    Outputs:
+    --------
+    isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate : float
+
+    """
             
-        peak_channel = peak_channels[cluster_id]
-        
-        # calculate distances from all channels to peak channel
-        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
-                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
-
-# OLDER calculatioon assuming linear array
-#        half_spread_down = peak_channel \
-#            if peak_channel < half_spread \
-#            else half_spread
-#
-#        half_spread_up = np.max(pc_feature_ind) - peak_channel \
-#            if peak_channel + half_spread > np.max(pc_feature_ind) \
-#            else half_spread
-
-        # which templates have pcs on the peak channel of the current unit?
-        # channel index -- which of the channel swithin the set for a single template -- i snot used
-        templates_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
-
-
-        # which units have these templates?       
-        units_for_channel = np.zeros((0,),dtype='uint16')
-        for j in templates_for_channel:
-            units_for_channel = np.append(units_for_channel, np.where(template_ids==j))
-                  
-               
-# OLDER calculatioon assuming linear array        
-#        units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
-#                       (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
-                        
-        
-        # of those units that have pc overlap, which have their peak channel 
-        # within range of the current unit?              
-        units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
-           
-            
-        # If there is at least one neighbor unit in range, compare pcs across 
-        # units for channels that overlap AND lie within maximum radius
-        
-        if len(units_in_range) > 1 :
+    peak_channel = peak_channels[cluster_id]
 
-            units_for_channel = np.asarray(units_for_channel[units_in_range])
-                    
+    # units with pc overlap on the peak channel of the current unit, 
+    # whose own peak channel is within range of the current unit
+    units_for_channel = index['unit_neighbors'][cluster_id]
+        
+    # If there is at least one neighbor unit in range, compare pcs across 
+    # units for channels that overlap AND lie within maximum radius
     
-# OLDER calculatioon assuming linear array
-#           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+    if units_for_channel.size > 1 :
+
+        channels_to_use = index['channel_neighbors'][peak_channel]
+
+        spike_counts = index['spike_counts'][units_for_channel]
             
-            channels_to_use = np.where(chan_dist < max_radius_um)[0]
+        this_unit_idx = np.where(units_for_channel == cluster_id)[0]
 
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-                
-            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
-            # calculate how many spikes from this unit will be used
-            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
-            else:
-                relative_counts = spike_counts
+        # calculate how many spikes from this unit will be used
+        if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+            relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+        else:
+            relative_counts = spike_counts
+        
+        all_pcs = []
+        all_labels = []
             
-            all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
-            all_labels = np.zeros((0,), dtype = 'int')
-                
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-    
+        for idx2, cluster_id2 in enumerate(units_for_channel):
+
 # if any manual curation as been done, the cluster ids are no longer identical to the template ids
 # That means we can't use a universal channelmask. Rather, we have to check for each spike what
 # channels are there (recorded in pc_feature_ind) and take those that are included in 
 # channels to use
-#                try:
-#                    channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
-#                except IndexError:
-#                    # Occurs when pc_feature_ind does not contain all channels of interest
-#                    # In that case, we will exclude this unit for the calculation
-#                    pass
-#                else:
-#                    subsample = int(relative_counts[idx2])
-#                    index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-#        
-#                    pcs = get_unit_pcs(pc_features, index_mask, channel_mask)
-#                    labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-#                    
-#                    all_pcs = np.concatenate((all_pcs, pcs),0)
-#                    all_labels = np.concatenate((all_labels, labels),0)
-                
-                subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                
-                pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
-                labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-
-                all_pcs = np.concatenate((all_pcs, pcs),0)
-                all_labels = np.concatenate((all_labels, labels),0) 
-                
-            all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
             
-            num_pcs = all_pcs.shape[0];
-#            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
-#            print(num_pcs_str)
+            subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
+            unit_spikes = index['spike_order'][index['unit_offsets'][cluster_id2]:index['unit_offsets'][cluster_id2+1]]
+            spike_inds = np.sort(unit_spikes[rng.permutation(unit_spikes.size)[:subsample]])
             
-            pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
-            pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
-        
-        else:
-            # no near neighbor units to compare
-            num_pcs = 0
-            pcs_for_this_unit = 0
-            pcs_for_other_units = 0
+            pcs = get_unit_pcs(pc_features, spike_inds, spike_templates, channels_to_use, pc_feature_ind, pc_index)
+            labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
+
+            all_pcs.append(pcs)
+            all_labels.append(labels)
+            
+        all_pcs = np.concatenate(all_pcs, 0)
+        all_labels = np.concatenate(all_labels, 0)
+
+        all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
         
+        num_pcs = all_pcs.shape[0];
         
-        if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
+        pcs_for_this_unit = np.sum(all_labels == cluster_id)
+        pcs_for_other_units = num_pcs - pcs_for_this_unit
+    
+    else:
+        # no near neighbor units to compare
+        num_pcs = 0
+        pcs_for_this_unit = 0
+        pcs_for_other_units = 0
+    
+    
+    if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+        isolation_distance, l_ratio, d_prime = whitened_pc_metrics(all_pcs, all_labels, cluster_id)
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+        nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+    else:
 
-        else:
+        # l_ratio is left at zero when there is nothing to compare
+        isolation_distance = np.nan
+        l_ratio = 0
+        d_prime = np.nan
+        nn_hit_rate = np.nan
+        nn_miss_rate = np.nan
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+    return isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
 
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+def calculate_peak_channels(spike_clusters,
+                            total_units,
+                            cluster_ids,
+                            template_ids,
+                            pc_features,
+                            pc_feature_ind,
+                            pc_index = None,
+                            spike_order = None,
+                            unit_offsets = None):
+
+    """ Peak channel of each unit, from the mean of its first PC on each channel
+
+    Outputs:
+    --------
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel for each unit (0 for units not in cluster_ids)
+
+    """
+
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units)
+
+    peak_channels = np.zeros((total_units,), dtype='uint16')
+
+# pc_feature_ind is NOT updated by phy during manual clustering
+
+    for idx, cluster_id in enumerate(cluster_ids):
+            
+        # individual pcs are stored for each spike, independent of cluster id
+        for_unit = spike_order[unit_offsets[cluster_id]:unit_offsets[cluster_id+1]]
+        pc_max = np.argmax(np.mean(gather_pcs(pc_features, for_unit, pc_index, pc = 0),0))
+        
+        # pc_feature_ind are stored according to template, using the 
+        # most common template for spikes in this cluster in this epoch
+        peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
+
+    return peak_channels
 
 
 def calculate_silhouette_score(spike_clusters,
@@ -468,50 +803,34 @@ def calculate_silhouette_score(spike_clusters,
                                  total_units,                                
                                  pc_features, 
                                  pc_feature_ind,
-                                 total_spikes):
+                                 total_spikes,
+                                 pc_index = None):
     
     # total_spikes = number of spikes to sample, given in the metrics params
+    # if pc_index is given, the PCs of spike i are pc_features[pc_index[i]]
 
     random_spike_inds = np.random.permutation(spike_clusters.size)
     random_spike_inds = random_spike_inds[:total_spikes]
     num_pc_features = pc_features.shape[1]
 
-    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
-
-    for idx, i in enumerate(random_spike_inds):
-        
-        # unit_id = spike_clusters[i]
-        
-        # look up channel using the template id for this spike
-        template_id = spike_templates[i]       
-        channels = pc_feature_ind[template_id,:]
-        
-        # fill pcs into the correct channels for this spike
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    # read only the sampled spikes
+    sample_pcs = gather_pcs(pc_features, random_spike_inds, pc_index)
 
-    cluster_labels = spike_clusters[random_spike_inds]
+    num_channels = np.max(pc_feature_ind)
 
-    cluster_ids = np.unique(cluster_labels)
+    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
+    all_pcs = np.zeros((random_spike_inds.size, num_channels * num_pc_features + 1))
 
-    SS = np.empty((total_units, total_units))
-    SS[:] = np.nan
+    # scatter the pcs of every spike into the columns of its template's channels,
+    # in the same (pc feature, channel) order as filling them one spike at a time
+    channels = pc_feature_ind[spike_templates[random_spike_inds], :]
+    columns = channels[:, np.newaxis, :] + num_channels * np.arange(num_pc_features)[np.newaxis, :, np.newaxis]
+    rows = np.broadcast_to(np.arange(random_spike_inds.size)[:, np.newaxis, np.newaxis], columns.shape)
+    all_pcs[rows, columns] = sample_pcs
 
-    for idx1, i in enumerate(cluster_ids):
+    cluster_labels = spike_clusters[random_spike_inds]
 
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                # positions of cluster labels = i or j
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+    SS = pairwise_silhouette_scores(all_pcs, cluster_labels, total_units)
 
     with warnings.catch_warnings():
       warnings.simplefilter("ignore")
@@ -530,7 +849,16 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            pc_index = None,
+                            chunk_size = 1000000,
+                            return_median_depths = False):
+
+    # if pc_index is given, the PCs of spike i are pc_features[pc_index[i]]
+    # spike depths are computed in chunks of chunk_size spikes, so only the first pc
+    # of chunk_size spikes is in memory at once
+    # if return_median_depths is True, the (total_units x intervals) matrix of median
+    # depths is returned as a third output (NaN where an interval has too few spikes)
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
@@ -555,52 +883,53 @@ def calculate_drift_metrics(spike_times,
     # make arrays of just those spikes for which the template matches the 
     # majority template for that cluster. These operations make copies of the
     # arrays.
-    m_spike_clusters = spike_clusters[match_maj]
-    m_spike_times = spike_times[match_maj]
+    match_inds = np.where(match_maj)[0]
+    m_spike_clusters = spike_clusters[match_inds]
+    m_spike_times = spike_times[match_inds]
     
-    # same for pc_features, but we only need the first pc for each
-    # this operation makes a copy of pc_features so original is not altered
-    m_pc_features_sq = np.squeeze(pc_features[match_maj,0,:]);
-    # set negative pc_features to zero before taking square
-    m_pc_features_sq[m_pc_features_sq < 0] = 0
-    # elementwise square
-    m_pc_features_sq = pow(m_pc_features_sq, 2) 
-    
-#    currmem = psutil.Process().memory_info().rss / (1024 * 1024)
-#    print("psutil memory info after copies: " + repr(currmem))
-    
-#    send only
+    depths = np.zeros((match_inds.size,))
+
+    for chunk_start in range(0, match_inds.size, chunk_size):
+
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+
+        # same for pc_features, but we only need the first pc for each
+        # this operation makes a copy of pc_features so original is not altered
+        m_pc_features_sq = gather_pcs(pc_features, match_inds[chunk], pc_index, pc = 0)
+        # set negative pc_features to zero before taking square
+        m_pc_features_sq[m_pc_features_sq < 0] = 0
+        # elementwise square
+        m_pc_features_sq = pow(m_pc_features_sq, 2) 
     
-    depths = get_spike_depths(m_spike_clusters, unit_template_ids, m_pc_features_sq, pc_feature_ind, channel_pos)
+        depths[chunk] = get_spike_depths(m_spike_clusters[chunk], unit_template_ids, m_pc_features_sq, pc_feature_ind, channel_pos)
     
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
+    num_intervals = interval_starts.size
 
     cluster_ids = np.unique(m_spike_clusters)
 
-    for idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(idx+1, len(cluster_ids))
-
-        in_cluster = m_spike_clusters == cluster_id
-        times_for_cluster = m_spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    # assign each spike to the interval it falls strictly inside of
+    interval_index = np.searchsorted(interval_starts, m_spike_times, side='right') - 1
+    in_interval = interval_index >= 0
+    in_interval[in_interval] = (m_spike_times[in_interval] > interval_starts[interval_index[in_interval]]) * \
+                               (m_spike_times[in_interval] < interval_ends[interval_index[in_interval]])
 
-        median_depths = []
+    median_depths = get_grouped_medians(depths[in_interval], 
+                                        m_spike_clusters[in_interval], 
+                                        interval_index[in_interval], 
+                                        total_units, 
+                                        num_intervals, 
+                                        min_spikes_per_interval)
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        max_drift[cluster_ids] = np.around(np.nanmax(median_depths[cluster_ids,:], 1) - \
+                                           np.nanmin(median_depths[cluster_ids,:], 1), 2)
+    cumulative_drift[cluster_ids] = np.around(np.nansum(np.abs(np.diff(median_depths[cluster_ids,:], axis=1)), 1), 2)
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+    if return_median_depths:
+        return max_drift, cumulative_drift, median_depths
 
     return max_drift, cumulative_drift
 
@@ -626,7 +955,7 @@ def isi_violations(spike_train, min_time, max_time, isi_threshold, min_isi=0):
     spike_train : array of spike times
     min_time : minimum time for potential spikes
     max_time : maximum time for potential spikes
-    isi_threshold : threshold for isi violation
+    isi_threshold : threshold for isi violation (or array of thresholds)
     min_isi : threshold for duplicate spikes
 
     Outputs:
@@ -636,6 +965,7 @@ def isi_violations(spike_train, min_time, max_time, isi_threshold, min_isi=0):
         A unit with some contamination has a fpRate < 0.5
         A unit with lots of contamination has a fpRate > 1.0
     num_violations : total number of violations
+        (both are arrays with one value per threshold if isi_threshold is an array)
 
     """
 
@@ -645,6 +975,16 @@ def isi_violations(spike_train, min_time, max_time, isi_threshold, min_isi=0):
     isis = np.diff(spike_train)
 
     num_spikes = len(spike_train)
+
+    if np.ndim(isi_threshold) > 0:
+        # all thresholds from the same isis
+        num_violations = grouped_isi_violation_counts(isis, np.zeros(isis.shape, dtype='int64'), 1, isi_threshold)[0]
+        violation_time = 2*num_spikes*(np.asarray(isi_threshold) - min_isi)
+        total_rate = firing_rate(spike_train, min_time, max_time)
+        c = num_violations/(violation_time*total_rate)
+        fpRate = np.ones(c.shape)
+        fpRate[c < 0.25] = (1 - np.sqrt(1-4*c[c < 0.25]))/2
+        return fpRate, num_violations
     num_violations = sum(isis < isi_threshold) 
     violation_time = 2*num_spikes*(isi_threshold - min_isi)
     total_rate = firing_rate(spike_train, min_time, max_time)
@@ -661,6 +1001,80 @@ def isi_violations(spike_train, min_time, max_time, isi_threshold, min_isi=0):
     return fpRate, num_violations
 
 
+def isi_fp_rate(num_violations, num_spikes, duration, isi_threshold, min_isi):
+
+    """ isi_violations false positive rate for many units (and thresholds) at once
+
+    Inputs:
+    -------
+    num_violations : numpy.ndarray (num_units x 0) or (num_units x num_thresholds)
+    num_spikes : numpy.ndarray (num_units x 0)
+        Number of spikes after removing duplicates
+    duration : float
+        Time over which the firing rate is calculated
+    isi_threshold : float or numpy.ndarray (num_thresholds x 0)
+    min_isi : float
+
+    Outputs:
+    --------
+    fp_rate : numpy.ndarray (same shape as num_violations)
+
+    """
+
+    if np.ndim(isi_threshold) > 0:
+        num_spikes = num_spikes[:, np.newaxis]
+
+    violation_time = 2*num_spikes*(np.asarray(isi_threshold) - min_isi)
+    total_rate = num_spikes / duration
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = num_violations/(violation_time*total_rate)
+    valid = c < 0.25
+    fp_rate = np.ones(c.shape)
+    fp_rate[valid] = (1 - np.sqrt(1-4*c[valid]))/2
+
+    return fp_rate
+
+
+def grouped_isi_violation_counts(isis, clusters, total_units, isi_threshold):
+
+    """ Number of isis shorter than each threshold, for every cluster
+
+    Each isi is placed once among the sorted thresholds, so any number of
+    thresholds costs a single pass over the isis.
+
+    Inputs:
+    -------
+    isis : numpy.ndarray (num_isis x 0)
+        Inter-spike intervals within clusters
+    clusters : numpy.ndarray (num_isis x 0)
+        Cluster ID of each isi
+    total_units : Int
+    isi_threshold : float or numpy.ndarray (num_thresholds x 0)
+
+    Outputs:
+    --------
+    num_viol : numpy.ndarray (total_units x 0) or (total_units x num_thresholds)
+
+    """
+
+    thresholds = np.atleast_1d(isi_threshold)
+    threshold_order = np.argsort(thresholds, kind='stable')
+    num_thresholds = thresholds.size
+
+    # an isi violates every threshold above the number of thresholds <= isi
+    position = np.searchsorted(thresholds[threshold_order], isis, side='right')
+    counts = np.bincount(clusters.astype('int64') * (num_thresholds + 1) + position,
+                         minlength=total_units * (num_thresholds + 1)).reshape((total_units, num_thresholds + 1))
+
+    num_viol = np.zeros((total_units, num_thresholds))
+    num_viol[:, threshold_order] = np.cumsum(counts, 1)[:, :num_thresholds]
+
+    if np.ndim(isi_threshold) == 0:
+        return num_viol[:, 0]
+
+    return num_viol
+
+
 
 def presence_ratio(spike_train, min_time, max_time, num_bins=100):
     """Calculate fraction of time the unit is present within an epoch.
@@ -856,6 +1270,104 @@ def lda_metrics(all_pcs, all_labels, this_unit_id):
 
 
 
+def whitened_pc_metrics(all_pcs, all_labels, this_unit_id, chunk_size = 65536):
+
+    """ Calculates isolation distance, L-ratio and d-prime from one whitening of the PCs
+
+    Gives the same results as mahalanobis_metrics and lda_metrics, without inverting
+    the covariance matrix or fitting an LDA model. The covariance of this unit's PCs is
+    factored once (Cholesky), and the PCs of the other spikes are whitened with
+    triangular solves, chunk_size spikes at a time. The squared norms of the
+    whitened PCs are the squared Mahalanobis distances; their mean and scatter
+    give the Fisher discriminant, since in whitened coordinates the scatter of
+    this unit is the identity matrix.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    this_unit_id : Int
+        number corresponding to unit for which these metrics will be calculated
+    chunk_size : Int
+        Number of spikes from other units that are whitened at once
+
+    Outputs:
+    --------
+    isolation_distance : float
+        Isolation distance of this unit
+    l_ratio : float
+        L-ratio for this unit
+    d_prime : float
+        d-prime for this unit
+
+    """
+
+    this_unit = all_labels == this_unit_id
+
+    pcs_for_this_unit = all_pcs[this_unit,:]
+    other_inds = np.where(np.invert(this_unit))[0]
+
+    n_this = pcs_for_this_unit.shape[0]
+    n_other = other_inds.size
+    dof = all_pcs.shape[1] # number of features
+
+    mean_value = np.mean(pcs_for_this_unit,0)
+
+    try:
+        L = np.linalg.cholesky(np.cov(pcs_for_this_unit.T))
+    except np.linalg.LinAlgError: # case of singular matrix
+        return np.nan, np.nan, lda_metrics(all_pcs, all_labels, this_unit_id)
+
+    mahalanobis_sq = np.zeros((n_other,))
+    whitened_sum = np.zeros((dof,))
+    whitened_scatter = np.zeros((dof, dof))
+
+    for chunk_start in range(0, n_other, chunk_size):
+
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+
+        # whitened offsets from the mean of this unit: L^-1 (x - mean)
+        W = solve_triangular(L, (all_pcs[other_inds[chunk],:] - mean_value).T, lower=True)
+
+        mahalanobis_sq[chunk] = np.einsum('ij,ij->j', W, W)
+        whitened_sum += np.sum(W, 1)
+        whitened_scatter += np.dot(W, W.T)
+
+    n = np.min([n_this, n_other]) # number of spikes
+
+    if n >= 2:
+
+        mahalanobis_other = np.sort(np.sqrt(mahalanobis_sq))
+
+        l_ratio = np.sum(1 - chi2.cdf(pow(mahalanobis_other,2), dof)) / mahalanobis_other.shape[0]
+        isolation_distance = pow(mahalanobis_other[n-1],2)
+
+    else:
+        l_ratio = np.nan 
+        isolation_distance = np.nan 
+
+    # Fisher discriminant in whitened coordinates: this unit has mean 0 and
+    # scatter (n_this - 1) * I, the other spikes have mean m and scatter S
+    m = whitened_sum / n_other
+    S = whitened_scatter - n_other * np.outer(m, m)
+
+    try:
+        w = cho_solve(cho_factor(S + (n_this - 1) * np.eye(dof)), -m)
+    except np.linalg.LinAlgError:
+        return isolation_distance, l_ratio, lda_metrics(all_pcs, all_labels, this_unit_id)
+
+    # mean and variance of the projections onto w
+    mean_difference = -np.dot(m, w)
+    var_this = np.dot(w, w) * (n_this - 1) / n_this
+    var_other = np.dot(w, np.dot(S, w)) / n_other
+
+    d_prime = mean_difference / np.sqrt(0.5 * (var_this + var_other))
+
+    return isolation_distance, l_ratio, d_prime
+
+
 def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_nn, n_neighbors):
 
     """ Calculates unit contamination based on NearestNeighbors search in PCA space
@@ -911,26 +1423,202 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
     
     return hit_rate, miss_rate
 
-# ==========================================================
-
-# HELPER FUNCTIONS:
-
-# ==========================================================
+def pairwise_silhouette_scores(X, labels, total_units, max_block_elements = 2**22):
 
-def make_index_mask(spike_clusters, unit_id, min_num, max_num):
+    """ Silhouette score of every pair of clusters, from one pass over the pairwise distances
 
-    """ Create a mask for the spike index dimensions of the pc_features array  
+    For each pair of clusters (i, j), the result equals sklearn.metrics.silhouette_score
+    applied to the samples labeled i or j. The distance from every sample to every 
+    other sample is computed once, in blocks of rows, and summed per cluster; the
+    two-cluster silhouette values of each sample are then derived from those sums.
 
     Inputs:
     -------
-    spike_clusters : numpy.ndarray (num_spikes x 0)
-        Contains cluster IDs for all spikes in pc_features array
-    unit_id : Int
+    X : numpy.ndarray (num_samples x num_features)
+        Feature vectors
+    labels : numpy.ndarray (num_samples x 0)
+        Cluster label of each sample
+    total_units : Int
+        Number of units (labels must be less than this)
+    max_block_elements : Int
+        Maximum size of the block of distances held in memory at once
+
+    Outputs:
+    --------
+    SS : numpy.ndarray (total_units x total_units)
+        Silhouette score of clusters i and j in SS[i,j] for j > i, NaN elsewhere
+
+    """
+
+    SS = np.empty((total_units, total_units))
+    SS[:] = np.nan
+
+    cluster_ids, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    num_clusters = cluster_ids.size
+
+    if num_clusters < 2:
+        return SS
+
+    # sort samples by cluster so that per-cluster sums are contiguous reductions
+    order = np.argsort(inverse, kind='stable')
+    X = np.asarray(X[order], dtype='float64')
+    inverse = inverse[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    squared_norms = np.einsum('ij,ij->i', X, X)
+
+    # sums of silhouette values of the samples in cluster i against cluster j
+    silhouette_sums = np.zeros((num_clusters, num_clusters))
+
+    num_samples = X.shape[0]
+    block_size = max(1, max_block_elements // max(num_samples, num_clusters))
+
+    for block_start in range(0, num_samples, block_size):
+
+        printProgressBar(min(block_start + block_size, num_samples), num_samples)
+
+        block = slice(block_start, min(block_start + block_size, num_samples))
+
+        distances = squared_norms[block, np.newaxis] - 2 * np.dot(X[block], X.T) + squared_norms[np.newaxis, :]
+        np.maximum(distances, 0, out=distances)
+        np.sqrt(distances, out=distances)
+        distances[np.arange(distances.shape[0]), np.arange(block.start, block.stop)] = 0
+
+        # summed distance from each sample in the block to each cluster
+        cluster_sums = np.add.reduceat(distances, starts, axis=1)
+
+        block_labels = inverse[block]
+        own_counts = counts[block_labels]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intra = cluster_sums[np.arange(cluster_sums.shape[0]), block_labels] / (own_counts - 1)
+            inter = cluster_sums / counts[np.newaxis, :]
+            silhouette = (inter - intra[:, np.newaxis]) / np.maximum(inter, intra[:, np.newaxis])
+
+        silhouette = np.nan_to_num(silhouette)
+        silhouette[own_counts == 1, :] = 0
+
+        # rows are sorted by cluster, so the block splits into contiguous runs
+        run_starts = np.concatenate(([0], np.where(np.diff(block_labels))[0] + 1))
+        silhouette_sums[block_labels[run_starts], :] += np.add.reduceat(silhouette, run_starts, axis=0)
+
+    pair_counts = counts[:, np.newaxis] + counts[np.newaxis, :]
+
+    i, j = np.triu_indices(num_clusters, 1)
+    valid = pair_counts[i, j] > 2
+    i, j = i[valid], j[valid]
+
+    SS[cluster_ids[i], cluster_ids[j]] = (silhouette_sums[i, j] + silhouette_sums[j, i]) / pair_counts[i, j]
+
+    return SS
+
+# ==========================================================
+
+# HELPER FUNCTIONS:
+
+# ==========================================================
+
+def unit_fingerprints(spike_clusters, total_units):
+
+    """ Fingerprint of the spikes assigned to each unit
+
+    Used to find the units whose membership changed between runs
+    (e.g. after merges and splits in phy).
+
+    Outputs:
+    --------
+    fingerprints : pandas.DataFrame
+        cluster_id, spike_count and member_hash (hash of the indices of the
+        unit's spikes) for each unit with spikes
+
+    """
+
+    spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units)
+    spike_counts = np.diff(unit_offsets)
+
+    cluster_ids = np.where(spike_counts > 0)[0]
+
+    member_hash = [hashlib.blake2b(spike_order[unit_offsets[i]:unit_offsets[i+1]].astype('<i8').tobytes(),
+                                   digest_size=16).hexdigest() for i in cluster_ids]
+
+    return pd.DataFrame(data = OrderedDict((('cluster_id', cluster_ids),
+                                            ('spike_count', spike_counts[cluster_ids]),
+                                            ('member_hash', member_hash))))
+
+
+def find_units_to_update(fingerprints, previous_fingerprints, channel_pos, max_radius_um):
+
+    """ Units whose PC metrics change after the membership of some units changed
+
+    A unit's PC metrics only depend on its own spikes and those of the units 
+    with a peak channel within max_radius_um, so units are updated if they
+    changed, or if a unit that changed (or was removed) was within range.
+
+    Inputs:
+    -------
+    fingerprints : pandas.DataFrame
+        Output of unit_fingerprints for the current data, with a peak_channel column
+    previous_fingerprints : pandas.DataFrame
+        The same, for the data the previous metrics were computed from
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    max_radius_um : Float
+        Radius used by the PC metrics
+
+    Outputs:
+    --------
+    units_to_update : numpy.ndarray
+        Cluster IDs whose PC metrics must be recomputed (including removed units)
+
+    """
+
+    merged = fingerprints.merge(previous_fingerprints, on='cluster_id', how='outer',
+                                suffixes=('', '_previous'), indicator=True)
+
+    changed = (merged['_merge'] != 'both') | \
+              (merged['spike_count'] != merged['spike_count_previous']) | \
+              (merged['member_hash'] != merged['member_hash_previous'])
+
+    current = (merged['_merge'] != 'right_only').values
+
+    # removed units are located at their previous peak channel
+    changed_channels = np.where(current, merged['peak_channel'].fillna(-1), merged['peak_channel_previous'].fillna(-1))
+    changed_channels = changed_channels[changed.values].astype('int')
+    changed_channels = changed_channels[changed_channels >= 0]
+
+    units_to_update = []
+
+    if changed_channels.size > 0:
+
+        peak_channels = fingerprints['peak_channel'].values.astype('int')
+
+        chan_dist = np.sqrt(np.square(channel_pos[peak_channels,0][:,np.newaxis] - channel_pos[changed_channels,0][np.newaxis,:]) + \
+                            np.square(channel_pos[peak_channels,1][:,np.newaxis] - channel_pos[changed_channels,1][np.newaxis,:]) )
+
+        in_range = np.any(chan_dist < max_radius_um, 1)
+
+        units_to_update = fingerprints['cluster_id'].values[in_range]
+
+    # removed units are included, so their previous metrics are not reused
+    return np.union1d(units_to_update, merged['cluster_id'][changed.values]).astype('int')
+
+
+def make_index_mask(spike_clusters, unit_id, min_num, max_num, rng = np.random):
+
+    """ Create a mask for the spike index dimensions of the pc_features array  
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Contains cluster IDs for all spikes in pc_features array
+    unit_id : Int
         ID for this unit
     min_num : Int
         Minimum number of spikes to return; if there are not enough spikes for this unit, return all False
     max_num : Int
         Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    rng : numpy.random.Generator or numpy.random (optional)
+        Source of the random subsample
 
     Output:
     -------
@@ -947,12 +1635,164 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
     else:
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
-        order = np.random.permutation(inds.size)
+        order = rng.permutation(inds.size)
         index_mask[inds[order[:max_num]]] = True
         
     return index_mask
 
 
+def unit_random_generator(seed, unit_id):
+
+    """ Random generator used to subsample the spikes of one unit
+
+    Returns the global numpy.random state if seed is None; otherwise a
+    generator seeded with (seed, unit_id), so a unit's subsample does not
+    depend on the order (or process) in which units are computed.
+
+    """
+
+    if seed is None:
+        return np.random
+    else:
+        return np.random.default_rng([seed, unit_id])
+
+
+def make_pc_metrics_index(spike_clusters, total_units, cluster_ids, template_ids, peak_channels,
+                          pc_feature_ind, channel_pos, max_radius_um, spike_order = None, unit_offsets = None):
+
+    """ Index of the spikes, templates and channels used by the PC metrics of each unit
+
+    Built once per run, so the work for each unit only depends on the size of
+    its neighborhood rather than on the total number of spikes.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int
+        Number of cluster IDs (max cluster ID + 1)
+    cluster_ids : numpy.ndarray
+        Units for which neighbor lists are built
+    template_ids : numpy.ndarray (total_units x 0)
+        Template used for the channels of each unit
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel of each unit
+    pc_feature_ind : numpy.ndarray (num_templates x num_channels)
+        Channels used for PC calculation for each template
+    channel_pos : numpy.ndarray (num_channels x 2)
+        x and y position of each channel
+    max_radius_um : Float
+        Units and channels within this distance of a unit's peak channel are used
+    spike_order, unit_offsets : numpy.ndarray (optional)
+        Output of group_spikes_by_cluster, if already computed
+
+    Outputs:
+    --------
+    index : dict
+        spike_order, unit_offsets : spikes of unit i are spike_order[unit_offsets[i]:unit_offsets[i+1]]
+        spike_counts : number of spikes for each unit
+        channel_templates, channel_offsets : templates with PCs on channel c are 
+            channel_templates[channel_offsets[c]:channel_offsets[c+1]]
+        template_units, template_offsets : units with template j are 
+            template_units[template_offsets[j]:template_offsets[j+1]]
+        channel_neighbors : list of the channels within max_radius_um of each channel
+        unit_neighbors : dict of the units that are compared with each unit in cluster_ids
+
+    """
+
+    if spike_order is None:
+        spike_order, unit_offsets = group_spikes_by_cluster(spike_clusters, total_units)
+
+    num_templates, channels_per_template = pc_feature_ind.shape
+    num_channels = max(channel_pos.shape[0], np.max(pc_feature_ind) + 1)
+
+    # channel -> templates, in the order they appear in pc_feature_ind
+    flat_channels = pc_feature_ind.flatten()
+    order = np.argsort(flat_channels, kind='stable')
+    channel_templates = order // channels_per_template
+    channel_offsets = np.zeros((num_channels + 1,), dtype='int64')
+    channel_offsets[1:] = np.cumsum(np.bincount(flat_channels, minlength=num_channels))
+
+    # template -> units
+    template_units = np.argsort(template_ids, kind='stable')
+    template_offsets = np.searchsorted(template_ids[template_units], np.arange(num_templates + 1))
+
+    # distances between all channels
+    chan_dist = np.sqrt(np.square(channel_pos[:,0][np.newaxis,:] - channel_pos[:,0][:,np.newaxis]) + \
+                        np.square(channel_pos[:,1][np.newaxis,:] - channel_pos[:,1][:,np.newaxis]) )
+
+    channel_neighbors = [np.where(d < max_radius_um)[0] for d in chan_dist]
+
+    unit_neighbors = {}
+
+    for cluster_id in cluster_ids:
+
+        peak_channel = peak_channels[cluster_id]
+
+        # which units have templates with pcs on the peak channel of this unit?
+        templates_for_channel = channel_templates[channel_offsets[peak_channel]:channel_offsets[peak_channel+1]]
+        units_for_channel = np.concatenate([np.zeros((0,), dtype='int64')] + \
+                                           [template_units[template_offsets[j]:template_offsets[j+1]] 
+                                            for j in templates_for_channel])
+
+        # of those units, which have their peak channel within range?
+        units_in_range = np.where(chan_dist[peak_channel, peak_channels[units_for_channel]] < max_radius_um)[0]
+
+        unit_neighbors[cluster_id] = units_for_channel[units_in_range]
+
+    return {'spike_order' : spike_order,
+            'unit_offsets' : unit_offsets,
+            'spike_counts' : np.diff(unit_offsets),
+            'channel_templates' : channel_templates,
+            'channel_offsets' : channel_offsets,
+            'template_units' : template_units,
+            'template_offsets' : template_offsets,
+            'channel_neighbors' : channel_neighbors,
+            'unit_neighbors' : unit_neighbors}
+
+
+def make_depth_shards(cluster_ids, peak_channels, channel_pos, max_radius_um, num_shards):
+
+    """ Split units into depth bands for sharded PC metrics
+
+    Inputs:
+    -------
+    cluster_ids : numpy.ndarray
+        Units to compute
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel for every cluster ID
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    max_radius_um : float
+        Halo added above and below each band
+    num_shards : Int
+        Number of equal-height bands
+
+    Output:
+    -------
+    shards : list of (owned, halo) tuples
+        owned : cluster IDs whose peak channel lies in the band
+        halo : all cluster IDs whose peak channel lies within max_radius_um of the band
+
+    """
+
+    depth = channel_pos[peak_channels, 1]
+    owned_depth = depth[cluster_ids]
+    edges = np.linspace(np.min(owned_depth), np.max(owned_depth), num_shards + 1)
+    band = np.clip(np.searchsorted(edges, owned_depth, side='right') - 1, 0, num_shards - 1)
+
+    all_units = np.arange(peak_channels.size)
+
+    shards = []
+    for b in range(num_shards):
+        owned = cluster_ids[band == b]
+        if owned.size > 0:
+            halo = all_units[(depth >= edges[b] - max_radius_um) & (depth <= edges[b+1] + max_radius_um)]
+            shards.append((owned, halo))
+
+    return shards
+
+
 def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 
     """ Create a mask for the channel dimension of the pc_features array  
@@ -978,6 +1818,221 @@ def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 
     return np.array(channel_mask)
 
+
+def group_spikes_by_cluster(spike_clusters, total_units, spike_times = None):
+
+    """ Order spikes by cluster (and by time within each cluster)
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int
+        Number of cluster IDs (max cluster ID + 1)
+    spike_times : numpy.ndarray (num_spikes x 0) (optional)
+        Spike times; if given, spikes within a cluster are sorted by time
+
+    Outputs:
+    --------
+    order : numpy.ndarray (num_spikes x 0)
+        Indices that sort the spikes by (cluster, time)
+    offsets : numpy.ndarray (total_units + 1 x 0)
+        Spikes of cluster i are order[offsets[i]:offsets[i+1]]
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters)
+
+    if spike_times is None or np.all(spike_times[1:] >= spike_times[:-1]):
+        # spike times are already sorted, a stable sort keeps them in order
+        order = np.argsort(spike_clusters, kind='stable')
+    else:
+        order = np.lexsort((spike_times, spike_clusters))
+
+    offsets = np.zeros((total_units + 1,), dtype='int64')
+    offsets[1:] = np.cumsum(np.bincount(spike_clusters, minlength=total_units))
+
+    return order, offsets
+
+
+def grouped_histogram(values, starts, counts, num_bins):
+
+    """ Equal-width histograms of many contiguous segments of an array in one pass
+
+    Each segment is binned over its own [min, max] range, exactly as
+    np.histogram(segment, num_bins) would bin it.
+
+    Inputs:
+    -------
+    values : numpy.ndarray (N x 0)
+        Values, grouped into contiguous segments
+    starts : numpy.ndarray (num_segments x 0)
+        Index of the first value of each (non-empty) segment
+    counts : numpy.ndarray (num_segments x 0)
+        Number of values in each segment
+    num_bins : Int
+        Number of bins per segment
+
+    Outputs:
+    --------
+    hist : numpy.ndarray (num_segments x num_bins)
+        Counts per bin for each segment
+    edges : numpy.ndarray (num_segments x num_bins + 1)
+        Bin edges for each segment
+
+    """
+
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype('float64')
+
+    rows = np.repeat(np.arange(starts.size), counts)
+
+    first_edge = np.minimum.reduceat(values, starts)
+    last_edge = np.maximum.reduceat(values, starts)
+    # expand empty ranges to avoid divide by zero
+    flat = first_edge == last_edge
+    first_edge[flat] = first_edge[flat] - 0.5
+    last_edge[flat] = last_edge[flat] + 0.5
+
+    edges = np.linspace(first_edge, last_edge, num_bins + 1, axis=1, dtype=values.dtype)
+
+    # same index calculation and edge corrections as np.histogram
+    indices = (((values - first_edge[rows]) / (last_edge - first_edge)[rows]) * num_bins).astype(np.intp)
+    indices[indices == num_bins] -= 1
+    indices[values < edges[rows, indices]] -= 1
+    increment = (values >= edges[rows, indices + 1]) & (indices != num_bins - 1)
+    indices[increment] += 1
+
+    hist = np.bincount(rows * num_bins + indices, minlength=starts.size * num_bins)
+
+    return np.reshape(hist, (starts.size, num_bins)), edges
+
+
+def grouped_amplitude_cutoff(amplitudes, starts, counts, num_histogram_bins = 500, histogram_smoothing_value = 3):
+
+    """ Calculate amplitude_cutoff for many units at once
+
+    Inputs:
+    -------
+    amplitudes : numpy.ndarray (N x 0)
+        Amplitudes grouped by unit into contiguous segments
+    starts : numpy.ndarray (num_units x 0)
+        Index of the first spike of each unit
+    counts : numpy.ndarray (num_units x 0)
+        Number of spikes for each unit (all > 0)
+
+    Output:
+    -------
+    fraction_missing : numpy.ndarray (num_units x 0)
+        Fraction of missing spikes (0-0.5) for each unit
+
+    """
+
+    h, b = grouped_histogram(amplitudes, starts, counts, num_histogram_bins)
+
+    # density, as in np.histogram(density=True)
+    h = h / np.array(np.diff(b, axis=1), float) / np.sum(h, 1, keepdims=True)
+
+    pdf = gaussian_filter1d(h, histogram_smoothing_value, axis=1)
+    support = b[:, :-1]
+
+    peak_index = np.argmax(pdf, 1)
+    distance = np.abs(pdf - pdf[:, :1])
+    distance[np.arange(num_histogram_bins) < peak_index[:, np.newaxis]] = np.inf
+    G = np.argmin(distance, 1)
+
+    # the tail sums and bin sizes are taken row by row so that the summation
+    # order (and result) matches amplitude_cutoff exactly
+    fraction_missing = np.array([np.sum(pdf[i, G[i]:]) * np.mean(np.diff(support[i])) for i in range(G.size)])
+
+    return np.minimum(fraction_missing, 0.5)
+
+def get_grouped_medians(values, groups, bins, num_groups, num_bins, min_count):
+
+    """ Median of values for every (group, bin) combination, from a single sort
+
+    Inputs:
+    -------
+    values : numpy.ndarray
+        Values to take medians of
+    groups : numpy.ndarray
+        Group index of each value (less than num_groups)
+    bins : numpy.ndarray
+        Bin index of each value (less than num_bins)
+    num_groups : Int
+        Number of rows in the output
+    num_bins : Int
+        Number of columns in the output
+    min_count : Int
+        Minimum number of values for a median to be computed
+
+    Outputs:
+    --------
+    medians : numpy.ndarray (num_groups x num_bins)
+        Median for each group and bin, NaN where there are fewer than min_count values
+
+    """
+
+    medians = np.empty((num_groups, num_bins))
+    medians[:] = np.nan
+
+    # sort by (group, bin) and then by value, so each segment is a sorted run
+    order = np.lexsort((values, bins, groups))
+    values = values[order]
+    segments = groups[order].astype('int64') * num_bins + bins[order]
+
+    segment_ids, starts, counts = np.unique(segments, return_index=True, return_counts=True)
+
+    enough = counts >= max(min_count, 1)
+    segment_ids, starts, counts = segment_ids[enough], starts[enough], counts[enough]
+
+    lower = values[starts + (counts - 1) // 2]
+    upper = values[starts + counts // 2]
+
+    medians.flat[segment_ids] = (lower + upper) / 2
+
+    return medians
+
+
+def gather_pcs(pc_features, spike_inds, pc_index = None, pc = None):
+
+    """ Read the PC features of a subset of spikes
+
+    Rows are read in increasing order, so a memory-mapped pc_features
+    array is traversed sequentially, and returned in the order of spike_inds.
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray or numpy.memmap (num_spikes x num_PCs x num_channels)
+        PC features
+    spike_inds : numpy.ndarray (int)
+        Spikes to read
+    pc_index : numpy.ndarray (optional)
+        Row of pc_features for each spike, if not the spike index itself
+    pc : Int (optional)
+        Read only this PC
+
+    Output:
+    -------
+    pcs : numpy.ndarray
+        (len(spike_inds) x num_PCs x num_channels), or (len(spike_inds) x num_channels) if pc is set
+
+    """
+
+    rows = spike_inds if pc_index is None else pc_index[spike_inds]
+
+    if rows.size > 1 and np.any(np.diff(rows) < 0):
+        order = np.argsort(rows)
+        pcs = np.empty((rows.size,) + (pc_features.shape[1:] if pc is None else pc_features.shape[2:]), dtype=pc_features.dtype)
+        pcs[order] = gather_pcs(pc_features, rows[order], pc = pc)
+        return pcs
+
+    if pc is None:
+        return np.asarray(pc_features[rows])
+    else:
+        return np.asarray(pc_features[rows, pc])
+
+
 # original version, which assumes a fixed channel mask for all spikes in a cluster
 # true only if no curation has happened in phy
 #def get_unit_pcs(these_pc_features, index_mask, channel_mask):
@@ -1006,7 +2061,7 @@ def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 #    
 #    return unit_PCs
     
-def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind):
+def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind, pc_index = None):
 
     """ Use the index_mask and channel_mask to return PC features for one unit 
 
@@ -1014,10 +2069,12 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask for spike index dimension of pc_features array, or the sorted spike indices
     channel_mask : numpy.ndarray (boolean)
         Mask for channel index dimension of pc_features array
+    pc_index : numpy.ndarray (optional)
+        Row of these_pc_features for each spike, if not the spike index itself
 
     Output:
     -------
@@ -1026,20 +2083,26 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
     """
 
+    if index_mask.dtype == bool:
+        spike_inds = np.where(index_mask)[0]
+    else:
+        spike_inds = index_mask
+
     # start with an empty 3D array
     [nspike,npcs,nchan] = these_pc_features.shape
     
     nchan_to_use = channels_to_use.shape[0]
 
-    unit_PCs = np.zeros((0,npcs,nchan_to_use))
+    unit_PCs = np.zeros((spike_inds.size,npcs,nchan_to_use))
+    num_filled = 0
     
     # get list of templates included in this cluster
     # for data with no curation, there will just be one value   
-    template_ids = np.unique(spike_templates[index_mask])
+    templates_for_spikes = spike_templates[spike_inds]
+    template_ids = np.unique(templates_for_spikes)
     
     # for each template id, create a channel mask (if possible) and extract templates
     for tid in template_ids:
-        curr_idx = index_mask & (spike_templates == tid)
         try:
             channel_mask = make_channel_mask(tid, pc_feature_ind, channels_to_use)            
         except IndexError:
@@ -1047,18 +2110,235 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
             # In that case, we will exclude this unit for the calculation
             pass
         else:
-            curr_pcs = these_pc_features[curr_idx,:,:]
-            curr_pcs = curr_pcs[:,:,channel_mask]
-            unit_PCs = np.append(unit_PCs,curr_pcs,axis=0)
+            curr_pcs = gather_pcs(these_pc_features, spike_inds[templates_for_spikes == tid], pc_index)
+            unit_PCs[num_filled:num_filled + curr_pcs.shape[0]] = curr_pcs[:,:,channel_mask]
+            num_filled += curr_pcs.shape[0]
     
-    return unit_PCs
+    return unit_PCs[:num_filled]
+
+
+def _shifted_pairs(values, groups, in_window):
+
+    """ Walk over pairs of spikes (i, i + shift) in a grouped, sorted stream
+
+    For each shift (1, 2, ...), yields the indices i for which spike i and
+    spike i + shift belong to the same group and in_window(values[i], values[i + shift])
+    is True. Because values are sorted within each group, a pair that falls
+    outside the window cannot come back at a larger shift, so the loop stops
+    once no pair is left and the total work is proportional to the number of
+    pairs inside the window.
+
+    """
+
+    first = np.arange(values.size - 1)
+    shift = 1
+
+    while first.size > 0:
+        second = first + shift
+        keep = (groups[first] == groups[second]) & in_window(values[first], values[second])
+        first = first[keep]
+        yield shift, first
+        shift += 1
+        first = first[first + shift < values.size]
+
+
+def ccg_counts(st1, st2, nbins, tbin, max_pairs = 2**22):
+
+    """ Crosscorrelogram histogram between two sorted spike trains
+
+    Same binning as the loop in Kilosort2: every spike in st1 within
+    (st2[j] - dt, st2[j] + dt) of a spike st2[j] is counted in bin
+    round((st2[j] - st1[k]) / tbin), with dt = nbins * tbin. The window of
+    each spike in st2 is found with searchsorted, and pairs are binned with
+    bincount in chunks of at most max_pairs.
+
+    Inputs:
+    -------
+    st1, st2 : numpy.ndarray
+        Sorted spike times in seconds
+    nbins : Int
+        Histogram has 2*nbins + 1 bins
+    tbin : float
+        Bin width in seconds
+
+    Output:
+    -------
+    K : numpy.ndarray (2*nbins + 1 x 0)
+        ccg histogram, zero lag at K[nbins]
+
+    """
+
+    dt = nbins*tbin
+
+    ilow = np.searchsorted(st1, st2 - dt, side='right')
+    ihigh = np.searchsorted(st1, st2 + dt, side='left')
+    n_pairs = np.maximum(ihigh - ilow, 0)
+    last_pair = np.cumsum(n_pairs)
+
+    K = np.zeros((2*nbins+1,))
+
+    j0 = 0
+    while j0 < st2.size:
+        first_pair = last_pair[j0] - n_pairs[j0]
+        j1 = max(np.searchsorted(last_pair, first_pair + max_pairs, side='right'), j0 + 1)
+        j = np.repeat(np.arange(j0, j1), n_pairs[j0:j1])
+        k = ilow[j] + np.arange(j.size) - (last_pair[j] - n_pairs[j] - first_pair)
+        ibin = np.round((st2[j] - st1[k])/tbin).astype('int64')
+        K += np.bincount(ibin + nbins, minlength=2*nbins+1)
+        j0 = j1
+
+    return K
+
+
+def grouped_autocorrelograms(sorted_times, sorted_clusters, total_units, nbins, tbin):
+
+    """ Autocorrelograms for many units in one call
+
+    Uses the same binning as ccg(st, st, nbins, tbin, True) for each unit,
+    with the self-found spikes already removed from the zero bin.
+
+    Inputs:
+    -------
+    sorted_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds, sorted by (cluster, time)
+    sorted_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each spike in sorted_times
+    total_units : Int
+        Number of rows in the output (max cluster ID + 1)
+    nbins : Int
+        Histograms have 2*nbins + 1 bins
+    tbin : float
+        Bin width in seconds
+
+    Output:
+    -------
+    K : numpy.ndarray (total_units x 2*nbins + 1)
+        acg histogram for each cluster ID
+
+    """
+
+    dt = nbins*tbin
+    width = 2*nbins + 1
+
+    K = np.zeros((total_units*width,))
+
+    for shift, first in _shifted_pairs(sorted_times, sorted_clusters,
+                                       lambda early, late: (late < early + dt) | (early > late - dt)):
+        early = sorted_times[first]
+        late = sorted_times[first + shift]
+        offset = sorted_clusters[first]*width + nbins
+
+        # each pair is seen once from each of its spikes, with the window test
+        # and lag computed as in the loop over the second spike train
+        m = early > late - dt
+        K += np.bincount(offset[m] + np.round((late[m] - early[m])/tbin).astype('int64'), minlength=K.size)
+        m = late < early + dt
+        K += np.bincount(offset[m] + np.round((early[m] - late[m])/tbin).astype('int64'), minlength=K.size)
+
+    return np.reshape(K, (total_units, width))
+
+
+def grouped_lag_histograms(sorted_samples, sorted_clusters, total_units, bin_size, max_bin):
+
+    """ One-sided lag histograms for many units in one call (lag-window mode)
+
+    Counts, for every pair of spikes of the same unit, the lag of the later
+    spike in bins of bin_size samples, up to max_bin. This matches the
+    diagonal of phylib.stats.correlograms(..., symmetrize=False), which is
+    the autocorrelogram used by slidingRP_viol.
+
+    Inputs:
+    -------
+    sorted_samples : numpy.ndarray (num_spikes x 0)
+        Integer spike times in samples, sorted by (cluster, time)
+    sorted_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each spike
+    total_units : Int
+        Number of rows in the output (max cluster ID + 1)
+    bin_size : Int
+        Bin width in samples
+    max_bin : Int
+        Largest lag bin to count
+
+    Output:
+    -------
+    counts : numpy.ndarray (total_units x max_bin + 1)
+        Number of spike pairs in each lag bin for each cluster ID
+
+    """
+
+    width = max_bin + 1
+
+    counts = np.zeros((total_units*width,), dtype='int64')
+
+    for shift, first in _shifted_pairs(sorted_samples, sorted_clusters,
+                                       lambda early, late: (late - early) // bin_size <= max_bin):
+        lag = (sorted_samples[first + shift] - sorted_samples[first]) // bin_size
+        counts += np.bincount(sorted_clusters[first]*width + lag, minlength=counts.size)
+
+    return np.reshape(counts, (total_units, width))
+
+
+def ccg_statistics(K, n_st1, n_st2, T, nbins, tbin):
+
+    """ Refractoriness statistics from one or more correlograms
+
+    Inputs:
+    -------
+    K : numpy.ndarray (num_units x 2*nbins + 1)
+        ccg histograms
+    n_st1, n_st2 : numpy.ndarray (num_units x 0)
+        number of spikes in each spike train
+    T : numpy.ndarray (num_units x 0)
+        time spanned by the spike trains
+
+    Outputs:
+    --------
+    Qi : numpy.ndarray (num_units x 11)
+    Q00 : numpy.ndarray (num_units x 0)
+    Q01 : numpy.ndarray (num_units x 0)
+    Ri : numpy.ndarray (num_units x 11)
+
+    """
+
+    irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
+    irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
+    irange3 = np.arange(nbins+10, nbins+50)  # 40 channels to positive side of peak
+
+    # Normalize the firing rate in the shoulders by the mean firing rate
+    # A Poisson process has a flat ACG (equal numbers of spikes at all ISIs) and these ratios would = 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_firing_rate = n_st2/T
+        Q00 = (np.sum(K[:,irange1],1)/(n_st1 * tbin * len(irange1)))/mean_firing_rate
+        Q01_neg = (np.sum(K[:,irange2],1)/(n_st1 * tbin * len(irange2)))/mean_firing_rate
+        Q01_pos = (np.sum(K[:,irange3],1)/(n_st1 * tbin * len(irange3)))/mean_firing_rate
+        Q01 = np.where(Q01_pos > Q01_neg, Q01_pos, Q01_neg)
+
+        # Calculate "refractoriness for periods from 1*tbin to 10*tbin
+        Qi = np.zeros((K.shape[0], 11))
+        Ri = np.zeros((K.shape[0], 11))
+        for i in range(1,11):
+            irange = np.arange(nbins-i,nbins+i)
+            Qi[:,i] = (np.sum(K[:,irange],1)/(n_st1 * (2*i+1)*tbin))/mean_firing_rate    #rate in this time period/mean rate
+
+            # Marius note: this is tricky: we approximate the Poisson likelihood with a gaussian of equal mean and variance
+            # that allows us to integrate the probability that we would see <N spikes in the center of the
+            # cross-correlogram from a distribution with mean R00*i spikes
+
+            # this calculation is done in KS2 but never used
+            # n = sum(K[irange])/2
+            # lam = R00 + i
+            # Ri[i] =  1/2 * (1+ special.erf((n - lam)/np.sqrt(2*lam)))
+
+    return Qi, Q00, Q01, Ri
 
 
 def ccg(st1, st2, nbins, tbin, auto):
     
     """ calculate crosscorrelogram between two sets of spike times (st1, st2)
         in seconds, with bin width tbin, time lags = plus/minus nbins.
-        Algorithm from Kilosort2, written by Marius Pachitariu
+        Algorithm from Kilosort2, written by Marius Pachitariu;
+        pairs are found with searchsorted and binned with bincount (see ccg_counts)
         
     st1 : spike times for set #1 in sec
     st2 : spike times for set #2 in sec
@@ -1073,86 +2353,24 @@ def ccg(st1, st2, nbins, tbin, auto):
     Q01
     
     """
-    # print('ccg num spikes = ' + repr(len(st1)))
     st1 = np.sort(np.squeeze(st1))
     st2 = np.sort(np.squeeze(st2))
     
-    dt = nbins*tbin  # cross correlogram spans -dt-dt
-    
     T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
     
-    # traverse both spike trains together, keeping track of the spikes in the first
-    # spike train that are within dt of the second spike train
-    ilow = 0
-    ihigh = 0
-    j = 0
-    
     n_st2 = len(st2)
     n_st1 = len(st1)
     
-    K = np.zeros((2*nbins+1,))
-    
-    while j < n_st2:                      # walk over all spikes in 2nd spike train
-        while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):            
-            ihigh = ihigh + 1             # increase upper bound until its outisde the dt range
-        while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
-            ilow = ilow + 1                # increase lower bound until it is inside the dt range
-        if ilow > n_st1:
-            break
-        if st1[ilow] > st2[j] + dt:
-            # if the lower bound is actually outside of the dt range, means
-            # there were no spikes in range of the ccg
-            # just move on to next spike st2
-            j = j + 1
-            continue
-        for k in range(ilow,ihigh):
-            # for all spikes within the plus/minus dt range
-            ibin = int(np.round((st2[j]-st1[k])/tbin))    # calculate which bin
-            K[ibin + nbins] = K[ibin + nbins] + 1    # increment corresponding bin in correlogram
-        j = j + 1   # go to next spike in st2
+    K = ccg_counts(st1, st2, nbins, tbin)
         
     if auto:
-        # print('nspikes, zero bin: ' + repr(n_st1) + ', ' + repr(K[nbins]))
         # if this is an autocorrelogram, remove the self-found spikes from the zero bin
         K[nbins] = K[nbins] - n_st1     # remove "self found" spikes from 
     
-    irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
-    irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
-    irange3 = np.arange(nbins+10, nbins+50)  # 40 channels to positive side of peak
-    
-    # Normalize the firing rate in the shoulders by the mean firing rate
-    # A Poisson process has a flat ACG (equal numbers of spikes at all ISIs) and these ratios would = 1
-    mean_firing_rate = (n_st2)/T
-    Q00 = (sum(K[irange1])/(n_st1 * tbin * len(irange1)))/mean_firing_rate
-    Q01_neg = (sum(K[irange2])/(n_st1 * tbin * len(irange2)))/mean_firing_rate
-    Q01_pos = (sum(K[irange3])/(n_st1 * tbin * len(irange3)))/mean_firing_rate
-    Q01 = max(Q01_neg, Q01_pos)
-    
-    #print('firing rate, Q00, Q01: ' + repr(mean_firing_rate) + ', ' + repr(Q00) + ', ' + repr(Q01))
-    
-    # Get highest spike rate of the sampled time regions
-    R00 = max(np.mean(K[irange2]), np.mean(K[irange3])) # Larger of the two shoulders near t = 0
-    R00 = max(R00, np.mean(K[irange1])) # compare this to the asymptotic shoulder
-    
-    # Calculate "refractoriness for periods from 1*tbin to 10*tbin
-    Qi = np.zeros((11,))
-    Ri = np.zeros((11,))
-    for i in range(1,11):
-        irange = np.arange(nbins-i,nbins+i)
-        Qi[i] = (sum(K[irange])/(n_st1 * (2*i+1)*tbin))/mean_firing_rate    #rate in this time period/mean rate
-        #print( 'K[nbins-i], Qi: ' + repr(K[nbins-i]) + ', ' + repr( Qi[i]))
+    Qi, Q00, Q01, Ri = ccg_statistics(K[np.newaxis,:], np.array([n_st1]), np.array([n_st2]), np.array([T]), nbins, tbin)
         
+    return K, Qi[0], Q00[0], Q01[0], Ri[0]
 
-        # Marius note: this is tricky: we approximate the Poisson likelihood with a gaussian of equal mean and variance
-        # that allows us to integrate the probability that we would see <N spikes in the center of the
-        # cross-correlogram from a distribution with mean R00*i spikes
-        
-        # this calculation is done in KS2 but never used
-        # n = sum(K[irange])/2
-        # lam = R00 + i
-        # Ri[i] =  1/2 * (1+ special.erf((n - lam)/np.sqrt(2*lam)))
-        
-    return K, Qi, Q00, Q01, Ri
 
 def contamination_rate(st_sec, tbin_sec, refPer_sec):
     # given a set of spike times in sec, calculate the KS2 contamination percent
@@ -1163,17 +2381,70 @@ def contamination_rate(st_sec, tbin_sec, refPer_sec):
     #      instead of just taking the range of the acg with the lowest contamination, take the range corresponding
     #      to the user specified refractory period. This will also usually give higher values for the contamination rate.
     
-    refPerBin = int(refPer_sec/tbin_sec)
-    if refPerBin == 0:
-        refPerBin = 1   # if refractory period < bin size, take the first bin
-    
     K, Qi, Q00, Q01, rir = ccg(st_sec, st_sec, 500, tbin_sec, True); # compute the auto-correlogram with 500 bins at 1ms bins
     
-    normFactor = (max(Q00, Q01))
-    
-    if normFactor > 0:
-        contam_rate  = Qi[refPerBin]/normFactor # get the Q[i] that includes the refractory period
-    else:
-        contam_rate = 1
-    
-    return contam_rate
\ No newline at end of file
+    return contamination_rate_from_ccg(Qi[np.newaxis,:], np.array([Q00]), np.array([Q01]), tbin_sec, refPer_sec)[0]
+
+
+def contamination_rate_from_ccg(Qi, Q00, Q01, tbin_sec, refPer_sec):
+
+    """ KS2 contamination rate from ccg_statistics output, for one or more units
+
+    refPer_sec can be an array of refractory periods, which are all read
+    from the same Qi.
+
+    Outputs:
+    --------
+    contam_rate : numpy.ndarray (num_units x 0) or (num_units x num_refractory_periods)
+
+    """
+
+    refPerBin = np.asarray(np.asarray(refPer_sec)/tbin_sec).astype('int64')
+    refPerBin[refPerBin == 0] = 1   # if refractory period < bin size, take the first bin
+
+    normFactor = np.where(Q01 > Q00, Q01, Q00)
+
+    contam_rate = np.ones(normFactor.shape + refPerBin.shape)
+    valid = normFactor > 0
+    contam_rate[valid] = Qi[valid][:, refPerBin]/normFactor[valid].reshape((-1,) + (1,) * refPerBin.ndim) # get the Q[i] that includes the refractory period
+
+    return contam_rate
+
+
+def grouped_contamination_rate(sorted_times, offsets, cluster_ids, tbin_sec, refPer_sec, nbins = 500):
+
+    """ contamination_rate for many units from one grouped, sorted spike stream
+
+    Inputs:
+    -------
+    sorted_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds, sorted by (cluster, time)
+    offsets : numpy.ndarray (total_units + 1 x 0)
+        Spikes of cluster i are sorted_times[offsets[i]:offsets[i+1]]
+    cluster_ids : numpy.ndarray
+        Cluster IDs to compute
+
+    Output:
+    -------
+    contam_rate : numpy.ndarray (cluster_ids.size x 0)
+        or (cluster_ids.size x num_refractory_periods) if refPer_sec is an array
+
+    """
+
+    total_units = offsets.size - 1
+    counts = np.diff(offsets)
+
+    # only spikes of the requested clusters enter the correlogram pass
+    selected = np.zeros((total_units,), dtype='bool')
+    selected[cluster_ids] = True
+    sorted_clusters = np.repeat(np.arange(total_units), counts)
+    in_selected = selected[sorted_clusters]
+
+    K = grouped_autocorrelograms(sorted_times[in_selected], sorted_clusters[in_selected], total_units, nbins, tbin_sec)[cluster_ids]
+
+    n = counts[cluster_ids]
+    T = sorted_times[offsets[cluster_ids + 1] - 1] - sorted_times[offsets[cluster_ids]]
+
+    Qi, Q00, Q01, Ri = ccg_statistics(K, n, n, T, nbins, tbin_sec)
+
+    return contamination_rate_from_ccg(Qi, Q00, Q01, tbin_sec, refPer_sec)
@@ -0,0 +1,64 @@
+from argschema import ArgSchemaParser
+import time
+
+import numpy as np
+
+from ...common.utils import KilosortDataset
+from ...common.schemas import SnippetStoreParams
+from ...common.artifact_cache import get_artifact_cache
+from ...common.snippet_store import get_snippet_store
+
+
+def build_store(args):
+
+    print('ecephys spike sorting: snippet store module')
+
+    start = time.time()
+
+    print("Loading data...")
+
+    rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+    data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+
+    cache = get_artifact_cache(args)
+    dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                args['ephys_params']['sample_rate'], cache = cache)
+
+    store_params = SnippetStoreParams().load(args.get('snippet_store_params') or {})
+
+    store = get_snippet_store(args['directories']['kilosort_output_directory'],
+                              data, args['ephys_params']['ap_band_file'],
+                              dataset.spike_times, dataset.spike_clusters, dataset.templates,
+                              dataset.channel_map, dataset.channel_pos, store_params,
+                              spike_templates = dataset.spike_templates,
+                              peak_channel_index = dataset.peak_channel_index)
+
+    execution_time = time.time() - start
+
+    print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
+    print()
+
+    return {"execution_time" : execution_time,
+            "store_directory" : store.store_directory,
+            "num_snippets" : int(store.snippet_times.size)} # output manifest
+
+
+def main():
+
+    from ._schemas import InputParameters, OutputParameters
+
+    """Main entry point:"""
+    mod = ArgSchemaParser(schema_type=InputParameters,
+                          output_schema_type=OutputParameters)
+
+    output = build_store(mod.args)
+
+    output.update({"input_parameters": mod.args})
+    if "output_json" in mod.args:
+        mod.output(output, indent=2)
+    else:
+        print(mod.get_output_json(output))
+
+
+if __name__ == "__main__":
+    main()
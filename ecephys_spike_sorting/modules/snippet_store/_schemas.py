@@ -0,0 +1,23 @@
+from argschema import ArgSchema, ArgSchemaParser 
+from argschema.schemas import DefaultSchema
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from ...common.schemas import EphysParams, Directories, SnippetStoreParams, ArtifactCacheParams
+
+
+class InputParameters(ArgSchema):
+    snippet_store_params = Nested(SnippetStoreParams)
+    artifact_cache_params = Nested(ArtifactCacheParams)
+    directories = Nested(Directories)
+    ephys_params = Nested(EphysParams)
+
+class OutputSchema(DefaultSchema): 
+    input_parameters = Nested(InputParameters, 
+                              description=("Input parameters the module " 
+                                           "was run with"), 
+                              required=True) 
+ 
+class OutputParameters(OutputSchema): 
+
+    execution_time = Float()
+    store_directory = String()
+    num_snippets = Int()
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import psutil
+
+from ...common.utils import load_kilosort_data
+from ...modules.quality_metrics._schemas import QualityMetricsParams
+from ...modules.quality_metrics import metrics as qm
+from ...modules.quality_metrics import ibl_metrics as ibl
+
+from .synthetic_kilosort import make_synthetic_kilosort_output
+
+# (num_spikes, num_units, num_channels) for each named scale
+SCALES = {'small' : (100000, 50, 96),
+          'medium' : (1000000, 200, 384),
+          'large' : (10000000, 600, 384)}
+
+STAGES = ['load', 'spike_train_metrics', 'pc_metrics', 'silhouette_score', 'drift_metrics',
+          'slidingRP', 'noise_cutoff', 'calculate_metrics', 'calculate_ibl_metrics']
+
+
+def run_stage(func, profile_memory):
+
+    """
+    Runs one stage and measures its run time (and peak memory)
+
+    Numpy allocations are traced by tracemalloc, so the peak includes arrays
+    allocated by the stage, but not memory-mapped files. As tracing slows down
+    the stage, the peak memory is measured in a second run.
+
+    Outputs:
+    --------
+    result : output of func
+    stats : dict
+        seconds, and if profile_memory, peak_memory_mb and rss_change_mb
+
+    """
+
+    start = time.perf_counter()
+    result = func()
+    stats = {'seconds' : time.perf_counter() - start}
+
+    if profile_memory:
+        rss_before = psutil.Process().memory_info().rss
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats['peak_memory_mb'] = peak / 1024**2
+        stats['rss_change_mb'] = (psutil.Process().memory_info().rss - rss_before) / 1024**2
+
+    return result, stats
+
+
+def benchmark_folder(kilosort_output_dir, params, sample_rate, stages = STAGES, profile_memory = True):
+
+    """
+    Times each stage of calculate_metrics and calculate_ibl_metrics on one Kilosort output folder
+
+    The stages are called with the same inputs that calculate_metrics and
+    calculate_ibl_metrics use for a single epoch covering the whole recording.
+
+    Outputs:
+    --------
+    results : dict
+        stats (see run_stage) for each stage
+
+    """
+
+    results = {}
+
+    def stage(name, func, required = False):
+        # stages that are not benchmarked are skipped, unless later stages need their output
+        if name in stages:
+            print('  ' + name)
+            output, results[name] = run_stage(func, profile_memory)
+            return output
+        elif required:
+            return func()
+
+    mmap_mode = 'r' if params['memmap_pc_features'] else None
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+        channel_pos, cluster_ids, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+        stage('load', lambda: load_kilosort_data(kilosort_output_dir, sample_rate, use_master_clock = False,
+                                                 include_pcs = True, mmap_mode = mmap_mode), required = True)
+
+    total_units = np.max(spike_clusters) + 1
+    spike_templates = np.squeeze(spike_templates)
+    cluster_ids = np.unique(spike_clusters)
+    template_ids = qm.get_majority_templates(spike_clusters, spike_templates, total_units)
+
+    stage('spike_train_metrics', lambda: qm.calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units,
+                                                                          params['isi_threshold'], params['min_isi'],
+                                                                          params['tbin_sec']))
+
+    stage('pc_metrics', lambda: qm.calculate_pc_metrics(spike_clusters, spike_templates, total_units, cluster_ids, template_ids,
+                                                        pc_features, pc_feature_ind, channel_pos, params['max_radius_um'],
+                                                        params['max_spikes_for_unit'], params['max_spikes_for_nn'],
+                                                        params['n_neighbors'], params['pc_metrics_workers'],
+                                                        params['pc_metrics_max_memory_gb'], params['random_seed']))
+
+    stage('silhouette_score', lambda: qm.calculate_silhouette_score(spike_clusters, spike_templates, total_units,
+                                                                    pc_features, pc_feature_ind,
+                                                                    min(spike_times.size, params['n_silhouette'])))
+
+    stage('drift_metrics', lambda: qm.calculate_drift_metrics(spike_times, spike_clusters, spike_templates, template_ids,
+                                                              total_units, pc_features, pc_feature_ind, channel_pos,
+                                                              params['drift_metrics_interval_s'],
+                                                              params['drift_metrics_min_spikes_per_interval']))
+
+    stage('slidingRP', lambda: ibl.calculate_slidingRP(spike_times, spike_clusters, total_units, sample_rate))
+
+    stage('noise_cutoff', lambda: ibl.calculate_noise_cutoff(np.squeeze(amplitudes), spike_clusters, total_units))
+
+    stage('calculate_metrics', lambda: qm.calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
+                                                            channel_map, channel_pos, templates, pc_features,
+                                                            pc_feature_ind, params))
+
+    stage('calculate_ibl_metrics', lambda: ibl.calculate_ibl_metrics(spike_times, spike_clusters, amplitudes,
+                                                                     params, sample_rate))
+
+    return results
+
+
+def get_version_info():
+
+    # identifies the code that was benchmarked, so results can be compared across versions
+
+    info = {'python' : sys.version.split()[0],
+            'numpy' : np.__version__,
+            'platform' : platform.platform(),
+            'processor' : platform.processor(),
+            'cpu_count' : os.cpu_count()}
+
+    try:
+        from git import Repo
+        repo = Repo(os.path.dirname(os.path.abspath(__file__)), search_parent_directories=True)
+        info['commit_hash'] = repo.head.commit.hexsha
+        info['commit_date'] = time.strftime("%a, %d %b %Y %H:%M", time.gmtime(repo.head.commit.committed_date))
+    except Exception:
+        info['commit_hash'] = 'repository not available'
+
+    return info
+
+
+def run_benchmarks(scales, output_json, work_dir = None, stages = STAGES, params = None,
+                   profile_memory = True, num_pcs = 3, firing_rate_median_hz = 5.0,
+                   firing_rate_sigma = 1.0, drift_um = 20.0, sample_rate = 30000.0, seed = 0, keep_data = False):
+
+    """
+    Generates synthetic Kilosort output at each scale, benchmarks it, and writes the results as JSON
+
+    Inputs:
+    -------
+    scales : list
+        Names from SCALES, or (num_spikes, num_units, num_channels) tuples
+    output_json : String
+        Path of the JSON file to write
+    work_dir : String
+        Folder for the synthetic data (a temporary folder if None)
+    stages : list
+        Stages to benchmark (see STAGES)
+    params : dict
+        Quality metrics parameters (defaults from QualityMetricsParams if None)
+    profile_memory : bool
+        If True, measure peak memory of each stage in a second (traced) run
+
+    Outputs:
+    --------
+    results : dict
+        Contents of the JSON file
+
+    """
+
+    if params is None:
+        params = QualityMetricsParams().load({})
+
+    temporary = work_dir is None
+    if temporary:
+        work_dir = tempfile.mkdtemp(prefix='qm_benchmark_')
+
+    results = {'version' : get_version_info(),
+               'params' : params,
+               'scales' : []}
+
+    try:
+        for scale in scales:
+
+            num_spikes, num_units, num_channels = SCALES[scale] if isinstance(scale, str) else scale
+            name = scale if isinstance(scale, str) else repr(num_spikes) + '_' + repr(num_units) + '_' + repr(num_channels)
+
+            folder = os.path.join(work_dir, name)
+
+            print('Generating ' + name + ' data set...')
+            start = time.perf_counter()
+            data_info = make_synthetic_kilosort_output(folder, num_spikes, num_units, num_channels, num_pcs,
+                                                       sample_rate = sample_rate,
+                                                       firing_rate_median_hz = firing_rate_median_hz,
+                                                       firing_rate_sigma = firing_rate_sigma,
+                                                       drift_um = drift_um, seed = seed)
+            data_info['generation_seconds'] = time.perf_counter() - start
+
+            print('Benchmarking ' + name + '...')
+            stage_results = benchmark_folder(folder, params, sample_rate, stages, profile_memory)
+
+            results['scales'].append({'name' : name, 'data' : data_info, 'stages' : stage_results})
+
+            if not keep_data:
+                shutil.rmtree(folder)
+
+            # written after each scale, so partial results survive an interrupted run
+            with open(output_json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    finally:
+        if temporary and not keep_data:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the quality_metrics module on synthetic Kilosort output')
+    parser.add_argument('--output_json', default='quality_metrics_benchmark.json', help='File for the results')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], help='Any of ' + ', '.join(SCALES.keys()))
+    parser.add_argument('--stages', nargs='+', default=STAGES, help='Any of ' + ', '.join(STAGES))
+    parser.add_argument('--work_dir', default=None, help='Folder for the synthetic data (temporary if not given)')
+    parser.add_argument('--keep_data', action='store_true', help='Keep the synthetic data')
+    parser.add_argument('--no_memory', action='store_true', help='Skip the peak memory measurements')
+    parser.add_argument('--num_pcs', type=int, default=3)
+    parser.add_argument('--firing_rate_median_hz', type=float, default=5.0)
+    parser.add_argument('--firing_rate_sigma', type=float, default=1.0)
+    parser.add_argument('--drift_um', type=float, default=20.0)
+    parser.add_argument('--pc_metrics_workers', type=int, default=1)
+    parser.add_argument('--memmap_pc_features', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    params = QualityMetricsParams().load({'pc_metrics_workers' : args.pc_metrics_workers,
+                                          'memmap_pc_features' : args.memmap_pc_features,
+                                          'random_seed' : args.seed})
+
+    run_benchmarks(args.scales, args.output_json, args.work_dir, args.stages, params,
+                   profile_memory = not args.no_memory, num_pcs = args.num_pcs,
+                   firing_rate_median_hz = args.firing_rate_median_hz,
+                   firing_rate_sigma = args.firing_rate_sigma, drift_um = args.drift_um,
+                   seed = args.seed, keep_data = args.keep_data)
+
+
+if __name__ == "__main__":
+    main()
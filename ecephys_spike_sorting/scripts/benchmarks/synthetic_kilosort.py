@@ -0,0 +1,218 @@
+import os
+import numpy as np
+import pandas as pd
+
+from ...common.utils import write_cluster_group_tsv
+
+
+def make_probe_geometry(num_channels):
+
+    """
+    Channel positions of a Neuropixels 1.0 probe (staggered, 20 um rows)
+
+    Inputs:
+    -------
+    num_channels : Int
+        Number of channels
+
+    Outputs:
+    --------
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates for each channel, in um
+
+    """
+
+    x = np.tile([43, 11, 59, 27], num_channels // 4 + 1)[:num_channels]
+    z = 20 * (np.arange(num_channels) // 2)
+
+    return np.stack((x, z), 1).astype('float64')
+
+
+def make_synthetic_kilosort_output(output_dir,
+                                   num_spikes = 1000000,
+                                   num_units = 200,
+                                   num_channels = 384,
+                                   num_pcs = 3,
+                                   num_pc_channels = 32,
+                                   sample_rate = 30000.0,
+                                   firing_rate_median_hz = 5.0,
+                                   firing_rate_sigma = 1.0,
+                                   drift_um = 20.0,
+                                   drift_period_s = 600.0,
+                                   contamination = 0.01,
+                                   template_samples = 82,
+                                   chunk_size = 1000000,
+                                   seed = 0):
+
+    """
+    Writes a phy/Kilosort output folder with synthetic units
+
+    Unit firing rates are drawn from a lognormal distribution; the recording
+    duration is chosen so the expected number of spikes is num_spikes. Each unit
+    has a peak site on the probe, and its PC features decay with the distance
+    between each site and the unit, which moves sinusoidally by drift_um with
+    period drift_period_s. A fraction (contamination) of each unit's spikes
+    is uniformly distributed noise, so ISI violations and contamination are
+    realistic rather than zero.
+
+    Inputs:
+    -------
+    output_dir : String
+        Folder to write (created if it doesn't exist)
+    num_spikes : Int
+        Approximate total number of spikes
+    num_units : Int
+        Number of units (and templates)
+    num_channels : Int
+        Number of channels on the probe
+    num_pcs : Int
+        Number of PCs per channel in pc_features.npy
+    num_pc_channels : Int
+        Number of channels per template in pc_features.npy
+    sample_rate : Float
+        Sample rate in Hz
+    firing_rate_median_hz : Float
+        Median of the lognormal firing rate distribution
+    firing_rate_sigma : Float
+        Sigma of the lognormal firing rate distribution
+    drift_um : Float
+        Amplitude of the probe drift
+    drift_period_s : Float
+        Period of the probe drift
+    contamination : Float
+        Fraction of spikes without a refractory period
+    template_samples : Int
+        Number of samples in each template
+    chunk_size : Int
+        Number of spikes written to pc_features.npy at once
+    seed : Int
+        Seed for the random generator
+
+    Outputs:
+    --------
+    info : dict
+        Parameters of the data that was written (duration, number of spikes, etc.)
+
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+
+    channel_pos = make_probe_geometry(num_channels)
+    num_pc_channels = min(num_pc_channels, num_channels)
+
+    # units and templates
+    firing_rates = firing_rate_median_hz * np.exp(firing_rate_sigma * rng.standard_normal(num_units))
+    duration = num_spikes / np.sum(firing_rates)
+
+    peak_channels = rng.integers(0, num_channels, num_units)
+    unit_x = channel_pos[peak_channels, 0]
+    unit_z = channel_pos[peak_channels, 1]
+    unit_amplitudes = 50 + 250 * rng.random(num_units)
+    footprint_um = 20 + 30 * rng.random(num_units)
+
+    distance = np.sqrt(np.square(channel_pos[:,0][np.newaxis,:] - unit_x[:,np.newaxis]) + \
+                       np.square(channel_pos[:,1][np.newaxis,:] - unit_z[:,np.newaxis]))
+
+    pc_feature_ind = np.argsort(distance, 1, kind='stable')[:, :num_pc_channels].astype('uint32')
+
+    t = np.arange(template_samples) - template_samples // 3
+    waveform = -np.exp(-np.square(t / 3.0)) + 0.3 * np.exp(-np.square((t - 12) / 8.0))
+    spatial = np.exp(-np.square(distance / footprint_um[:,np.newaxis]))
+    templates = (waveform[np.newaxis,:,np.newaxis] * spatial[:,np.newaxis,:]).astype('float32')
+
+    whitening_mat = np.eye(num_channels, dtype='float64') * 0.05
+    whitening_mat_inv = np.eye(num_channels, dtype='float64') * 20.0
+
+    # spike trains: refractory (gamma) ISIs plus a fraction of uniform noise spikes
+    spike_times = []
+    spike_clusters = []
+
+    for unit, rate in enumerate(firing_rates):
+
+        count = rng.poisson(rate * duration)
+        num_noise = rng.binomial(count, contamination)
+
+        isis = 0.0015 + rng.exponential(max(1.0 / rate - 0.0015, 0.0005), count - num_noise)
+        times = np.cumsum(isis)
+        times = np.concatenate((times[times < duration], rng.random(num_noise) * duration))
+
+        spike_times.append(times)
+        spike_clusters.append(np.full((times.size,), unit, dtype='int32'))
+
+    spike_times = np.concatenate(spike_times)
+    spike_clusters = np.concatenate(spike_clusters)
+
+    order = np.argsort(spike_times, kind='stable')
+    spike_times = spike_times[order]
+    spike_clusters = spike_clusters[order]
+    total_spikes = spike_times.size
+
+    spike_samples = np.round(spike_times * sample_rate).astype('uint64')
+
+    amplitudes = (unit_amplitudes[spike_clusters] * np.exp(0.2 * rng.standard_normal(total_spikes))).astype('float64')
+
+    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_samples)
+    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
+    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_clusters.astype('uint32'))
+    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
+    np.save(os.path.join(output_dir, 'templates.npy'), templates)
+    np.save(os.path.join(output_dir, 'whitening_mat.npy'), whitening_mat)
+    np.save(os.path.join(output_dir, 'whitening_mat_inv.npy'), whitening_mat_inv)
+    np.save(os.path.join(output_dir, 'channel_map.npy'), np.arange(num_channels, dtype='int32'))
+    np.save(os.path.join(output_dir, 'channel_positions.npy'), channel_pos)
+    np.save(os.path.join(output_dir, 'pc_feature_ind.npy'), pc_feature_ind)
+
+    # pc_features are written in chunks, so they never have to fit in memory
+    pc_features = np.lib.format.open_memmap(os.path.join(output_dir, 'pc_features.npy'), mode='w+',
+                                            dtype='float32', shape=(total_spikes, num_pcs, num_pc_channels))
+
+    pc_scale = 1.0 / (1 + np.arange(num_pcs))
+    pc_offsets = rng.standard_normal((num_units, num_pcs)).astype('float32')
+
+    for chunk_start in range(0, total_spikes, chunk_size):
+
+        chunk = slice(chunk_start, min(chunk_start + chunk_size, total_spikes))
+        units = spike_clusters[chunk]
+
+        # distance from each of the unit's pc channels to the drifting unit position
+        drift = drift_um * np.sin(2 * np.pi * spike_times[chunk] / drift_period_s)
+        channels = pc_feature_ind[units]
+        d = np.sqrt(np.square(channel_pos[channels,0] - unit_x[units][:,np.newaxis]) + \
+                    np.square(channel_pos[channels,1] - (unit_z[units] + drift)[:,np.newaxis]))
+        spatial = np.exp(-np.square(d / footprint_um[units][:,np.newaxis]))
+
+        pcs = (amplitudes[chunk] / 10)[:,np.newaxis,np.newaxis] * \
+              (pc_scale[np.newaxis,:,np.newaxis] + 0.1 * pc_offsets[units][:,:,np.newaxis]) * spatial[:,np.newaxis,:]
+        pcs += rng.standard_normal(pcs.shape)
+
+        pc_features[chunk] = pcs
+
+    pc_features.flush()
+    del pc_features
+
+    cluster_amplitude = pd.DataFrame({'cluster_id' : np.arange(num_units), 'Amplitude' : unit_amplitudes})
+    cluster_amplitude.to_csv(os.path.join(output_dir, 'cluster_Amplitude.tsv'), sep='\t', index=False)
+
+    write_cluster_group_tsv(np.arange(num_units), ['unsorted'] * num_units, output_dir)
+
+    with open(os.path.join(output_dir, 'params.py'), 'w') as f:
+        f.write("dat_path = 'continuous.dat'\n")
+        f.write('n_channels_dat = ' + repr(num_channels) + '\n')
+        f.write("dtype = 'int16'\n")
+        f.write('offset = 0\n')
+        f.write('sample_rate = ' + repr(float(sample_rate)) + '\n')
+        f.write('hp_filtered = True\n')
+
+    return {'num_spikes' : int(total_spikes),
+            'num_units' : int(num_units),
+            'num_channels' : int(num_channels),
+            'num_pcs' : int(num_pcs),
+            'num_pc_channels' : int(num_pc_channels),
+            'duration_s' : float(duration),
+            'sample_rate' : float(sample_rate),
+            'firing_rate_median_hz' : float(firing_rate_median_hz),
+            'firing_rate_sigma' : float(firing_rate_sigma),
+            'drift_um' : float(drift_um),
+            'seed' : int(seed)}
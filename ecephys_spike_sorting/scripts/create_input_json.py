@@ -371,6 +371,7 @@ def createInputJson(output_file,
                       
         "ks_postprocessing_params" : {
             "align_avg_waveform" : False,              
+            "align_method" : 'C_Waves',
             "remove_duplicates" : True,
             "cWaves_path" : cWaves_path,
             "within_unit_overlap_window" : 0.00017,
@@ -395,6 +396,19 @@ def createInputJson(output_file,
             "calc_half_run" : c_Waves_calc_half
             
         },
+
+        "snippet_store_params" : {
+            "store_directory" : os.path.join(kilosort_output_directory, 'snippet_store'),
+            "spikes_per_unit" : 1000,
+            "site_radius_um" : 100,
+            "random_seed" : 0
+        },
+
+        "artifact_cache_params" : {
+            "use_cache" : False,
+            "cache_directory" : os.path.join(kilosort_output_directory, 'artifact_cache'),
+            "max_cache_gb" : 2.0
+        },
             
 
         "noise_waveform_params" : {
@@ -0,0 +1,100 @@
+import os
+import time
+
+import numpy as np
+
+from ecephys_spike_sorting.common.artifact_cache import ArtifactCache, get_artifact_cache
+from ecephys_spike_sorting.common.utils import KilosortDataset, get_majority_templates
+
+def make_kilosort_output(folder, seed = 0):
+
+	rng = np.random.default_rng(seed)
+
+	spike_clusters = rng.integers(0, 6, 5000).astype('int32')
+	spike_templates = np.where(rng.random(5000) < 0.8, spike_clusters, rng.integers(0, 8, 5000))
+
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+	np.save(os.path.join(folder, 'spike_templates.npy'), spike_templates[:, np.newaxis].astype('uint32'))
+	np.save(os.path.join(folder, 'templates.npy'), rng.standard_normal((8, 82, 16)).astype('float32'))
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), rng.standard_normal((16, 16)).astype('float32'))
+
+def test_artifact_cache(tmpdir):
+
+	folder = str(tmpdir)
+	source_file = os.path.join(folder, 'spike_clusters.npy')
+	np.save(source_file, np.arange(100))
+
+	cache = ArtifactCache(os.path.join(folder, 'cache'))
+	calls = []
+
+	def compute():
+		calls.append(1)
+		return np.load(source_file) * 2
+
+	assert(np.array_equal(cache.get('double', [source_file], compute), np.arange(100) * 2))
+	assert(np.array_equal(cache.get('double', [source_file], compute), np.arange(100) * 2))
+	assert(len(calls) == 1)
+
+	# other parameters are another entry
+	cache.get('double', [source_file], compute, params = {'factor' : 2})
+	assert(len(calls) == 2)
+
+	# re-saved with the same contents (e.g. by phy, without changes): still a hit
+	time.sleep(0.01)
+	np.save(source_file, np.arange(100))
+	cache.get('double', [source_file], compute)
+	assert(len(calls) == 2)
+
+	# curated: a miss
+	np.save(source_file, np.arange(100) + 1)
+	assert(np.array_equal(cache.get('double', [source_file], compute), (np.arange(100) + 1) * 2))
+	assert(len(calls) == 3)
+
+def test_artifact_cache_eviction(tmpdir):
+
+	folder = str(tmpdir)
+	source_file = os.path.join(folder, 'source.npy')
+	np.save(source_file, np.zeros((1,)))
+
+	# room for two entries of 8000 bytes (plus headers)
+	cache = ArtifactCache(os.path.join(folder, 'cache'), max_bytes = 17000)
+
+	for name in ['a', 'b', 'c']:
+		cache.get(name, [source_file], lambda: np.zeros((1000,)))
+		time.sleep(0.01)
+
+	entries = sorted(f for f in os.listdir(cache.cache_directory) if f.endswith('.npy'))
+	assert([f[0] for f in entries] == ['b', 'c'])
+
+def test_kilosort_dataset_with_cache(tmpdir):
+
+	folder = str(tmpdir)
+	make_kilosort_output(folder)
+	# off by default, so nothing is written to the Kilosort output directory
+	args = {'directories' : {'kilosort_output_directory' : folder}}
+	assert(get_artifact_cache(args) is None)
+
+	args['artifact_cache_params'] = {'use_cache' : True}
+	cache = get_artifact_cache(args)
+	assert(cache.cache_directory == os.path.join(folder, 'artifact_cache'))
+
+	expected = KilosortDataset(folder)
+
+	first = KilosortDataset(folder, cache = cache)
+	assert(np.array_equal(first.templates, expected.templates))
+	assert(np.array_equal(first.peak_channel_index, expected.peak_channel_index))
+	assert(np.array_equal(first.majority_templates,
+						  get_majority_templates(expected.spike_clusters, expected.spike_templates,
+												 np.max(expected.spike_clusters) + 1)))
+
+	# a later module reads them from the cache
+	second = KilosortDataset(folder, cache = cache)
+	assert(np.array_equal(second.templates, expected.templates))
+	assert(np.array_equal(second.majority_templates, first.majority_templates))
+	assert(second._whitened_templates is None)
+	assert(second._spike_clusters is None)
+
+	# peak channels, e.g. for getSortResults, are read without the templates
+	third = KilosortDataset(folder, cache = cache)
+	assert(np.array_equal(third.peak_channel_index, expected.peak_channel_index))
+	assert(third._templates is None)
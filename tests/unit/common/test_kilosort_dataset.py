@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+
+from ecephys_spike_sorting.common.utils import KilosortDataset, load_kilosort_data, getSortResults
+
+def make_kilosort_output(folder, seed = 0):
+
+	rng = np.random.default_rng(seed)
+	num_channels = 16
+	num_templates = 8
+
+	spike_times = np.sort(rng.integers(0, 300000, 5000)).astype('uint64')[:, np.newaxis]
+	spike_clusters = rng.integers(0, num_templates - 2, spike_times.size).astype('int32')
+
+	templates = rng.standard_normal((num_templates, 82, num_channels)).astype('float32')
+	templates[:, :21, :] = 0
+	templates[3, 40, 2] = np.nan
+	# symmetric, as the whitening matrices of Kilosort are
+	whitening_mat_inv = rng.standard_normal((num_channels, num_channels)).astype('float32')
+	whitening_mat_inv = whitening_mat_inv + whitening_mat_inv.T
+
+	np.save(os.path.join(folder, 'spike_times.npy'), spike_times)
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+	np.save(os.path.join(folder, 'spike_templates.npy'), spike_clusters[:, np.newaxis].astype('uint32'))
+	np.save(os.path.join(folder, 'amplitudes.npy'), rng.random((spike_times.size, 1)))
+	np.save(os.path.join(folder, 'templates.npy'), templates)
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), whitening_mat_inv)
+	np.save(os.path.join(folder, 'channel_map.npy'), np.arange(num_channels)[:, np.newaxis] + 100)
+	np.save(os.path.join(folder, 'channel_positions.npy'),
+			np.stack([np.zeros((num_channels,)), np.arange(num_channels) * 20.0], 1))
+
+	with open(os.path.join(folder, 'cluster_Amplitude.tsv'), 'w') as f:
+		f.write('cluster_id\tAmplitude\n')
+		for i in range(num_templates - 2):
+			f.write('%d\t%.1f\n' % (i, 10.0 * i))
+
+	return spike_times, spike_clusters, templates, whitening_mat_inv
+
+def test_kilosort_dataset(tmpdir):
+
+	folder = str(tmpdir)
+	spike_times, spike_clusters, templates, whitening_mat_inv = make_kilosort_output(folder)
+
+	dataset = KilosortDataset(folder, 30000.0)
+
+	# templates are fixed, trimmed and unwhitened on first access
+	assert(dataset.template_zero_padding == 21)
+	assert(not np.any(np.isnan(np.load(os.path.join(folder, 'templates.npy')))))
+
+	expected = np.zeros((templates.shape[0], 61, templates.shape[2]))
+	for i in range(templates.shape[0]):
+		expected[i] = np.dot(np.nan_to_num(templates[i, 21:, :]), whitening_mat_inv)
+	assert(np.array_equal(dataset.templates, expected))
+
+	peak_index = np.argmax(np.max(expected, 1) - np.min(expected, 1), 1)
+	assert(np.array_equal(dataset.peak_channel_index, peak_index))
+	assert(np.array_equal(dataset.peak_channels, peak_index + 100))
+	assert(np.array_equal(dataset.template_amplitudes, np.max(np.max(expected, 1) - np.min(expected, 1), 1)))
+
+	# memory-mapped read-only
+	assert(not dataset.spike_times.flags.writeable)
+	assert(np.array_equal(dataset.spike_times, np.squeeze(spike_times)))
+	assert(np.array_equal(dataset.spike_times_seconds, np.squeeze(spike_times) / 30000.0))
+	assert(np.array_equal(dataset.cluster_ids, np.unique(spike_clusters)))
+	assert(np.array_equal(dataset.cluster_amplitude, [0, 10, 20, 30, 40, 50, 0, 0]))
+	assert(dataset.pc_features.size == 0)
+
+def test_load_kilosort_data(tmpdir):
+
+	folder = str(tmpdir)
+	spike_times, spike_clusters, templates, whitening_mat_inv = make_kilosort_output(folder)
+	dataset = KilosortDataset(folder, 30000.0)
+
+	outputs = load_kilosort_data(folder, 30000.0, include_pcs = True)
+	assert(len(outputs) == 13)
+	assert(np.array_equal(outputs[0], dataset.spike_times_seconds))
+	assert(np.array_equal(outputs[4], dataset.templates))
+	assert(outputs[8] == ['unsorted'] * dataset.cluster_ids.size)
+
+	outputs = load_kilosort_data(folder, 30000.0, convert_to_seconds = False)
+	assert(len(outputs) == 10)
+	# read into memory, as before
+	assert(outputs[0].flags.writeable)
+	assert(np.array_equal(outputs[0], np.squeeze(spike_times)))
+
+def test_get_sort_results(tmpdir):
+
+	folder = str(tmpdir)
+	make_kilosort_output(folder)
+	KilosortDataset(folder).templates # fixes the NaNs in templates.npy
+
+	# a merged unit, with spikes from two templates
+	spike_clusters = np.load(os.path.join(folder, 'spike_clusters.npy'))
+	spike_clusters[spike_clusters == 2] = 9
+	spike_clusters[spike_clusters == 4] = 9
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+
+	nTemplate, nTot = getSortResults(folder, 0)
+	clus_Table = np.load(os.path.join(folder, 'clus_Table.npy'))
+
+	spike_templates = np.squeeze(np.load(os.path.join(folder, 'spike_templates.npy')))
+	templates = np.load(os.path.join(folder, 'templates.npy'))
+	w_inv = np.load(os.path.join(folder, 'whitening_mat_inv.npy'))
+	channel_map = np.squeeze(np.load(os.path.join(folder, 'channel_map.npy')))
+
+	expected = np.zeros((10, 2), dtype='uint32')
+	for label in np.unique(spike_clusters):
+		template = np.argmax(np.bincount(spike_templates[spike_clusters == label]))
+		unwhitened = np.matmul(w_inv, templates[template].T)
+		expected[label] = [np.sum(spike_clusters == label),
+						   channel_map[np.argmax(np.max(unwhitened, 1) - np.min(unwhitened, 1))]]
+
+	assert((nTemplate, nTot) == (templates.shape[0], spike_clusters.size))
+	assert(np.array_equal(clus_Table, expected))
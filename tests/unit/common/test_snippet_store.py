@@ -0,0 +1,132 @@
+import os
+import json
+import time
+
+import numpy as np
+import pytest
+
+from ecephys_spike_sorting.common.snippet_store import SnippetStore, build_snippet_store, snippet_store_is_valid, \
+	get_snippet_store, get_unit_peak_channels, STORE_PARAMS
+from ecephys_spike_sorting.common.schemas import SnippetStoreParams
+
+def make_kilosort_output(folder, seed = 0):
+
+	rng = np.random.default_rng(seed)
+	num_channels = 16
+
+	raw_data = (rng.standard_normal((100000, num_channels)) * 20).astype('int16')
+	spike_times = np.sort(rng.integers(0, raw_data.shape[0], 2000)).astype('uint64')
+	spike_clusters = rng.integers(0, 6, spike_times.size).astype('int32')
+	templates = rng.standard_normal((6, 82, num_channels))
+	channel_map = np.arange(num_channels)
+	channel_pos = np.stack([np.zeros((num_channels,)), np.arange(num_channels) * 20.0], 1)
+
+	raw_data_file = os.path.join(folder, 'continuous.dat')
+	raw_data.tofile(raw_data_file)
+	np.save(os.path.join(folder, 'spike_times.npy'), spike_times)
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+
+	return raw_data, raw_data_file, spike_times, spike_clusters, templates, channel_map, channel_pos
+
+def test_build_snippet_store(tmpdir):
+
+	folder = str(tmpdir)
+	raw_data, raw_data_file, spike_times, spike_clusters, templates, channel_map, channel_pos = \
+		make_kilosort_output(folder)
+	store_directory = os.path.join(folder, 'snippet_store')
+
+	build_snippet_store(raw_data, spike_times, spike_clusters, templates, channel_map, channel_pos, store_directory,
+						spikes_per_unit = 100, site_radius_um = 30, chunk_samples = 5000)
+	store = SnippetStore(store_directory)
+
+	peak_channels = np.argmax(np.max(templates, 1) - np.min(templates, 1), 1)
+
+	for cluster_id in range(6):
+
+		times = store.unit_times(cluster_id)
+		in_data = (spike_times >= 20) & (spike_times + 62 <= raw_data.shape[0])
+		expected_count = min(100, np.sum(spike_clusters == cluster_id))
+
+		assert(np.all(np.diff(times) > 0))
+		assert(np.all(np.isin(times, spike_times[(spike_clusters == cluster_id) & in_data])))
+		assert(times.size <= expected_count and times.size >= expected_count - 2)
+
+		sites = store.kept_sites[cluster_id]
+		assert(peak_channels[cluster_id] in sites)
+		assert(np.array_equal(sites[sites >= 0], np.arange(max(peak_channels[cluster_id] - 1, 0),
+														   min(peak_channels[cluster_id] + 2, 16))))
+
+		snippets = store.unit_snippets(cluster_id)
+		assert(snippets.dtype == np.int16)
+		for snippet, time in zip(snippets, times):
+			expected = raw_data[int(time) - 20:int(time) + 62, np.maximum(sites, 0)].T
+			assert(np.array_equal(snippet, expected))
+
+def test_snippet_store_validity(tmpdir):
+
+	folder = str(tmpdir)
+	raw_data, raw_data_file, spike_times, spike_clusters, templates, channel_map, channel_pos = \
+		make_kilosort_output(folder)
+
+	params = SnippetStoreParams().load({'spikes_per_unit' : 50})
+	store = get_snippet_store(folder, raw_data, raw_data_file, spike_times, spike_clusters, templates,
+							  channel_map, channel_pos, params)
+
+	store_directory = os.path.join(folder, 'snippet_store')
+	source_files = [os.path.join(folder, 'spike_clusters.npy'), os.path.join(folder, 'spike_times.npy'), raw_data_file]
+	store_params = {name : params[name] for name in STORE_PARAMS}
+
+	assert(store.store_directory == store_directory)
+	assert(snippet_store_is_valid(store_directory, source_files, store_params))
+	assert(not snippet_store_is_valid(store_directory, source_files, dict(store_params, spikes_per_unit = 60)))
+
+	# re-saving the same cluster IDs keeps the store
+	time.sleep(0.01)
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+	assert(snippet_store_is_valid(store_directory, source_files, store_params))
+
+	# and the new modification time is saved, so the file is not hashed again
+	with open(os.path.join(store_directory, 'snippet_store.json')) as f:
+		saved = json.load(f)['source_files']['spike_clusters.npy']
+	assert(saved['mtime'] == os.path.getmtime(os.path.join(folder, 'spike_clusters.npy')))
+
+	# changed cluster IDs (e.g. after curation) make it stale
+	spike_clusters[:10] = 5
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+	assert(not snippet_store_is_valid(store_directory, source_files, store_params))
+
+	store = get_snippet_store(folder, raw_data, raw_data_file, spike_times, spike_clusters, templates,
+							  channel_map, channel_pos, params)
+	assert(snippet_store_is_valid(store_directory, source_files, store_params))
+	assert(np.array_equal(np.diff(store.unit_offsets), np.minimum(np.bincount(spike_clusters, minlength=6), 50)))
+
+def test_snippet_store_after_curation(tmpdir):
+
+	folder = str(tmpdir)
+	raw_data, raw_data_file, spike_times, spike_templates, templates, channel_map, channel_pos = \
+		make_kilosort_output(folder)
+
+	# units 1 and 3 merged into a new cluster ID, beyond the number of templates
+	spike_clusters = spike_templates.copy()
+	spike_clusters[(spike_templates == 1) | (spike_templates == 3)] = 8
+	store_directory = os.path.join(folder, 'snippet_store')
+
+	with pytest.raises(ValueError):
+		build_snippet_store(raw_data, spike_times, spike_clusters, templates, channel_map, channel_pos, store_directory)
+
+	build_snippet_store(raw_data, spike_times, spike_clusters, templates, channel_map, channel_pos, store_directory,
+						spikes_per_unit = 100, site_radius_um = 30, chunk_samples = 5000, spike_templates = spike_templates)
+	store = SnippetStore(store_directory)
+
+	template_peaks = np.argmax(np.max(templates, 1) - np.min(templates, 1), 1)
+	majority = np.argmax(np.bincount(spike_templates[spike_clusters == 8]))
+	assert(store.num_units == 9)
+	assert(template_peaks[majority] in store.kept_sites[8])
+	assert(np.array_equal(get_unit_peak_channels(spike_clusters, spike_templates, templates, channel_map, 9)[[0, 8]],
+						  template_peaks[[0, majority]]))
+
+	# peak channels of the templates, as from KilosortDataset.peak_channel_index
+	reversed_peaks = template_peaks[::-1].copy()
+	assert(np.array_equal(get_unit_peak_channels(spike_clusters, spike_templates, templates, channel_map, 9,
+												 reversed_peaks)[[0, 8]],
+						  reversed_peaks[[0, majority]]))
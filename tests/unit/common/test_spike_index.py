@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.spike_index import SpikeIndex
+from ecephys_spike_sorting.common.epoch import Epoch
+from ecephys_spike_sorting.modules.quality_metrics.metrics import group_spikes_by_cluster
+
+@pytest.mark.parametrize('time_sorted', [True, False])
+def test_epoch_ranges_match_masks(time_sorted):
+
+	rng = np.random.default_rng(0)
+	sample_rate = 30000.0
+	total_units = 12
+
+	spike_samples = np.round(rng.random(20000) * 100 * sample_rate).astype('uint64')
+	if time_sorted:
+		spike_samples = np.sort(spike_samples)
+	spike_clusters = rng.integers(0, total_units - 2, spike_samples.size)
+
+	spike_index = SpikeIndex(spike_samples, spike_clusters, total_units, sample_rate)
+	sorted_samples = spike_index.sort(spike_samples)
+	sorted_clusters = spike_index.sort(spike_clusters)
+	sorted_times = sorted_samples / sample_rate
+
+	epochs = [Epoch('complete_session', 0, np.inf),
+			  Epoch('middle', 10, 20),
+			  Epoch('on_spikes', sorted_times[5], sorted_times[100]),
+			  Epoch('empty', 50, 50)]
+
+	for epoch in epochs:
+
+		start, stop = spike_index.epoch_range(epoch, include_start = False, include_end = False)
+		in_epoch = (sorted_times > epoch.start_time) & (sorted_times < epoch.end_time)
+		assert(np.array_equal(np.where(in_epoch)[0], np.arange(start, stop)))
+
+		start, stop = spike_index.epoch_range(epoch)
+		in_epoch = (sorted_times >= epoch.start_time) & (sorted_times <= epoch.end_time)
+		assert(np.array_equal(np.where(in_epoch)[0], np.arange(start, stop)))
+
+		order, offsets = spike_index.grouped(start, stop)
+		expected_order, expected_offsets = group_spikes_by_cluster(sorted_clusters[start:stop], total_units,
+																  sorted_samples[start:stop])
+		assert(np.array_equal(order, expected_order))
+		assert(np.array_equal(offsets, expected_offsets))
+
+		assert(np.array_equal(spike_samples[spike_index.original_indices(start, stop)], sorted_samples[start:stop]))
+
+def test_epoch_convert_to_index():
+
+	timestamps = np.arange(1000) / 100.0
+
+	epoch = Epoch('test', 1.0, 2.5)
+	epoch.convert_to_index(timestamps)
+	assert((epoch.start_index, epoch.end_index) == (100, 250))
+
+	epoch = Epoch('complete_session', 0, np.inf)
+	epoch.convert_to_index(timestamps)
+	assert((epoch.start_index, epoch.end_index) == (0, 1000))
@@ -0,0 +1,154 @@
+import os
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import find_between_unit_overlap, \
+    find_between_unit_overlaps, find_within_unit_overlap, find_within_unit_overlaps, get_neighbor_pairs, \
+    write_kept_spikes, get_alignment_shifts, align_spike_times_from_templates, get_raw_mean_waveforms
+
+def make_spike_trains(seed, num_units, lag):
+
+    rng = np.random.default_rng(seed)
+
+    spike_times = rng.integers(0, 3000000, 20000)
+    spike_clusters = rng.integers(0, num_units, spike_times.size)
+
+    # copies of some spikes in the next unit, at a fixed lag
+    source = rng.integers(0, spike_times.size, 3000)
+    spike_times = np.concatenate((spike_times, spike_times[source] + lag))
+    spike_clusters = np.concatenate((spike_clusters, (spike_clusters[source] + 1) % num_units))
+
+    order = np.argsort(spike_times, kind='stable')
+
+    return spike_times[order].astype('uint64'), spike_clusters[order]
+
+def test_find_within_unit_overlaps():
+
+    spike_times, spike_clusters = make_spike_trains(0, 10, 3)
+    spike_times = np.concatenate((spike_times, spike_times[::7] + 2))
+    spike_clusters = np.concatenate((spike_clusters, spike_clusters[::7]))
+
+    spikes_to_remove, counts = find_within_unit_overlaps(spike_times, spike_clusters, 10, 5)
+
+    expected = []
+    for unit in range(10):
+        for_unit = np.where(spike_clusters == unit)[0]
+        to_remove = for_unit[find_within_unit_overlap(spike_times[for_unit], 5)]
+        assert(counts[unit] == to_remove.size)
+        expected.append(to_remove)
+
+    assert(np.array_equal(spikes_to_remove, np.sort(np.concatenate(expected))))
+
+@pytest.mark.parametrize('deletion_mode', ['lowAmpCluster', 'deleteFirst'])
+@pytest.mark.parametrize('lag', [0, 4, 11])
+def test_find_between_unit_overlaps_matches_pairs(deletion_mode, lag):
+
+    num_units = 12
+    rng = np.random.default_rng(lag)
+    spike_times, spike_clusters = make_spike_trains(lag, num_units, lag)
+    cluster_amplitude = rng.random(num_units)
+    peak_positions = np.stack((np.zeros((num_units,)), rng.integers(0, 10, num_units) * 20.0), 1)
+    unit_rank = np.argsort(np.argsort(peak_positions[:, 1]))
+
+    unit1, unit2 = get_neighbor_pairs(peak_positions, unit_rank, 50)
+
+    spikes_to_remove, count1, count2 = find_between_unit_overlaps(spike_times, spike_clusters, unit_rank, unit1, unit2,
+                                                                  cluster_amplitude, 12, deletion_mode)
+
+    expected = []
+    for pair in range(unit1.size):
+        for_unit1 = np.where(spike_clusters == unit1[pair])[0]
+        for_unit2 = np.where(spike_clusters == unit2[pair])[0]
+        to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+                                                           cluster_amplitude[unit1[pair]], cluster_amplitude[unit2[pair]],
+                                                           12, deletion_mode)
+        assert((count1[pair], count2[pair]) == (len(to_remove1), len(to_remove2)))
+        expected.extend([for_unit1[to_remove1], for_unit2[to_remove2]])
+
+    assert(np.array_equal(spikes_to_remove, np.unique(np.concatenate(expected))))
+    assert(spikes_to_remove.size > 0)
+
+def test_write_kept_spikes(tmpdir):
+
+    output_dir = str(tmpdir)
+    rng = np.random.default_rng(0)
+
+    spike_times = np.sort(rng.integers(0, 100000, 1000)).astype('uint64')
+    pc_features = rng.standard_normal((1000, 3, 8)).astype('float32')
+    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
+    np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
+
+    keep = rng.random(1000) > 0.3
+    new_times = spike_times + 5
+
+    write_kept_spikes(output_dir, keep, {'spike_times.npy' : new_times, 'pc_features.npy' : None}, chunk_spikes = 77)
+
+    assert(np.array_equal(np.load(os.path.join(output_dir, 'spike_times.npy')), new_times[keep]))
+    assert(np.array_equal(np.load(os.path.join(output_dir, 'pc_features.npy')), pc_features[keep]))
+    assert(sorted(os.listdir(output_dir)) == ['pc_features.npy', 'spike_times.npy'])
+
+def test_get_alignment_shifts_matches_rule():
+
+    rng = np.random.default_rng(1)
+    waveforms = rng.standard_normal((200, 82)) * rng.random((200, 1)) * 40
+
+    deltat, ambiguous = get_alignment_shifts(waveforms, 19)
+
+    for waveform, shift in zip(waveforms, deltat):
+        min_v, max_v = abs(np.min(waveform)), abs(np.max(waveform))
+        min_t, max_t = np.argmin(waveform), np.argmax(waveform)
+        if min_v > 30 and max_v > 30:
+            mean_peak_time = min(min_t, max_t)
+        else:
+            mean_peak_time = min_t if min_v >= max_v else max_t
+        assert(shift == 19 - mean_peak_time)
+
+    assert(not np.any(ambiguous))
+
+@pytest.mark.parametrize('ambiguity_margin', [1.5, 1000.0])
+def test_align_spike_times_from_templates(ambiguity_margin):
+
+    rng = np.random.default_rng(2)
+    num_units = 6
+    num_channels = 8
+    bit_volts = 0.195
+
+    # troughs and peaks at different samples, with both, one or neither above 30 uV
+    t = np.arange(61)
+    trough_t = rng.integers(15, 30, num_units)
+    templates = np.zeros((num_units, 61, num_channels))
+    for unit, (trough, peak) in enumerate([(400, 300), (400, 50), (60, 400), (100, 90), (500, 20), (300, 400)]):
+        wave = -trough * np.exp(-np.square((t - trough_t[unit]) / 2.0)) + peak * np.exp(-np.square((t - trough_t[unit] - 8) / 4.0))
+        templates[unit, :, unit] = wave
+        templates[unit, :, unit + 1] = wave * 0.5
+
+    spike_times = np.sort(rng.choice(np.arange(100, 299900), 3000, replace=False)).astype('uint64')
+    spike_clusters = rng.integers(0, num_units, spike_times.size)
+    amplitudes = np.ones((spike_times.size,))
+
+    raw_data = rng.standard_normal((300000, num_channels)) * 5
+    for time, unit in zip(spike_times, spike_clusters):
+        raw_data[int(time) - 20:int(time) + 41] += templates[unit]
+    raw_data = np.round(raw_data).astype('int16')
+
+    channel_map = np.arange(num_channels)
+    channel_pos = np.stack((np.zeros((num_channels,)), np.arange(num_channels) * 20.0), 1)
+
+    aligned, ambiguous_units = align_spike_times_from_templates(spike_times, spike_clusters, templates, amplitudes,
+                                                                channel_map, channel_pos, raw_data, bit_volts,
+                                                                ambiguity_margin = ambiguity_margin)
+
+    # shifts from the mean waveforms of all units in the raw data
+    units = np.arange(num_units)
+    mean_waves = get_raw_mean_waveforms(raw_data, spike_times, spike_clusters, units, units, channel_map, channel_pos,
+                                        bit_volts, site_radius_um = 1000)
+    max_site = np.argmax(np.max(mean_waves, 2) - np.min(mean_waves, 2), 1)
+    deltat, ambiguous = get_alignment_shifts(mean_waves[units, max_site, :], 19)
+
+    assert(aligned.dtype == spike_times.dtype)
+    assert(np.array_equal(aligned, spike_times - deltat[spike_clusters]))
+
+    if ambiguity_margin > 100:
+        assert(np.array_equal(ambiguous_units, units))
+    else:
+        assert(ambiguous_units.size < num_units)
@@ -2,8 +2,11 @@ import pytest
 import numpy as np
 import os
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, accumulate_mean_waveforms, \
+    accumulate_mean_waveforms_sharded, writeDataAsNpy, load_kept_sites
+import ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics as wm
 import ecephys_spike_sorting.common.utils as utils
+from ecephys_spike_sorting.common.snippet_store import SnippetStore, build_snippet_store
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
@@ -29,4 +32,292 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+
+def test_accumulate_mean_waveforms_matches_numpy():
+
+    rng = np.random.default_rng(0)
+    num_channels = 8
+    samples_per_spike = 20
+    bit_volts = 0.195
+
+    raw_data = rng.integers(-500, 500, (50000, num_channels)).astype('int16')
+    snippet_starts = rng.integers(0, raw_data.shape[0] - samples_per_spike, 3000)
+    snippet_groups = rng.integers(0, 7, snippet_starts.size)
+
+    count, mean, M2 = accumulate_mean_waveforms(raw_data, snippet_starts, snippet_groups, 8,
+                                                samples_per_spike, bit_volts, chunk_samples = 1000)
+
+    for group in range(8):
+
+        starts = snippet_starts[snippet_groups == group]
+        assert(count[group] == starts.size)
+
+        if starts.size > 0:
+            snippets = np.stack([raw_data[start:start + samples_per_spike, :].T for start in starts]) * bit_volts
+            assert(np.allclose(mean[group], np.mean(snippets, 0)))
+            assert(np.allclose(M2[group] / count[group], np.var(snippets, 0)))
+
+def test_accumulate_mean_waveforms_sharded(tmpdir):
+
+    rng = np.random.default_rng(2)
+    num_channels = 8
+    samples_per_spike = 20
+    bit_volts = 0.195
+
+    raw_data_file = os.path.join(str(tmpdir), 'continuous.dat')
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='w+', shape=(50000, num_channels))
+    raw_data[:] = rng.integers(-500, 500, raw_data.shape)
+    raw_data.flush()
+
+    snippet_starts = rng.integers(0, raw_data.shape[0] - samples_per_spike, 3000)
+    snippet_groups = rng.integers(0, 7, snippet_starts.size)
+
+    count, mean, M2 = accumulate_mean_waveforms(raw_data, snippet_starts, snippet_groups, 8,
+                                                samples_per_spike, bit_volts, chunk_samples = 1000)
+
+    sharded = accumulate_mean_waveforms_sharded(raw_data_file, raw_data.shape, raw_data.dtype,
+                                                snippet_starts, snippet_groups, 8, samples_per_spike,
+                                                bit_volts, 1000, num_workers = 2, num_shards = 5)
+
+    assert(np.array_equal(count, sharded[0]))
+    assert(np.allclose(mean, sharded[1]))
+    assert(np.allclose(M2, sharded[2]))
+
+def test_extract_waveforms_streaming():
+
+    rng = np.random.default_rng(1)
+    num_channels = 16
+    sample_rate = 30000.0
+    bit_volts = 0.195
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 50,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    raw_data = (rng.standard_normal((30000 * 20, num_channels)) * 20).astype('int16')
+    spike_times = np.sort(rng.integers(0, raw_data.shape[0], 2000)).astype('uint64')
+    spike_times[0] = 5    # too close to the start to be read
+    spike_clusters = rng.integers(0, 6, spike_times.size)
+    templates = rng.standard_normal((6, 82, num_channels))
+
+    np.random.seed(0)
+    mean_waveforms, spike_count, coords, labels, metrics, kept_sites = extract_waveforms(raw_data, spike_times,
+                                                                                         spike_clusters, templates,
+                                                                                         np.arange(num_channels),
+                                                                                         bit_volts, sample_rate, 20e-6,
+                                                                                         params, chunk_samples = 5000)
+
+    assert(np.array_equal(spike_count[:, 0], np.minimum(np.bincount(spike_clusters), 50)))
+    assert(metrics.shape[0] == 6)
+
+    # the same spikes are chosen as with a per-unit shuffle
+    np.random.seed(0)
+    for cluster_id in range(6):
+        times = spike_times[spike_clusters == cluster_id]
+        np.random.shuffle(times)
+        starts = times[:50].astype('int64') - 20
+        starts = starts[starts >= 0]
+        snippets = np.stack([raw_data[start:start + 82, :].T for start in starts]) * bit_volts
+        expected_mean = np.mean(snippets, 0)
+        assert(np.allclose(mean_waveforms[cluster_id, 0, 0], expected_mean - expected_mean[:, :1]))
+        assert(np.allclose(mean_waveforms[cluster_id, 0, 1], np.std(snippets, 0)))
+
+    # worker processes read the raw data from its file
+    with pytest.raises(ValueError):
+        extract_waveforms(raw_data, spike_times, spike_clusters, templates, np.arange(num_channels),
+                          bit_volts, sample_rate, 20e-6, params, num_workers = 2)
+
+def test_extract_waveforms_compact(tmpdir):
+
+    rng = np.random.default_rng(5)
+    num_channels = 32
+    sample_rate = 30000.0
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 50,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    raw_data = (rng.standard_normal((30000 * 10, num_channels)) * 20).astype('int16')
+    spike_times = np.sort(rng.integers(100, raw_data.shape[0] - 100, 1000)).astype('uint64')
+    spike_clusters = rng.integers(0, 5, spike_times.size)
+    templates = rng.standard_normal((5, 82, num_channels))
+    channel_map = np.arange(num_channels)
+
+    outputs = []
+    for waveform_dtype, site_radius_um in [('float64', 0), ('float32', 45)]:
+        np.random.seed(0)
+        outputs.append(extract_waveforms(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195,
+                                         sample_rate, 20e-6, params, waveform_dtype = waveform_dtype,
+                                         site_radius_um = site_radius_um))
+
+    full, compact = outputs[0][0], outputs[1][0]
+    kept_sites = outputs[1][5]
+    peak_channels = np.argmax(np.max(templates, 1) - np.min(templates, 1), 1)
+
+    assert(outputs[0][5] is None)
+    assert(compact.dtype == np.float32)
+    assert(compact.shape == (5, 1, 2, 5, 82))
+
+    for cluster_id in range(5):
+        sites = kept_sites[cluster_id][kept_sites[cluster_id] >= 0]
+        assert(np.array_equal(sites, np.arange(max(peak_channels[cluster_id] - 2, 0),
+                                               min(peak_channels[cluster_id] + 3, num_channels))))
+        assert(np.allclose(compact[cluster_id, :, :, :sites.size], full[cluster_id][:, :, sites], atol=1e-3))
+
+    # 1D metrics only use the peak channel
+    for column in ['snr', 'duration', 'PT_ratio']:
+        assert(np.allclose(outputs[0][4][column], outputs[1][4][column]))
+
+    mean_waveforms_file = os.path.join(str(tmpdir), 'mean_waveforms.npy')
+    writeDataAsNpy(compact, mean_waveforms_file, kept_sites)
+    assert(np.array_equal(load_kept_sites(mean_waveforms_file, np.load(mean_waveforms_file)), kept_sites))
+
+    writeDataAsNpy(full, mean_waveforms_file)
+    assert(load_kept_sites(mean_waveforms_file, np.load(mean_waveforms_file)) is None)
+
+def test_extract_waveforms_from_snippet_store(tmpdir):
+
+    rng = np.random.default_rng(6)
+    num_channels = 32
+    sample_rate = 30000.0
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 1000,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    raw_data = (rng.standard_normal((30000 * 10, num_channels)) * 20).astype('int16')
+    spike_times = np.sort(rng.integers(100, raw_data.shape[0] - 100, 1000)).astype('uint64')
+    spike_clusters = rng.integers(0, 5, spike_times.size)
+    templates = rng.standard_normal((5, 82, num_channels))
+    channel_map = np.arange(num_channels)
+    channel_pos = np.stack([np.zeros((num_channels,)), np.arange(num_channels) * 20.0], 1)
+
+    store_directory = os.path.join(str(tmpdir), 'snippet_store')
+    build_snippet_store(raw_data, spike_times, spike_clusters, templates, channel_map, channel_pos, store_directory,
+                        spikes_per_unit = 1000, site_radius_um = 45)
+
+    # every spike is used, so both paths average the same snippets
+    outputs = [extract_waveforms(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, sample_rate,
+                                 20e-6, params, channel_pos = channel_pos, site_radius_um = 45,
+                                 snippet_store = snippet_store) for snippet_store in [None, SnippetStore(store_directory)]]
+
+    assert(np.array_equal(outputs[0][5], outputs[1][5]))
+    assert(np.array_equal(outputs[0][1], outputs[1][1]))
+    assert(np.allclose(outputs[0][0], outputs[1][0]))
+
+    for column in ['snr', 'duration', 'PT_ratio', 'spread']:
+        assert(np.allclose(outputs[0][4][column], outputs[1][4][column], equal_nan=True))
+
+def test_calculate_1D_features_matches_per_unit():
+
+    rng = np.random.default_rng(3)
+    num_samples = 200
+    timestamps = np.linspace(0, 82 / 30000.0, num_samples)
+
+    t = np.arange(num_samples)[np.newaxis, :] - rng.integers(20, 150, (50, 1))
+    waveforms = -np.exp(-np.square(t / 8.0)) + rng.random((50, 1)) * np.exp(-np.square((t - 30) / 20.0))
+    waveforms[::5] = -waveforms[::5]
+    waveforms += 0.05 * rng.standard_normal(waveforms.shape)
+
+    features = wm.calculate_1D_features(waveforms, timestamps)
+
+    for idx, waveform in enumerate(waveforms):
+        expected = [wm.calculate_waveform_duration(waveform, timestamps),
+                    wm.calculate_waveform_halfwidth(waveform, timestamps),
+                    wm.calculate_waveform_PT_ratio(waveform),
+                    wm.calculate_waveform_repolarization_slope(waveform, timestamps),
+                    wm.calculate_waveform_recovery_slope(waveform, timestamps)]
+        for feature, value in zip(features, expected):
+            assert(np.allclose(feature[idx], value, equal_nan=True))
+
+def test_site_neighborhoods_linear_probe():
+
+    site_x = np.zeros((64,))
+    site_y = np.arange(64) * 20.0
+
+    nn_candidates, sites_to_sample = wm.get_site_neighborhoods(site_x, site_y, np.array([0, 30]), 16)
+
+    # all sites are in one column, so the 16 sites closest to the peak are sampled
+    assert(np.array_equal(np.sort(sites_to_sample[0, -1]), np.arange(16)))
+    assert(np.array_equal(np.sort(sites_to_sample[1, -1]), np.arange(22, 38)))
+    assert(np.array_equal(sites_to_sample[1, 0], sites_to_sample[1, -1]))
+
+def reference_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range = 16):
+
+    # the original per-unit calculate_2D_features, kept here as the reference for the batched version
+
+    dist = np.sqrt(np.square(site_x - site_x[peak_channel]) + np.square(site_y - site_y[peak_channel]))
+    ydiff = (site_y != site_y[peak_channel])
+    min_dist = 1e6
+    x_nn = -1
+    amp_nn = 0
+    x_peak = site_x[peak_channel]
+
+    for i in range(site_x.size):
+        if ydiff[i] and dist[i] <= min_dist:
+            min_dist = dist[i]
+            currAmp = np.max(waveform[i,:]) - np.min(waveform[i,:])
+            if currAmp > amp_nn:
+                x_nn = site_x[i]
+
+    inCol = (site_x == x_peak) | (site_x == x_nn)
+    sort_dist_ind = np.argsort(dist)
+    sites_to_sample = np.zeros(site_range+1, dtype='int32')
+
+    nfound = 0
+    i = 0
+    while nfound < site_range and i < site_x.size:
+        if inCol[sort_dist_ind[i]]:
+            sites_to_sample[nfound] = sort_dist_ind[i]
+            nfound = nfound + 1
+        i = i + 1
+
+    sites_to_sample = sites_to_sample[0:nfound]
+    wv = waveform[sites_to_sample, :]
+
+    trough_idx = np.argmin(wv, 1)
+    overall_amplitude = np.max(wv, 1) - np.min(wv, 1)
+    amplitude = np.max(overall_amplitude)
+    max_chan = np.argmax(overall_amplitude)
+
+    points_above_thresh = np.where(overall_amplitude > (amplitude * spread_threshold))[0]
+    if len(points_above_thresh) > 1:
+        points_above_thresh = points_above_thresh[wm.isnot_outlier(points_above_thresh)]
+
+    yDist = (site_y[sites_to_sample] - site_y[peak_channel])[points_above_thresh]
+    spread = np.max(yDist) - np.min(yDist) if len(yDist) > 0 else 0
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[max_chan]]
+    trough_times = trough_times[points_above_thresh]
+
+    velocity_above, velocity_below = wm.get_velocity(yDist, trough_times)
+
+    return amplitude, spread, velocity_above, velocity_below
+
+
+def test_calculate_2D_features_for_units():
+
+    rng = np.random.default_rng(4)
+    num_channels = 96
+    num_samples = 82
+    sample_rate = 30000.0
+    upsampling_factor = 200/82
+
+    # timestamps as built by calculate_waveform_metrics_for_units, which passes the
+    # timestamps of the upsampled 1D waveforms along with the 2D waveforms
+    timestamps = np.linspace(0, num_samples / sample_rate, int(num_samples * upsampling_factor))
+
+    site_x = np.tile([43, 11, 59, 27], num_channels // 4).astype('float64')
+    site_y = 20.0 * (np.arange(num_channels) // 2)
+    peak_channels = rng.integers(0, num_channels, 20)
+
+    t = np.arange(num_samples)[np.newaxis, np.newaxis, :] - 20 - rng.integers(-3, 4, (20, num_channels, 1))
+    distance = np.abs(site_y[np.newaxis, :] - site_y[peak_channels][:, np.newaxis])
+    waveforms = -np.exp(-np.square(t / 3.0)) * np.exp(-np.square(distance / 40.0))[:, :, np.newaxis] * 100
+    waveforms += rng.standard_normal(waveforms.shape)
+
+    features = wm.calculate_2D_features_for_units(waveforms, timestamps, peak_channels, site_x, site_y)
+
+    for idx in range(20):
+        expected = reference_2D_features(waveforms[idx], timestamps, peak_channels[idx], site_x, site_y)
+        assert(np.allclose([feature[idx] for feature in features], expected, equal_nan=True))
+        assert(features[0][idx] >= np.max(waveforms[idx, peak_channels[idx]]) - np.min(waveforms[idx, peak_channels[idx]]))
@@ -1,8 +1,11 @@
 import pytest
 import numpy as np
+import pandas as pd
 import os
 
 from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+import ecephys_spike_sorting.modules.quality_metrics.metrics as qm
+from ecephys_spike_sorting.modules.quality_metrics.__main__ import reuse_pc_metrics
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -31,6 +34,296 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+def test_spike_train_metrics_match_per_unit_functions():
+
+	rng = np.random.default_rng(0)
+	num_spikes = 20000
+	total_units = 25
+
+	spike_times = np.sort(rng.random(num_spikes) * 300)
+	spike_clusters = rng.integers(0, total_units - 2, num_spikes)
+	spike_clusters[spike_clusters == 3] = 4    # one unit with no spikes
+	amplitudes = rng.gamma(5, 3, num_spikes).astype('float32')
+	amplitudes[spike_clusters == 5] = 10.0     # one unit with constant amplitude
+
+	grouped = qm.calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units, 0.0015, 0.0001, 0.001)
+
+	isi_viol, num_viol = qm.calculate_isi_violations(spike_times, spike_clusters, total_units, 0.0015, 0.0001)
+	per_unit = (isi_viol,
+			 num_viol,
+			 qm.calculate_contam_rate(spike_times, spike_clusters, total_units, 0.001, 0.0015),
+			 qm.calculate_presence_ratio(spike_times, spike_clusters, total_units),
+			 qm.calculate_firing_rate(spike_times, spike_clusters, total_units),
+			 qm.calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units))
+
+	for a, b in zip(grouped, per_unit):
+		assert(np.array_equal(a, b, equal_nan=True))
+
+def test_refractory_period_sweep_matches_single_thresholds():
+
+	rng = np.random.default_rng(3)
+	num_spikes = 20000
+	total_units = 10
+
+	spike_times = np.sort(rng.random(num_spikes) * 100)
+	spike_clusters = rng.integers(0, total_units, num_spikes)
+	amplitudes = rng.gamma(5, 3, num_spikes)
+	thresholds = np.array([0.002, 0.0005, 0.0015, 0.001])
+
+	sweep = qm.calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units, thresholds, 0.0001, 0.001)
+
+	for idx, threshold in enumerate(thresholds):
+		single = qm.calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units, threshold, 0.0001, 0.001)
+		for a, b in zip(sweep[:3], single[:3]):
+			assert(np.array_equal(a[:,idx], b))
+
+	st = spike_times[spike_clusters == 0]
+	fp_rate, num_violations = qm.isi_violations(st, 0, 100, thresholds, 0.0001)
+	assert(np.allclose(fp_rate, [qm.isi_violations(st, 0, 100, t, 0.0001)[0] for t in thresholds]))
+	assert(np.array_equal(num_violations, [qm.isi_violations(st, 0, 100, t, 0.0001)[1] for t in thresholds]))
+	assert(np.array_equal(qm.contamination_rate(st, 0.001, thresholds),
+						  [qm.contamination_rate(st, 0.001, t) for t in thresholds]))
+
+def test_ccg_matches_all_pairs():
+
+	rng = np.random.default_rng(1)
+	nbins = 500
+	tbin = 0.001
+	dt = nbins * tbin
+
+	st1 = np.sort(rng.random(400) * 20)
+	st2 = np.sort(rng.random(300) * 20)
+
+	# brute force over all pairs, same window and binning as the Kilosort2 loop
+	in_window = (st1[np.newaxis,:] > st2[:,np.newaxis] - dt) & (st1[np.newaxis,:] < st2[:,np.newaxis] + dt)
+	lags = np.round((st2[:,np.newaxis] - st1[np.newaxis,:]) / tbin)[in_window].astype('int')
+	expected = np.bincount(lags + nbins, minlength=2 * nbins + 1)
+
+	K, Qi, Q00, Q01, Ri = qm.ccg(st1, st2, nbins, tbin, False)
+
+	assert(np.array_equal(K, expected))
+	assert(Qi.shape == (11,))
+
+def test_grouped_autocorrelograms_match_ccg():
+
+	rng = np.random.default_rng(2)
+	total_units = 6
+
+	spike_times = np.sort(np.round(rng.random(5000) * 60 * 30000) / 30000)
+	spike_clusters = rng.integers(0, total_units, spike_times.size)
+
+	order, offsets = qm.group_spikes_by_cluster(spike_clusters, total_units, spike_times)
+	K = qm.grouped_autocorrelograms(spike_times[order], spike_clusters[order], total_units, 500, 0.001)
+
+	for cluster_id in range(total_units):
+		st = spike_times[spike_clusters == cluster_id]
+		assert(np.array_equal(K[cluster_id], qm.ccg(st, st, 500, 0.001, True)[0]))
+		assert(qm.grouped_contamination_rate(spike_times[order], offsets, np.array([cluster_id]), 0.001, 0.0015)[0] ==
+			   qm.contamination_rate(st, 0.001, 0.0015))
+
+def make_pc_data(num_spikes = 6000, total_units = 12, num_channels = 32, channels_per_template = 8, seed = 0):
+
+	rng = np.random.default_rng(seed)
+
+	channel_pos = np.stack((np.tile([16, 48], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20, 2)), 1).astype('float')
+	peak = rng.integers(0, num_channels, total_units)
+	distance = np.abs(channel_pos[:,1][np.newaxis,:] - channel_pos[peak,1][:,np.newaxis])
+	pc_feature_ind = np.argsort(distance, 1, kind='stable')[:, :channels_per_template].astype('uint32')
+
+	spike_clusters = rng.integers(0, total_units, num_spikes)
+	spike_times = np.sort(rng.random(num_spikes) * 600)
+	pc_features = rng.normal(size=(num_spikes, 3, channels_per_template)).astype('float32')
+	pc_features[:,0,0] += 5 + (spike_clusters % 5)
+
+	return spike_times, spike_clusters, spike_clusters.copy(), pc_features, pc_feature_ind, channel_pos, total_units
+
+def test_sharded_pc_metrics_match_serial():
+
+	spike_times, spike_clusters, spike_templates, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_data()
+
+	args = (spike_clusters, spike_templates, total_units, np.unique(spike_clusters), np.arange(total_units),
+			pc_features, pc_feature_ind, channel_pos, 68, 500, 10000, 4)
+
+	serial = qm.calculate_pc_metrics(*args, seed = 1)
+	sharded = qm.calculate_pc_metrics(*args, num_workers = 2, max_memory_gb = 1e-4, seed = 1)
+
+	for a, b in zip(serial, sharded):
+		assert(np.array_equal(a, b, equal_nan=True))
+
+	# peak channels computed beforehand (as for the fingerprints) give the same results
+	peak_channels = qm.calculate_peak_channels(spike_clusters, total_units, np.unique(spike_clusters), np.arange(total_units),
+											   pc_features, pc_feature_ind)
+	for a, b in zip(serial, qm.calculate_pc_metrics(*args, seed = 1, peak_channels = peak_channels)):
+		assert(np.array_equal(a, b, equal_nan=True))
+
+def test_memmapped_pc_metrics_match_copies(tmp_path):
+
+	spike_times, spike_clusters, spike_templates, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_data()
+
+	np.save(tmp_path / 'pc_features.npy', pc_features)
+	pc_features_mmap = np.load(tmp_path / 'pc_features.npy', mmap_mode='r')
+
+	in_epoch = np.where((spike_times > 100) & (spike_times < 400))[0]
+	args = (spike_clusters[in_epoch], spike_templates[in_epoch], total_units, np.unique(spike_clusters[in_epoch]), np.arange(total_units))
+	other_args = (pc_feature_ind, channel_pos, 68, 500, 10000, 4)
+
+	copied = qm.calculate_pc_metrics(*args, pc_features[in_epoch], *other_args, seed = 1)
+	indexed = qm.calculate_pc_metrics(*args, pc_features_mmap, *other_args, seed = 1, pc_index = in_epoch)
+
+	for a, b in zip(copied, indexed):
+		assert(np.array_equal(a, b, equal_nan=True))
+
+	drift_args = (spike_times[in_epoch], spike_clusters[in_epoch], spike_templates[in_epoch], np.arange(total_units), total_units)
+
+	copied = qm.calculate_drift_metrics(*drift_args, pc_features[in_epoch], pc_feature_ind, channel_pos, 50, 10)
+	indexed = qm.calculate_drift_metrics(*drift_args, pc_features_mmap, pc_feature_ind, channel_pos, 50, 10, in_epoch, chunk_size = 500)
+
+	for a, b in zip(copied, indexed):
+		assert(np.array_equal(a, b, equal_nan=True))
+
+def test_pairwise_silhouette_scores_match_sklearn():
+
+	from sklearn.metrics import silhouette_score
+
+	rng = np.random.default_rng(2)
+	labels = rng.integers(0, 8, 400)
+	labels[0] = 9 # a cluster with a single sample
+	X = rng.normal(size=(400, 6)) + labels[:, np.newaxis] * 0.2
+
+	SS = qm.pairwise_silhouette_scores(X, labels, 10, max_block_elements = 400 * 17)
+
+	for i in range(10):
+		for j in range(10):
+			inds = np.isin(labels, [i, j])
+			if j > i and np.sum(inds) > 2 and np.any(labels == i) and np.any(labels == j):
+				assert(np.isclose(SS[i, j], silhouette_score(X[inds], labels[inds])))
+			else:
+				assert(np.isnan(SS[i, j]))
+
+def test_grouped_medians_match_per_group_median():
+
+	rng = np.random.default_rng(3)
+	values = rng.normal(size=2000)
+	groups = rng.integers(0, 7, 2000)
+	bins = rng.integers(0, 9, 2000)
+
+	medians = qm.get_grouped_medians(values, groups, bins, 8, 10, 30)
+
+	for i in range(8):
+		for j in range(10):
+			in_group = (groups == i) * (bins == j)
+			if np.sum(in_group) >= 30:
+				assert(medians[i, j] == np.median(values[in_group]))
+			else:
+				assert(np.isnan(medians[i, j]))
+
+def test_whitened_pc_metrics_match_mahalanobis_and_lda():
+
+	rng = np.random.default_rng(4)
+	all_pcs = np.concatenate((rng.normal(size=(300, 12)) @ rng.normal(size=(12, 12)), rng.normal(size=(900, 12)) * 3 + 1))
+	all_labels = np.concatenate((np.ones((300,), dtype='int') * 5, rng.integers(0, 4, 900)))
+
+	isolation_distance, l_ratio = qm.mahalanobis_metrics(all_pcs, all_labels, 5)
+	d_prime = qm.lda_metrics(all_pcs, all_labels, 5)
+
+	result = qm.whitened_pc_metrics(all_pcs, all_labels, 5, chunk_size = 100)
+
+	assert(np.allclose(result, (isolation_distance, l_ratio, d_prime), rtol = 1e-9))
+
+def test_majority_templates_match_bincount():
+
+	rng = np.random.default_rng(5)
+	spike_clusters = rng.integers(0, 20, 3000)
+	spike_templates = rng.integers(0, 6, 3000)
+	spike_clusters[spike_clusters == 4] = 5
+
+	template_ids = qm.get_majority_templates(spike_clusters, spike_templates, 21)
+
+	for cluster_id in range(21):
+		if np.any(spike_clusters == cluster_id):
+			assert(template_ids[cluster_id] == np.argmax(np.bincount(spike_templates[spike_clusters == cluster_id])))
+		else:
+			assert(template_ids[cluster_id] == -1)
+
+def test_incremental_pc_metrics_match_full_recompute():
+
+	spike_times, spike_clusters, spike_templates, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_data(num_spikes = 10000, total_units = 30)
+
+	def fingerprints_and_metrics(spike_clusters, units_to_compute = None):
+		total_units = np.max(spike_clusters) + 1
+		cluster_ids = np.unique(spike_clusters)
+		template_ids = qm.get_majority_templates(spike_clusters, spike_templates, total_units)
+		fingerprints = qm.unit_fingerprints(spike_clusters, total_units)
+		fingerprints['peak_channel'] = qm.calculate_peak_channels(spike_clusters, total_units, cluster_ids, template_ids, pc_features, pc_feature_ind)[cluster_ids]
+		metrics = qm.calculate_pc_metrics(spike_clusters, spike_templates, total_units, cluster_ids, template_ids, pc_features, pc_feature_ind, channel_pos, 68, 500, 10000, 4, seed = 2, units_to_compute = units_to_compute)
+		return fingerprints, np.array(metrics)
+
+	previous_fingerprints, previous_metrics = fingerprints_and_metrics(spike_clusters)
+
+	# merge two units and split another one
+	curated = spike_clusters.copy()
+	curated[curated == 5] = 6
+	curated[(curated == 20) * (spike_times > 300)] = 30
+
+	fingerprints, metrics = fingerprints_and_metrics(curated)
+
+	units_to_update = qm.find_units_to_update(fingerprints, previous_fingerprints, channel_pos, 68)
+
+	assert(np.all(np.isin([5, 6, 20, 30], units_to_update)))
+	assert(units_to_update.size < 31)
+
+	fingerprints, updated = fingerprints_and_metrics(curated, units_to_update)
+
+	reused = np.setdiff1d(fingerprints['cluster_id'].values, units_to_update)
+	updated[:, reused] = previous_metrics[:, reused]
+
+	assert(np.array_equal(metrics, updated, equal_nan=True))
+
+def test_reused_pc_metrics_match_epoch():
+
+	pc_metrics = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
+
+	def metrics_table(cluster_ids, epochs, offset):
+		rows = pd.DataFrame({'cluster_id' : np.tile(cluster_ids, len(epochs)),
+							 'epoch_name' : np.repeat(epochs, len(cluster_ids))})
+		for i, column in enumerate(pc_metrics):
+			rows[column] = rows['cluster_id'] * 10 + rows['epoch_name'].map({'a' : 1.0, 'b' : 2.0}) + i + offset
+		return rows
+
+	previous = metrics_table([0, 1, 2], ['a', 'b'], 0)
+	metrics = metrics_table([0, 1, 2, 3], ['a', 'b'], 0.5)
+	metrics.loc[metrics['cluster_id'] != 1, pc_metrics] = np.nan
+
+	# as saved after merging with the waveform metrics
+	previous = previous.rename(columns={'epoch_name' : 'epoch_name_quality_metrics'})
+
+	reused = reuse_pc_metrics(metrics.copy(), previous, np.array([1, 3]))
+	expected = metrics_table([0, 1, 2, 3], ['a', 'b'], 0)
+	expected.loc[expected['cluster_id'] == 1, pc_metrics] += 0.5
+	expected.loc[expected['cluster_id'] == 3, pc_metrics] = np.nan
+
+	assert(reused[pc_metrics].equals(expected[pc_metrics]))
+
+def test_grouped_ibl_metrics_match_per_unit_functions():
+
+	import ecephys_spike_sorting.modules.quality_metrics.ibl_metrics as ibl
+
+	rng = np.random.default_rng(6)
+	spike_clusters = np.concatenate([np.full((n,), i) for i, n in enumerate(rng.integers(0, 3000, 15))])
+	spike_times = np.concatenate([np.cumsum(0.002 + rng.exponential(0.1, n)) for n in np.bincount(spike_clusters, minlength=15)])
+	amplitudes = rng.lognormal(3, 0.4, spike_times.size)
+
+	order = np.argsort(spike_times, kind='stable')
+	spike_times, spike_clusters, amplitudes = spike_times[order], spike_clusters[order], amplitudes[order]
+
+	SRP_pass = ibl.calculate_slidingRP(spike_times, spike_clusters, 16, 30000)
+	nc_pass = ibl.calculate_noise_cutoff(amplitudes, spike_clusters, 16)
+
+	for cluster_id in range(16):
+		in_cluster = spike_clusters == cluster_id
+		assert(SRP_pass[cluster_id] == ibl.slidingRP_viol(spike_times[in_cluster], sample_rate = 30000))
+		assert(nc_pass[cluster_id] == ibl.noise_cutoff(amplitudes[in_cluster])[0])
+
 if __name__ == "__main__":
     #test_quality_metrics()
     pass
\ No newline at end of file
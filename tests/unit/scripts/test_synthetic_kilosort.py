@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from ecephys_spike_sorting.scripts.benchmarks.synthetic_kilosort import make_synthetic_kilosort_output
+
+def test_synthetic_kilosort_output(tmpdir):
+
+    folder = str(tmpdir)
+    info = make_synthetic_kilosort_output(folder, num_spikes = 20000, num_units = 20, num_channels = 64,
+                                          num_pc_channels = 8, chunk_size = 3000)
+
+    spike_times = np.load(os.path.join(folder, 'spike_times.npy'))
+    spike_clusters = np.load(os.path.join(folder, 'spike_clusters.npy'))
+    pc_features = np.load(os.path.join(folder, 'pc_features.npy'))
+
+    assert(spike_times.dtype == 'uint64')
+    assert(spike_clusters.dtype == 'int32')
+    assert(spike_times.shape == spike_clusters.shape == (info['num_spikes'],))
+    assert(np.all(np.diff(spike_times.astype('int64')) >= 0))
+    assert(spike_times[-1] <= np.round(info['duration_s'] * info['sample_rate']))
+
+    assert(pc_features.dtype == 'float32')
+    assert(pc_features.shape == (info['num_spikes'], 3, 8))
+    assert(np.load(os.path.join(folder, 'pc_feature_ind.npy')).shape == (20, 8))
+    assert(np.load(os.path.join(folder, 'templates.npy')).shape == (20, 82, 64))
+    assert(np.load(os.path.join(folder, 'amplitudes.npy')).shape == (info['num_spikes'],))
+    assert(np.load(os.path.join(folder, 'channel_positions.npy')).shape == (64, 2))
+
+    # without contamination, no spikes are wrapped around into another's refractory period
+    make_synthetic_kilosort_output(folder, num_spikes = 20000, num_units = 20, num_channels = 64,
+                                   num_pc_channels = 8, contamination = 0, seed = 1)
+    spike_times = np.load(os.path.join(folder, 'spike_times.npy')).astype('int64')
+    spike_clusters = np.load(os.path.join(folder, 'spike_clusters.npy'))
+    for unit in range(20):
+        assert(np.all(np.diff(spike_times[spike_clusters == unit]) >= 44))